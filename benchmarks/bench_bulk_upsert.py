@@ -0,0 +1,79 @@
+"""
+Benchmark of the ways rows can be written to the staging tables: ORM objects through the unit of work
+(the old path of the move_*_to_sqlite methods) against transform.bulk_upsert.
+
+Run from the project folder: python benchmarks/bench_bulk_upsert.py [rows ...]
+"""
+import os
+import sys
+import tempfile
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, StudentCourseInstance
+from transform import bulk_upsert
+
+
+def make_rows(n):
+    """Builds n StudentCourseInstance rows shaped like the ones move_instances_to_sqlite builds"""
+    return [dict(
+                talentlms_user_id=i // 10,
+                talentlms_course_id=i % 10,
+                instance_name=f'Last{i} First{i}: Course {i % 10}',
+                firstname=f'First{i}',
+                lastname=f'Last{i}',
+                course_name=f'Course {i % 10}',
+                code=f'01ABC-{i % 10}',
+                company_cohort_id='cohort',
+                completed_on=1650000000000,
+                completion_status='completed',
+                completion_percent=100,
+                email=f'user{i}@example.com',
+                live_session_datetime=1670000000000,
+                role='learner',
+                session_time='18:00:00 EST',
+                status='active',
+                total_time='1h 2m',
+                total_time_seconds=3720,
+                last_accessed_unit_url='https://client_name.talentlms.com/unit',
+                assignment_complete='No'
+                ) for i in range(n)]
+
+
+def orm_path(session, rows):
+    session.add_all([StudentCourseInstance(**row) for row in rows])
+    session.commit()
+
+
+def bulk_path(session, rows):
+    bulk_upsert(session, StudentCourseInstance, rows)
+    session.commit()
+
+
+def time_path(path, rows):
+    """Times one path against a fresh database file"""
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(f"sqlite:///{os.path.join(folder, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        start = perf_counter()
+        path(session, rows)
+        elapsed = perf_counter() - start
+        session.close()
+        engine.dispose()
+    return elapsed
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [10_000, 100_000]
+    for n in sizes:
+        rows = make_rows(n)
+        orm = time_path(orm_path, rows)
+        bulk = time_path(bulk_path, rows)
+        print(f'{n:>8} rows | ORM {orm:7.2f}s ({n / orm:9.0f} rows/s) | bulk upsert {bulk:7.2f}s '
+              f'({n / bulk:9.0f} rows/s) | {orm / bulk:5.1f}x')
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the date parsing in transform.py against the fuzzy dateutil parsing it replaced.
+Also checks that both give the exact same output for every input.
+
+Run from the project folder: python benchmarks/bench_date_parsing.py [repeats]
+"""
+import os
+import random
+import sys
+
+from calendar import timegm
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytz
+
+from dateutil.parser import parse
+
+import transform
+
+
+def old_to_millisec(datetime_str):
+    """to_millisec before the fast path"""
+    return timegm(parse(datetime_str, fuzzy=True).timetuple()) * 1000
+
+
+def old_convert_dt_to_utc(dt_str, zonename='US/Eastern'):
+    """convert_dt_to_utc before the fast path"""
+    tz = pytz.timezone(zonename)
+    dt_obj_aware = tz.localize(parse(dt_str, fuzzy=True))
+    return timegm(dt_obj_aware.astimezone(pytz.utc).timetuple()) * 1000, dt_obj_aware.strftime("%H:%M:%S %Z")
+
+
+def make_inputs(repeats):
+    """Dates in the formats TalentLMS sends, repeated the way cohorts share them, plus a few odd ones"""
+    random.seed(0)
+    dates = []
+    for _ in range(200):
+        month, day, year = random.randint(1, 12), random.randint(1, 28), random.randint(2019, 2024)
+        hour, minute, second = random.randint(0, 23), random.randint(0, 59), random.randint(0, 59)
+        dates += [
+                f'{month:02}/{day:02}/{year}',
+                f'{month}/{day}/{year}',
+                f'{month:02}/{day:02}/{year}, {hour:02}:{minute:02}:{second:02}',
+                f'{month:02}/{day:02}/{year} {hour % 12 + 1}:{minute:02} {"AM" if hour < 12 else "PM"}',
+                f'{year}-{month:02}-{day:02}',
+                f'{year}-{month:02}-{day:02}T{hour:02}:{minute:02}:{second:02}.{random.randint(0, 999999):06}',
+                ]
+    odd = ['December 3, 2022 6:00 PM', 'Dec 3 2022', 'on 12/03/2022 at 6pm', '3rd of March 2022 18:00']
+    return (dates + odd) * repeats
+
+
+def bench(function, inputs):
+    start = perf_counter()
+    results = [function(value) for value in inputs]
+    return perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    inputs = make_inputs(repeats)
+    for name, old, new in (('to_millisec', old_to_millisec, transform.to_millisec),
+                           ('convert_dt_to_utc', old_convert_dt_to_utc, transform.convert_dt_to_utc)):
+        transform.parse_datetime.cache_clear()
+        transform.convert_dt_to_utc.cache_clear()
+        old_time, old_results = bench(old, inputs)
+        new_time, new_results = bench(new, inputs)
+        mismatches = [value for value, a, b in zip(inputs, old_results, new_results) if a != b]
+        print(f'{name:>17} | {len(inputs)} inputs | dateutil {old_time:6.3f}s | fast path {new_time:6.3f}s '
+              f'| {old_time / new_time:6.1f}x | {len(mismatches)} mismatches')
+        if mismatches:
+            print('    mismatching inputs:', sorted(set(mismatches))[:10])
+            sys.exit(1)
@@ -0,0 +1,87 @@
+"""
+Import time of each module of the integration, measured with python -X importtime in a fresh interpreter,
+and a regression check of the cumulative times against the ones saved in import_time_baseline.json.
+
+Run from the project folder:
+    python benchmarks/bench_import_time.py            prints the import times next to the baseline
+    python benchmarks/bench_import_time.py --check    exits with 1 if a module got slower than the baseline allows
+    python benchmarks/bench_import_time.py --update   saves the current times as the new baseline
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_time_baseline.json')
+MODULES = ('logger', 'models', 'cache', 'templates', 'queries', 'transform', 'talentlmsapi', 'task')
+REPEATS = 7
+# A module fails the check when it takes longer than its baseline times TOLERANCE plus SLACK_US,
+# the slack keeps small modules from failing on noise
+TOLERANCE = 1.5
+SLACK_US = 20000
+# hubapi.py is not part of this repository, so the modules that import it are measured with a stand-in
+# module holding the names they import, the way tests/conftest.py does. Its own import time is left out.
+HUBAPI_NAMES = ('CreateRecordsHandler', 'UpdateRecordsHandler', 'CreateAssociationsHandler', 'read_property',
+                'add_value_to_property')
+HUBAPI_STUB = ('import sys, types; hubapi = types.ModuleType("hubapi"); '
+               f'hubapi.__dict__.update(dict.fromkeys({HUBAPI_NAMES!r})); sys.modules["hubapi"] = hubapi')
+
+
+def import_time(module):
+    """
+    Median import time of a module over REPEATS fresh interpreters
+
+    Args:
+        module (str): name of the module
+
+    Returns:
+        (tuple): microseconds spent in the module itself and cumulative with what it imports, or None if 
+            the module can not be imported here
+    """
+    times = []
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get('PYTHONPATH')])))
+    for _ in range(REPEATS):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'{HUBAPI_STUB}; import {module}'], cwd=PROJECT_DIR, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        # Lines look like "import time:  self [us] | cumulative | imported package", the module itself comes last
+        for line in reversed(result.stderr.splitlines()):
+            parts = [part.strip() for part in line.split('|')]
+            if len(parts) == 3 and parts[2] == module:
+                times.append((int(parts[0].split(':')[1]), int(parts[1])))
+                break
+    if not times:
+        return None
+    return int(statistics.median(t[0] for t in times)), int(statistics.median(t[1] for t in times))
+
+
+if __name__ == '__main__':
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as file:
+            baseline = json.load(file)
+    current = {module: import_time(module) for module in MODULES}
+    failed = []
+    for module, times in current.items():
+        if times is None:
+            print(f'{module:>13} | could not be imported here')
+            continue
+        own, micros = times
+        before = baseline.get(module)
+        line = f'{module:>13} | self {own / 1000:6.1f} ms | cumulative {micros / 1000:6.1f} ms'
+        if before:
+            line += f' | baseline {before / 1000:8.1f} ms'
+            if micros > before * TOLERANCE + SLACK_US:
+                failed.append(module)
+                line += ' | SLOWER THAN BASELINE'
+        print(line)
+    if '--update' in sys.argv:
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump({module: times[1] for module, times in current.items() if times is not None}, file, indent=4)
+        print(f'Saved the baseline to {BASELINE_FILE}')
+    elif '--check' in sys.argv and failed:
+        print(f'Import time regressed for: {", ".join(failed)}')
+        sys.exit(1)
@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of building student_course_instance rows with transform.InstanceBatch against the
+row by row dict building it replaced in TalentLMS.move_instances_to_sqlite. Also checks that both
+give the exact same rows.
+
+Run from the project folder: python benchmarks/bench_instance_transform.py [enrollments] [chunk size]
+"""
+import html
+import os
+import random
+import sys
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transform import InstanceBatch
+
+
+def make_enrollments(count):
+    """Students spread over a few dozen courses, the way cohorts share them"""
+    random.seed(0)
+    course_ids_session = {}
+    for course_id in range(1, 41):
+        course_ids_session[str(course_id)] = {
+                                            'code': f'C{course_id:03}',
+                                            'session_date_unix': 1669900000000 + course_id,
+                                            'session_time': '18:00:00 EST',
+                                            'assign_complete_ids': set(random.sample(range(count), count // 3)),
+                                            'name': f'Leadership &amp; Strategy &#8211; Cohort {course_id}',
+                                            }
+    enrollments = []
+    for user_id in range(count):
+        student = {
+                'first_name': f'First{user_id}', 'last_name': f'Last{user_id}', 'email': f'user{user_id}@example.com',
+                'status': 'active', 'custom_field_4': f'cohort-{user_id % 7}',
+                }
+        course_id = str(user_id % 40 + 1)
+        course = {
+                'id': course_id, 'name': course_ids_session[course_id]['name'],
+                'completed_on_timestamp': str(1669900000 + user_id) if user_id % 3 else None,
+                'completion_status': 'Completed' if user_id % 3 else 'In progress', 'completion_percentage': '100',
+                'role': 'learner', 'total_time': '1h 5m', 'total_time_seconds': '3900',
+                'last_accessed_unit_url': f'https://client_name.talentlms.com/unit/{user_id}',
+                }
+        enrollments.append((str(user_id), student, course))
+    return course_ids_session, enrollments
+
+
+def old_rows(course_ids_session, enrollments, chunk_size):
+    """move_instances_to_sqlite before the columnar batches"""
+    rows, chunk = [], []
+    for student_id, instance_json, course in enrollments:
+        if int(student_id) in course_ids_session[course['id']]['assign_complete_ids']:
+            assignment_status = "Yes"
+        else:
+            assignment_status = "No"
+        chunk.append(dict(
+                        talentlms_user_id=student_id,
+                        talentlms_course_id=course['id'],
+                        instance_name=f"{instance_json['last_name']} {instance_json['first_name']}: {html.unescape(course['name'])}",
+                        firstname=instance_json['first_name'],
+                        lastname=instance_json['last_name'],
+                        course_name=course['name'],
+                        code=course_ids_session[course['id']]['code'],
+                        company_cohort_id=instance_json['custom_field_4'],
+                        completed_on=int(course['completed_on_timestamp']) * 1000 \
+                            if course['completed_on_timestamp'] is not None \
+                            else course['completed_on_timestamp'],
+                        completion_status=course['completion_status'],
+                        completion_percent=course['completion_percentage'],
+                        email=instance_json['email'],
+                        live_session_datetime=course_ids_session[course['id']]['session_date_unix'],
+                        role=course['role'],
+                        session_time=course_ids_session[course['id']]['session_time'],
+                        status = instance_json['status'],
+                        total_time=course['total_time'],
+                        total_time_seconds=course['total_time_seconds'],
+                        last_accessed_unit_url=course['last_accessed_unit_url'],
+                        assignment_complete=assignment_status
+                        ))
+        if len(chunk) >= chunk_size:
+            rows += chunk
+            chunk = []
+    return rows + chunk
+
+
+def new_rows(course_ids_session, enrollments, chunk_size):
+    """move_instances_to_sqlite with InstanceBatch"""
+    rows, batch = [], InstanceBatch()
+    for student_id, instance_json, course in enrollments:
+        batch.append(student_id, instance_json, course, course_ids_session[course['id']])
+        if len(batch) >= chunk_size:
+            rows += batch.rows()
+    return rows + batch.rows()
+
+
+def bench(function, *args):
+    start = perf_counter()
+    results = function(*args)
+    return perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    course_ids_session, enrollments = make_enrollments(count)
+    old_time, old_results = bench(old_rows, course_ids_session, enrollments, chunk_size)
+    new_time, new_results = bench(new_rows, course_ids_session, enrollments, chunk_size)
+    mismatches = sum(a != b for a, b in zip(old_results, new_results)) + abs(len(old_results) - len(new_results))
+    print(f'{count} enrollments | row by row {count / old_time:9.0f} rows/s | columnar {count / new_time:9.0f} rows/s '
+          f'| {old_time / new_time:4.1f}x | {mismatches} mismatches')
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,108 @@
+"""
+Benchmark of the history join queries in sql_queries/ against a database holding 1M instance_history rows.
+Runs them on a plain create_engine database without the secondary index of models.py (instance_history's
+ix_instance_history_talentlms_course_id, which the course/instance association query scans), then on the
+same data through models.get_engine with the index and the connection pragmas of set_sqlite_pragma, and
+prints each query's plan and timing.
+
+Run from the project folder: python benchmarks/bench_join_queries.py [instance rows] [new enrollments]
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+
+from models import Base, get_engine
+from queries import QueryRegistry
+
+# Queries that join the staging tables or each other with the history tables
+JOIN_QUERIES = ('assoc_contact_instance', 'assoc_courses_instance', 'instances_create', 'instances_update',
+                'contacts_create', 'contacts_update', 'courses_create', 'courses_update')
+COURSES = 2000
+COURSES_PER_STUDENT = 20
+
+
+def fill(engine, instance_rows, new_rows):
+    """
+    History of instance_rows enrollments, all associated on Hubspot except new_rows of them, and a staging
+    run that brings new_rows new enrollments and new_rows updated ones
+    """
+    students = instance_rows // COURSES_PER_STUDENT
+    enrollments = ((user_id, (user_id * 7 + n) % COURSES) for user_id in range(students) for n in range(COURSES_PER_STUDENT))
+    with engine.begin() as con:
+        con.execute(text('INSERT INTO contact_hs_history (talentlms_user_id, hs_contact_id) VALUES (:u, :h)'),
+                    [{'u': u, 'h': 10**9 + u} for u in range(students)])
+        con.execute(text('INSERT INTO course_hs_history (talentlms_course_id, hs_course_id) VALUES (:c, :h)'),
+                    [{'c': c, 'h': 2 * 10**9 + c} for c in range(COURSES)])
+        instances = [{'u': u, 'c': c, 'h': 3 * 10**9 + i} for i, (u, c) in enumerate(enrollments)]
+        con.execute(text('INSERT INTO instance_history (talentlms_user_id, talentlms_course_id, hs_instance_id) '
+                         'VALUES (:u, :c, :h)'), instances)
+        associated = instances[:-new_rows]
+        con.execute(text("INSERT INTO association_history VALUES (:f, :t, 'student_class_instance_to_contact')"),
+                    [{'f': 10**9 + row['u'], 't': row['h']} for row in associated])
+        con.execute(text("INSERT INTO association_history VALUES (:f, :t, 'course_to_student_class_instance')"),
+                    [{'f': 2 * 10**9 + row['c'], 't': row['h']} for row in associated])
+        staged = instances[-2 * new_rows:]
+        con.execute(text('INSERT INTO contacts (talentlms_user_id, firstname) VALUES (:u, :u)'),
+                    [{'u': u} for u in {row['u'] for row in staged}])
+        con.execute(text('INSERT INTO courses (talentlms_course_id, course_name) VALUES (:c, :c)'),
+                    [{'c': c} for c in {row['c'] for row in staged}])
+        con.execute(text('INSERT INTO student_course_instance (talentlms_user_id, talentlms_course_id) VALUES (:u, :c)'),
+                    [{'u': row['u'], 'c': row['c']} for row in staged] +
+                    [{'u': students + n, 'c': n % COURSES} for n in range(new_rows)])
+
+
+def run_queries(engine, repeats):
+    """Best time and row count of each join query"""
+    registry = QueryRegistry(engine)
+    timings = {}
+    with engine.connect() as con:
+        for name in JOIN_QUERIES:
+            best = None
+            for _ in range(repeats):
+                start = perf_counter()
+                count = len(con.execute(registry[name]).fetchall())
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = (best, count, registry.plan(name))
+    return timings
+
+
+if __name__ == '__main__':
+    instance_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    new_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    with tempfile.TemporaryDirectory() as folder:
+        plain_path, tuned_path = os.path.join(folder, 'plain.db'), os.path.join(folder, 'tuned.db')
+        start = perf_counter()
+        plain = create_engine(f'sqlite:///{plain_path}')
+        Base.metadata.create_all(plain)
+        fill(plain, instance_rows, new_rows)
+        plain.dispose()
+        print(f'Built {instance_rows} instance_history rows in {perf_counter() - start:.1f}s')
+        shutil.copy(plain_path, tuned_path)
+        # The plain database goes without the secondary index, the primary keys are left as they are
+        plain = create_engine(f'sqlite:///{plain_path}')
+        with plain.begin() as con:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    con.execute(text(f'DROP INDEX {index.name}'))
+        tuned = get_engine(f'sqlite:///{tuned_path}')
+        results = {'plain': run_queries(plain, 3), 'tuned': run_queries(tuned, 3)}
+        plain.dispose()
+        tuned.dispose()
+    for name in JOIN_QUERIES:
+        (plain_time, plain_rows, plain_plan), (tuned_time, tuned_rows, tuned_plan) = results['plain'][name], results['tuned'][name]
+        print(f'{name:>23} | {tuned_rows:6} rows | plain {plain_time:7.3f}s | tuned + index {tuned_time:7.3f}s '
+              f'| {plain_time / tuned_time:5.1f}x')
+        if plain_plan != tuned_plan:
+            print('    plain plan: ' + plain_plan.replace('\n', ' / '))
+            print('    tuned plan: ' + tuned_plan.replace('\n', ' / '))
+        if plain_rows != tuned_rows:
+            print(f'    row counts differ: {plain_rows} vs {tuned_rows}')
+            sys.exit(1)
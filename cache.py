@@ -0,0 +1,124 @@
+"""Module to keep TalentLMS detail payloads in SQLite so records that have not changed are not requested again"""
+import json
+import logging
+import os
+
+from time import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+# Most entries a cache table is allowed to hold, the least recently used ones are evicted first
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 20000))
+# Seconds after which an entry is requested again even if its version has not changed, 3 hours or 12 runs of
+# the */15 cron job, so an unchanged course is requested once every 12 runs instead of every run. A course's
+# enrolled users come with its detail and a new enrollment does not move last_update_on, but the student's
+# own record lists all of their courses, so only the first enrollment of a student that is in no other course
+# of the run can wait up to this long to reach Hubspot (a webhook enrollment event syncs it right away)
+CACHE_MAX_AGE = int(os.getenv('CACHE_MAX_AGE', 3 * 60 * 60))
+
+
+class DetailCache:
+    """
+    Serves TalentLMS detail payloads from one of the cache tables in models.py. An entry is only used
+    when it was stored for the same version (ex: a course's last_update_on) and is younger than max_age.
+    A hit leaves fetched_at alone, so max_age bounds how stale a served payload can be.
+    """
+
+    def __init__(self, model, id_column, version_column, session, max_entries=CACHE_MAX_ENTRIES, max_age=CACHE_MAX_AGE):
+        """
+        Args:
+            model (class): cache table to use, ex: CourseDetailCache
+            id_column (str): name of the column holding the TalentLMS id
+            version_column (str): name of the column the version of the payload is compared against
+            session (class): scoped_session object, and it represents a registry of Session
+                objects: which manages persistence operations for ORM-mapped objects.
+            max_entries (int): most entries to keep in the table
+            max_age (int): seconds an entry can be used for before it is requested again
+        """
+        self.model = model
+        self.id_column = id_column
+        self.version_column = version_column
+        self.session = session
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, talentlms_id, version):
+        """
+        Gives back the cached payload of a record if it is still valid
+
+        Args:
+            talentlms_id (str): TalentLMS id of the record
+            version (str): current version of the record to compare against the cached one
+
+        Returns:
+            (dict): the cached payload, or None if the record needs to be requested from TalentLMS
+        """
+        now = int(time())
+        try:
+            entry = self.session.get(self.model, int(talentlms_id))
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            entry = None
+        if entry is None or getattr(entry, self.version_column) != str(version) or now - entry.fetched_at > self.max_age:
+            self.misses += 1
+            return None
+        entry.last_accessed = now
+        self.hits += 1
+        return json.loads(entry.payload)
+
+    def put(self, talentlms_id, version, payload):
+        """
+        Stores the payload of a record that was just requested from TalentLMS
+
+        Args:
+            talentlms_id (str): TalentLMS id of the record
+            version (str): version of the record the payload belongs to
+            payload (dict): the part of the TalentLMS response to keep
+        """
+        now = int(time())
+        entry = {
+                self.id_column: int(talentlms_id),
+                self.version_column: str(version),
+                'payload': json.dumps(payload),
+                'fetched_at': now,
+                'last_accessed': now
+                }
+        self.session.merge(self.model(**entry))
+
+    def save(self, live_ids=None):
+        """
+        Evicts entries that are too old, that belong to records no longer in TalentLMS or that go over
+        max_entries, then commits the cache
+
+        Args:
+            live_ids (iterable): TalentLMS ids that still exist, entries of any other id are removed. 
+                Nothing is removed for an empty list, it is more likely a bad response than every
+                record deleted, and those entries expire after max_age anyway
+        """
+        id_attr = getattr(self.model, self.id_column)
+        try:
+            self.session.query(self.model).filter(self.model.fetched_at < int(time()) - self.max_age)\
+                .delete(synchronize_session=False)
+            if live_ids:
+                gone = list({i for (i,) in self.session.query(id_attr)} - {int(i) for i in live_ids})
+                # Delete in chunks to stay under SQLite's limit of variables per statement
+                for start in range(0, len(gone), 500):
+                    self.session.query(self.model).filter(id_attr.in_(gone[start:start + 500]))\
+                        .delete(synchronize_session=False)
+            # Keep only the max_entries most recently used entries
+            keep = self.session.query(id_attr).order_by(self.model.last_accessed.desc()).limit(self.max_entries)
+            self.session.query(self.model).filter(id_attr.notin_(keep.scalar_subquery()))\
+                .delete(synchronize_session=False)
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            pass
+        logger.info(f'...{self.model.__tablename__}: {self.hits} hits, {self.misses} misses')
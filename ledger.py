@@ -0,0 +1,218 @@
+"""Module to record the progress of each run, so a run that stopped halfway is resumed instead of redone"""
+
+from sqlalchemy import and_, func
+from sqlalchemy.exc import SQLAlchemyError
+from functools import wraps
+from threading import Lock
+
+import logging
+import os
+import time
+
+from models import RunLedger
+
+# Stage name of the row that tracks the run itself
+RUN = 'run'
+# Finished runs kept in the run_ledger table, older ones are deleted when a run finishes
+LEDGER_KEEP_RUNS = int(os.getenv('LEDGER_KEEP_RUNS', 30))
+# An unfinished run is resumed at most LEDGER_MAX_RESUMES times and for LEDGER_MAX_AGE seconds after it started,
+# past that it is abandoned and a new run starts from scratch, so a stage that fails every time can not hold
+# back the runs forever
+LEDGER_MAX_RESUMES = int(os.getenv('LEDGER_MAX_RESUMES', 3))
+LEDGER_MAX_AGE = int(os.getenv('LEDGER_MAX_AGE', 6 * 60 * 60))
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+
+class Ledger:
+    """
+    Keeps the run_ledger table of a run: when the run and each of its stages started and finished and how many
+    Hubspot batches each stage had acknowledged. A run that crashed or had a stage fail stays unfinished, and
+    the next run picks it up under the same start time, skipping the stages that finished. Inside a stage that
+    did not finish, the batches Hubspot already acknowledged are left out by the queries themselves: created
+    records are in the history tables, accepted updates have their fingerprints saved and confirmed associations
+    are in association_history, so the stage carries on from the first batch that was not confirmed. A run
+    still unfinished after LEDGER_MAX_RESUMES resumes or LEDGER_MAX_AGE seconds is marked abandoned, and the
+    new run takes over its start time so the changes since then are still brought in. A ledger that was not
+    opened, as in the targeted runs of the webhook receiver, records nothing.
+    """
+
+    def __init__(self, session):
+        """
+        Args:
+            session (class):  scoped_session object, and it represents a registry of Session objects:
+                which manages persistence operations for ORM-mapped objects.
+        """
+        self.session = session
+        self.run_id = None
+        self.since = None # start time the run brings TalentLMS changes in from
+        self.resumed = False # True when the run picked up an unfinished one
+        self.done = set() # stages of the run that finished
+        self.batches = {} # {stage: Hubspot batches acknowledged}
+        self.lock = Lock() # the loaders of the streaming pipeline acknowledge batches of the same stage
+
+    def open(self, isodatetime, max_resumes=LEDGER_MAX_RESUMES, max_age=LEDGER_MAX_AGE):
+        """
+        Starts a new run, or resumes the most recent run that did not finish unless it has been resumed
+        max_resumes times already or started more than max_age seconds ago, then it is abandoned
+
+        Args:
+            isodatetime (str): start time of the new run
+            max_resumes (int): most times a run is resumed
+            max_age (int): seconds after its start a run can still be resumed
+
+        Returns:
+            (str): start time the run brings TalentLMS changes in from, the one of the resumed or 
+                abandoned run if there was one
+        """
+        since = isodatetime
+        try:
+            unfinished = self.unfinished()
+            if unfinished is not None:
+                run = self.session.query(RunLedger).filter(and_(RunLedger.run_id == unfinished, RunLedger.stage == RUN)).one()
+                since = run.since or run.run_id
+                resumes = run.resumes or 0
+                age = int(time.time()) - (run.started_at or 0)
+                if resumes >= max_resumes or age > max_age:
+                    run.status = 'abandoned'
+                    run.finished_at = int(time.time())
+                    self.session.commit()
+                    logger.warning(f'Abandoning the unfinished run of {unfinished} after {resumes} resumes and {age}s, '
+                                   f'starting a new run that brings in the changes since {since}')
+                else:
+                    self.run_id = unfinished
+                    self.since = since
+                    self.resumed = True
+                    run.resumes = resumes + 1
+                    self.session.commit()
+                    for row in self.session.query(RunLedger).filter(and_(RunLedger.run_id == self.run_id, RunLedger.stage != RUN)):
+                        self.batches[row.stage] = row.batches or 0
+                        if row.status == 'done':
+                            self.done.add(row.stage)
+                    logger.info(f'Resuming the unfinished run of {self.run_id} ({resumes + 1} of {max_resumes} resumes), finished stages: '
+                                f'{", ".join(sorted(self.done)) or "none"}, acknowledged batches: {sum(self.batches.values())}')
+                    return self.since
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            pass
+        self.run_id = isodatetime
+        self.since = since
+        self._write(RUN, 'running')
+        return self.since
+
+    def unfinished(self):
+        """
+        Returns:
+            (str): start time of the most recent run that did not finish, None if they all did
+        """
+        unfinished = self.session.query(RunLedger.run_id).filter(and_(RunLedger.stage == RUN, RunLedger.status == 'running')) \
+            .order_by(RunLedger.started_at.desc()).first()
+        return unfinished[0] if unfinished is not None else None
+
+    def is_done(self, stage):
+        """True if the stage finished in this run, or in the run it resumes"""
+        return stage in self.done
+
+    def redo(self, stage):
+        """Runs a stage again even though it finished, ex: when the data it left behind is gone"""
+        self.done.discard(stage)
+        self.batches.pop(stage, None)
+
+    def start(self, stage):
+        """Records that a stage started, keeping the batches it acknowledged before a restart"""
+        self._write(stage, 'running', batches=self.batches.get(stage, 0))
+
+    def ack(self, stage):
+        """Records that Hubspot acknowledged one more batch of the stage"""
+        if self.run_id is None:
+            return
+        with self.lock:
+            self.batches[stage] = self.batches.get(stage, 0) + 1
+            batches = self.batches[stage]
+        try:
+            # Loaders of the same stage can commit their counts out of order, the row keeps the highest
+            self.session.query(RunLedger).filter(and_(RunLedger.run_id == self.run_id, RunLedger.stage == stage)) \
+                .update({'batches': func.max(RunLedger.batches, batches)}, synchronize_session=False)
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            pass
+
+    def finish(self, stage):
+        """Records that a stage finished, a resumed run skips it"""
+        self.done.add(stage)
+        self._write(stage, 'done', batches=self.batches.get(stage, 0), finished=True)
+
+    def stage(self, name, function):
+        """
+        Wraps the function of a stage to skip it if it finished already, and record when it starts and finishes
+
+        Args:
+            name (str): name of the stage
+            function (function): function running the stage
+
+        Returns:
+            (function): the wrapped function
+        """
+        @wraps(function)
+        def run_stage():
+            if self.is_done(name):
+                logger.info(f'Stage {name} finished in the run of {self.run_id}, skipping it')
+                return
+            self.start(name)
+            function()
+            self.finish(name)
+        return run_stage
+
+    def close(self):
+        """Marks the run as finished and deletes the ledger of older runs beyond LEDGER_KEEP_RUNS"""
+        if self.run_id is None:
+            return
+        self._write(RUN, 'done', finished=True)
+        try:
+            old_runs = self.session.query(RunLedger.run_id).filter(RunLedger.stage == RUN) \
+                .order_by(RunLedger.started_at.desc()).offset(LEDGER_KEEP_RUNS).scalar_subquery()
+            self.session.query(RunLedger).filter(RunLedger.run_id.in_(old_runs)).delete(synchronize_session=False)
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            pass
+
+    def _write(self, stage, status, batches=0, finished=False):
+        """Inserts or replaces the row of a stage, keeping the time it started and the resumes of the run"""
+        if self.run_id is None:
+            return
+        now = int(time.time())
+        try:
+            row = self.session.query(RunLedger).filter(and_(RunLedger.run_id == self.run_id, RunLedger.stage == stage)).first()
+            started_at = row.started_at if row is not None and status == 'done' else now
+            self.session.execute(RunLedger.__table__.insert().prefix_with('OR REPLACE'), {
+                    'run_id': self.run_id,
+                    'stage': stage,
+                    'status': status,
+                    'batches': batches,
+                    'started_at': started_at,
+                    'finished_at': now if finished else None,
+                    'since': self.since if stage == RUN else None,
+                    'resumes': (row.resumes if row is not None else 0) if stage == RUN else None
+                    })
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            pass
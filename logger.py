@@ -88,6 +88,32 @@ def get_console_handler():
     console_handler.setFormatter(MyFormatter())
     return console_handler
 
+class LazySysLogHandler(logging.Handler):
+    """
+    Handler that only creates its SysLogHandler, which resolves the papertrail address and opens a 
+    socket to it, when the first record is logged instead of when the logger is set up
+    """
+
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+        self.handler = None
+
+    def emit(self, record):
+        try:
+            if self.handler is None:
+                self.handler = SysLogHandler(address=self.address)
+            # Format here with this handler's formatter, the SysLogHandler only sends the message
+            self.handler.setFormatter(self.formatter)
+            self.handler.emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        super().close()
+
 def get_syslog_handler():
     """
     Sets the lowest logging level of the file_handler to DEBUG and format the log message to 
@@ -97,7 +123,7 @@ def get_syslog_handler():
         external_handler (class): sending logging messages to papertrail cloud hosting management
         system
     """
-    external_handler = SysLogHandler(address=('logs6.papertrailapp.com', 11789))
+    external_handler = LazySysLogHandler(('logs6.papertrailapp.com', 11789))
     external_handler.setLevel(logging.DEBUG)
     external_handler.setFormatter(MyFormatter())
     return external_handler
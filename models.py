@@ -2,12 +2,14 @@
 Module to create a SQLite schema using SQLAlchemy to hold in student and course information.
 """
 
-from sqlalchemy import create_engine, MetaData, ForeignKey, Column, Date, Integer, Text, PrimaryKeyConstraint, CheckConstraint 
+from sqlalchemy import create_engine, event, text, MetaData, ForeignKey, Column, Date, Index, Integer, Text, PrimaryKeyConstraint, \
+    CheckConstraint 
 from sqlalchemy.orm import relationship, backref, sessionmaker, deferred
 from sqlalchemy.ext.declarative import declarative_base
 import json
 import time
 import os
+import sqlite3
 
  
 # If echo is True, the Engine will log all statements as well as a repr() of their parameter lists to the default 
@@ -28,7 +30,76 @@ db_dir = os.path.join(package_dir, 'company_name.db')
 SQLITE_DB = ''.join(['sqlite:///', db_dir])
 
 
-engine = create_engine(SQLITE_DB) 
+
+# Page cache of each connection in KiB and the most bytes of the database file read through mmap
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 64000))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 268435456))
+
+# Set IN_MEMORY_STAGING=1 to keep the tables that only hold one run's data (contacts, courses and
+# student_course_instance) in an in-memory database attached to every connection as "staging", instead
+# of company_name.db. The history and time_tracking tables stay on disk and the .sql queries join across both.
+IN_MEMORY_STAGING = bool(int(os.getenv('IN_MEMORY_STAGING', 0)))
+# Shared cache lets every connection of the process attach the same in-memory database
+STAGING_DB = 'file:tlms_staging?mode=memory&cache=shared'
+STAGING_SCHEMA = 'staging' if IN_MEMORY_STAGING else None
+STAGING_PREFIX = f'{STAGING_SCHEMA}.' if STAGING_SCHEMA else ''
+STAGING_TABLES = ('contacts', 'courses', 'student_course_instance')
+# Connection holding the in-memory database open for the life of the process, it is dropped by SQLite
+# as soon as its last connection closes, even between two runs
+_staging_keeper = None
+# Databases init_db has already brought up to date in this process
+_initialized = set()
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Tunes every new connection to the database:
+        - write-ahead logging, so the payload queries can keep streaming rows while the Hubspot ids of 
+          the records already sent are written to the history tables
+        - synchronous=NORMAL, which is safe with WAL and only syncs the log at checkpoints
+        - a larger page cache and memory mapped reads for the joins over the history tables
+        - temporary tables and indexes (sorts, automatic indexes) kept in memory
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # A negative cache_size is in KiB instead of pages
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def get_engine(url=SQLITE_DB, **kwargs):
+    """
+    Creates an engine whose connections are all tuned by set_sqlite_pragma
+
+    Args:
+        url (str): database URL, the integration's database by default
+        kwargs: passed on to create_engine
+
+    Returns:
+        (class): Engine object to provide a source of database connectivity and behavior
+    """
+    global _staging_keeper
+    if IN_MEMORY_STAGING:
+        # URI filenames have to be turned on for ATTACH to understand STAGING_DB
+        kwargs['connect_args'] = dict(kwargs.get('connect_args', {}), uri=True)
+        if _staging_keeper is None:
+            _staging_keeper = sqlite3.connect(STAGING_DB, uri=True, check_same_thread=False)
+    engine = create_engine(url, **kwargs)
+    event.listen(engine, 'connect', set_sqlite_pragma)
+    if IN_MEMORY_STAGING:
+        event.listen(engine, 'connect', attach_staging)
+    return engine
+
+
+def attach_staging(dbapi_connection, connection_record):
+    """Attaches the in-memory staging database to a new connection"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"ATTACH DATABASE '{STAGING_DB}' AS {STAGING_SCHEMA}")
+    cursor.close()
+
 
 # imports the declarative_base object, which connects the database engine to the SQLAlchemy functionality of 
 # metadata = MetaData()
@@ -40,6 +111,7 @@ class Contacts(Base):
     """Model to represent the students and all data associated with them"""
 
     __tablename__ = "contacts"
+    __table_args__ = {'schema': STAGING_SCHEMA}
 
     talentlms_user_id  = Column(Integer, primary_key=True, sqlite_on_conflict_primary_key='REPLACE')
     firstname = Column(Text)
@@ -58,6 +130,7 @@ class Courses(Base):
     """Model to represent the courses and all data associated with them"""
 
     __tablename__ = "courses"
+    __table_args__ = {'schema': STAGING_SCHEMA}
 
     talentlms_course_id = Column(Integer, primary_key=True, sqlite_on_conflict_primary_key='REPLACE')
     course_name = Column(Text)
@@ -84,8 +157,8 @@ class StudentCourseInstance(Base):
 
     __tablename__ = "student_course_instance"
 
-    talentlms_user_id = Column(Integer, ForeignKey('contacts.talentlms_user_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE') 
-    talentlms_course_id = Column(Integer, ForeignKey('courses.talentlms_course_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE')
+    talentlms_user_id = Column(Integer, ForeignKey(f'{STAGING_PREFIX}contacts.talentlms_user_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE') 
+    talentlms_course_id = Column(Integer, ForeignKey(f'{STAGING_PREFIX}courses.talentlms_course_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE')
     instance_name = Column(Text)
     firstname = Column(Text)
     lastname = Column(Text)
@@ -105,7 +178,8 @@ class StudentCourseInstance(Base):
     last_accessed_unit_url = Column(Text)
     linkedin_badge = Column(Text)
     assignment_complete = Column(Text)
-    __table_args__ = (PrimaryKeyConstraint(talentlms_user_id, talentlms_course_id, sqlite_on_conflict='REPLACE', name='user_course_compound_id'),)
+    __table_args__ = (PrimaryKeyConstraint(talentlms_user_id, talentlms_course_id, sqlite_on_conflict='REPLACE', name='user_course_compound_id'),
+                      {'schema': STAGING_SCHEMA})
     # Relationships
     # student_course_instance_histories = relationship("StudentCourseInstanceHistory", backref=backref("student_course_instance"))
 
@@ -115,8 +189,10 @@ class ContactHSHistory(Base):
     
     __tablename__ = "contact_hs_history"
 
-    talentlms_user_id = Column(Integer, ForeignKey('contacts.talentlms_user_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE') 
+    talentlms_user_id = Column(Integer, ForeignKey(f'{STAGING_PREFIX}contacts.talentlms_user_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE') 
     hs_contact_id = Column(Integer, unique=True)
+    # Hash of the properties last sent to Hubspot, used to skip updates that would not change anything
+    property_hash = Column(Text)
 
 
 class CourseHSHistory(Base):
@@ -124,8 +200,10 @@ class CourseHSHistory(Base):
     
     __tablename__ = "course_hs_history"
 
-    talentlms_course_id = Column(Integer, ForeignKey('courses.talentlms_course_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE') 
+    talentlms_course_id = Column(Integer, ForeignKey(f'{STAGING_PREFIX}courses.talentlms_course_id'), primary_key=True, sqlite_on_conflict_primary_key='REPLACE') 
     hs_course_id = Column(Integer, unique=True)
+    # Hash of the properties last sent to Hubspot, used to skip updates that would not change anything
+    property_hash = Column(Text)
 
 
 class InstanceHistory(Base):
@@ -139,7 +217,87 @@ class InstanceHistory(Base):
     talentlms_user_id = Column(Integer, ForeignKey('instance_history.talentlms_user_id')) 
     talentlms_course_id = Column(Integer, ForeignKey('instance_history.talentlms_course_id')) 
     hs_instance_id = Column(Integer, unique=True)
-    __table_args__ = (PrimaryKeyConstraint(talentlms_user_id, talentlms_course_id, sqlite_on_conflict='REPLACE', name='user_course_compound_id'),)
+    # Hash of the properties last sent to Hubspot, used to skip updates that would not change anything
+    property_hash = Column(Text)
+    __table_args__ = (
+                    PrimaryKeyConstraint(talentlms_user_id, talentlms_course_id, sqlite_on_conflict='REPLACE', name='user_course_compound_id'),
+                    # The compound primary key only serves lookups by user, the course/instance association query
+                    # joins on the course. hs_instance_id makes it a covering index for that query.
+                    Index('ix_instance_history_talentlms_course_id', talentlms_course_id, hs_instance_id),
+                    )
+
+
+class CourseDetailCache(Base):
+    """
+    Last course payload (units and enrolled users) fetched from TalentLMS, kept to skip the request
+    while the course's last_update_on has not moved
+    """
+
+    __tablename__ = "course_detail_cache"
+
+    talentlms_course_id = Column(Integer, primary_key=True, sqlite_on_conflict_primary_key='REPLACE')
+    last_update_on = Column(Text)
+    payload = Column(Text)
+    fetched_at = Column(Integer)
+    last_accessed = Column(Integer)
+
+
+class AssignmentCompletion(Base):
+    """
+    Index of the students that have answered an Assignment unit, built up run after run from the 
+    TalentLMS timeline. A student is added once per unit.
+    """
+
+    __tablename__ = "assignment_completion"
+
+    unit_id = Column(Integer)
+    user_id = Column(Integer)
+    __table_args__ = (PrimaryKeyConstraint(unit_id, user_id, sqlite_on_conflict='IGNORE', name='unit_user_compound_id'),)
+
+
+class CourseTemplate(Base):
+    """Local copy of the options of the course_template_name property on Hubspot"""
+
+    __tablename__ = "course_template"
+
+    code = Column(Text, primary_key=True, sqlite_on_conflict_primary_key='REPLACE')
+    label = Column(Text)
+    refreshed_at = Column(Integer)
+
+
+class AssociationHistory(Base):
+    """
+    Associations between Hubspot records that have been created on Hubspot, kept so that each pair is 
+    only sent once
+    """
+
+    __tablename__ = "association_history"
+
+    from_id = Column(Integer)
+    to_id = Column(Integer)
+    assoc_type = Column(Text)
+    __table_args__ = (PrimaryKeyConstraint(from_id, to_id, assoc_type, sqlite_on_conflict='IGNORE', name='from_to_type_compound_id'),)
+
+
+class RunLedger(Base):
+    """
+    Progress of the runs: one row per stage, plus a row for the run itself under the stage name 'run', 
+    so a run that did not finish is picked up by the next one from the stages that did not finish
+    """
+
+    __tablename__ = "run_ledger"
+
+    run_id = Column(Text) # start time (isodatetime) of the run
+    stage = Column(Text)
+    status = Column(Text) # running, done, or abandoned for a run resumed too many times
+    batches = Column(Integer) # Hubspot batches of the stage acknowledged so far
+    started_at = Column(Integer)
+    finished_at = Column(Integer)
+    # Run row only: start time (isodatetime) the run brings TalentLMS changes in from, the one of the run it
+    # took over from if it replaced an abandoned run, and how many times it was resumed
+    since = Column(Text)
+    resumes = Column(Integer)
+    __table_args__ = (PrimaryKeyConstraint(run_id, stage, sqlite_on_conflict='REPLACE', name='run_stage_compound_id'),)
 
 
 class TimeTracking(Base):
@@ -149,7 +307,65 @@ class TimeTracking(Base):
 
     last_modified_time = Column(Integer, primary_key=True)
 
-# Add all the Tables/Models to the database
-Base.metadata.create_all(engine)
+def add_missing_columns(engine):
+    """
+    Adds the columns declared on the models that an existing database was created without, since
+    create_all only creates the tables that are missing
+
+    Args:
+        engine (class): Engine object to provide a source of database connectivity and behavior
+    """
+    with engine.begin() as con:
+        for table in Base.metadata.sorted_tables:
+            schema = table.schema or 'main'
+            existing = {row[1] for row in con.execute(text(f'PRAGMA {schema}.table_info({table.name})'))}
+            for column in table.columns:
+                if column.name not in existing:
+                    con.execute(text(f'ALTER TABLE {schema}.{table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'))
+
+def add_missing_indexes(engine):
+    """
+    Creates the indexes declared on the models that an existing database was created without, since
+    create_all only creates the indexes of the tables it creates
+
+    Args:
+        engine (class): Engine object to provide a source of database connectivity and behavior
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def drop_disk_staging_tables(engine):
+    """
+    Drops the copies of the staging tables left in company_name.db from runs without IN_MEMORY_STAGING,
+    since SQLite would pick them over the attached ones for the table names in the .sql queries
+
+    Args:
+        engine (class): Engine object to provide a source of database connectivity and behavior
+    """
+    with engine.begin() as con:
+        for table in STAGING_TABLES:
+            con.execute(text(f'DROP TABLE IF EXISTS main.{table}'))
+
+def init_db(engine=None):
+    """
+    Creates the tables and indexes the database is missing, once per database for the life of the process.
+    Nothing is created when the module is imported, the program calls this when it starts.
+
+    Args:
+        engine (class): Engine object of the database, a new engine to the integration's database if None
+    """
+    own_engine = engine is None
+    engine = engine or get_engine()
+    url = str(engine.url)
+    if url not in _initialized:
+        # Add all the Tables/Models to the database
+        if IN_MEMORY_STAGING:
+            drop_disk_staging_tables(engine)
+        Base.metadata.create_all(engine)
+        add_missing_columns(engine)
+        add_missing_indexes(engine)
+        _initialized.add(url)
+    if own_engine:
+        engine.dispose()
 
-engine.dispose()
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""Module to load records to Hubspot while they are still being extracted from TalentLMS"""
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event
+
+import logging
+import os
+
+from sqlalchemy import bindparam, text
+
+from hubapi import CreateRecordsHandler, UpdateRecordsHandler
+from transform import iter_create_obj_payload, iter_update_obj_payload, save_fingerprints, HUBSPOT_BATCH_SIZE
+
+# Committed chunks waiting for each loader, the extraction waits once a loader is this many chunks behind
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 4))
+
+# Staging table: (Hubspot object, create query, update query, columns identifying a record)
+STREAMS = {
+    'contacts': ('contacts', 'contacts_create', 'contacts_update', ('talentlms_user_id',)),
+    'courses': ('2-8311841', 'courses_create', 'courses_update', ('talentlms_course_id',)),
+    'student_course_instance': ('2-8311962', 'instances_create', 'instances_update', ('talentlms_user_id', 'talentlms_course_id'))
+    }
+
+# Most records a restricted query is limited to. An instance takes 3 variables (its two key columns and at most
+# one course id), so 300 of them stay under the 999 variables per statement of SQLite builds before 3.32
+RESTRICT_MAX_ROWS = 300
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+
+def restrict_query(query, columns, keys):
+    """
+    Limits a query of the QueryRegistry to the records of a chunk, the first column goes through the
+    primary key of the staging table so only the chunk's rows are read
+
+    Args:
+        query (class): TextClause of a create or update query
+        columns (tuple): columns of the query identifying a record
+        keys (list): tuples of the column values of the chunk's records
+
+    Returns:
+        (class): TextClause of the query for just those records
+    """
+    sql = query.text.strip().rstrip(';')
+    conditions = [f'chunk.{columns[0]} IN :firsts']
+    params = {}
+    if len(columns) > 1:
+        # Row values to match the records exactly, the IN on the first column alone can bring in other records
+        values = ', '.join('(' + ', '.join(f':k{i}_{j}' for j in range(len(columns))) + ')' for i in range(len(keys)))
+        conditions.append(f'({", ".join(f"chunk.{column}" for column in columns)}) IN (VALUES {values})')
+        params = {f'k{i}_{j}': value for i, key in enumerate(keys) for j, value in enumerate(key)}
+    # The query goes on its own lines so a trailing -- comment can not swallow the parenthesis
+    statement = text(f'SELECT * FROM (\n{sql}\n) AS chunk WHERE {" AND ".join(conditions)}')
+    return statement.bindparams(bindparam('firsts', sorted({key[0] for key in keys}), expanding=True), **params)
+
+def restrict_queries(query, columns, keys, max_rows=RESTRICT_MAX_ROWS):
+    """
+    Splits the records of a chunk into groups of max_rows and limits the query to each group in turn,
+    so no statement binds more variables than SQLite allows
+
+    Args:
+        query (class): TextClause of a create or update query
+        columns (tuple): columns of the query identifying a record
+        keys (list): tuples of the column values of the chunk's records
+        max_rows (int): most records per statement
+
+    Yields:
+        (class): TextClause of the query for the records of one group
+    """
+    for start in range(0, len(keys), max_rows):
+        yield restrict_query(query, columns, keys[start:start + max_rows])
+
+
+class StreamingPipeline:
+    """
+    Runs the TalentLMS extraction of a CurrUpdate and, at the same time, one loader thread per staging table
+    that sends the records of every committed chunk to Hubspot as soon as they fill a batch. The chunks reach
+    the loaders through bounded queues, so the extraction waits when Hubspot falls behind. Each loader runs
+    the usual create and update queries limited to the chunk's records, so the records sent, the fingerprints
+    and the Hubspot ids saved are the same as running the stages one after the other. Contacts and courses
+    are staged and sent first, the instances follow once the students have been fetched.
+    """
+
+    def __init__(self, update, stage='stream', queue_size=STREAM_QUEUE_SIZE, batch_size=HUBSPOT_BATCH_SIZE):
+        """
+        Args:
+            update (class): the CurrUpdate whose engine, session, queries and ledger are used
+            stage (str): name of the stage in the run ledger, its batches are acknowledged under it
+            queue_size (int): most committed chunks waiting for each loader
+            batch_size (int): most records per Hubspot request
+        """
+        self.update = update
+        self.stage = stage
+        self.batch_size = batch_size
+        self.queues = {table: Queue(maxsize=queue_size) for table in STREAMS}
+        self.aborted = Event() # set when the extraction or a loader fails, the loaders stop sending
+
+    def notify(self, model, rows):
+        """
+        on_chunk callback of TalentLMS: hands the keys of a committed chunk to the loader of its table,
+        waiting while the loader's queue is full
+
+        Args:
+            model (class): staging table the chunk was committed to
+            rows (list): dicts of {column name: value} of the chunk
+        """
+        table = model.__tablename__
+        if table not in self.queues or not rows:
+            return
+        columns = STREAMS[table][3]
+        self.queues[table].put([tuple(row[column] for column in columns) for row in rows])
+
+    def run(self):
+        """
+        Extracts from TalentLMS in the calling thread while the loaders send the records
+
+        Raises:
+            Exception: the exception of the extraction or of the first loader that failed
+        """
+        with ThreadPoolExecutor(max_workers=len(STREAMS), thread_name_prefix='loader') as executor:
+            loaders = [executor.submit(self._load, table) for table in STREAMS]
+            try:
+                self.update._migrate_from_talentlms(on_chunk=self.notify)
+            except Exception:
+                self.aborted.set()
+                raise
+            finally:
+                # Tell every loader the extraction is over
+                for queue in self.queues.values():
+                    queue.put(None)
+            for loader in loaders:
+                loader.result()
+
+    def _load(self, table):
+        """
+        Sends the records of the chunks of a staging table in full batches, then what is left once the
+        extraction is over
+
+        Args:
+            table (str): name of the staging table
+        """
+        obj, create_query, update_query, columns = STREAMS[table]
+        update = self.update
+        create_records = CreateRecordsHandler(obj, update.session)
+        update_records = UpdateRecordsHandler(obj)
+        creates, updates = [], []
+        keys = []
+        try:
+            while True:
+                keys = self.queues[table].get()
+                if keys is None:
+                    break
+                if self.aborted.is_set():
+                    # Keep taking chunks so the extraction never waits on a full queue
+                    continue
+                for statement in restrict_queries(update.queries[create_query], columns, keys):
+                    for payload in iter_create_obj_payload(statement, update.engine):
+                        creates += payload['inputs']
+                creates = self._send(create_records, obj, creates)
+                for statement in restrict_queries(update.queries[update_query], columns, keys):
+                    for payload in iter_update_obj_payload(statement, obj, update.engine, suppressed=update.suppressed_updates):
+                        updates += payload['inputs']
+                updates = self._send(update_records, obj, updates)
+            if not self.aborted.is_set():
+                self._send(create_records, obj, creates, last=True)
+                self._send(update_records, obj, updates, last=True)
+        except Exception:
+            self.aborted.set()
+            # Keep taking chunks until the extraction is over so it never waits on a full queue
+            while keys is not None:
+                keys = self.queues[table].get()
+            raise
+        finally:
+            update.session.remove()
+        logger.info(f'...Finished streaming {table} to Hubspot')
+
+    def _send(self, handler, obj, inputs, last=False):
+        """
+        Dispatches the full batches of inputs, and the last partial one if last
+
+        Returns:
+            (list): the inputs left to send
+        """
+        while len(inputs) >= self.batch_size or (last and inputs):
+            payload = {'inputs': inputs[:self.batch_size]}
+            inputs = inputs[self.batch_size:]
+            res = handler.dispatch(payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints(obj, payload, self.update.session, res):
+                self.update.ledger.ack(self.stage)
+        return inputs
@@ -0,0 +1,123 @@
+"""Module to load, compile and check the .sql queries in sql_queries/ once at startup"""
+
+from glob import glob
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import logging
+import os
+import re
+
+# Folder of the .sql queries, found next to this module wherever the package is installed
+QUERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql_queries')
+# Tables that grow every run, a full scan of one of them is worth a warning
+HISTORY_TABLES = ('contact_hs_history', 'course_hs_history', 'instance_history', 'association_history')
+# Queries that go through all of instance_history on purpose, to find every pair not yet associated
+# on Hubspot, including the ones refused on an earlier run whose instance is not staged again
+FULL_HISTORY_QUERIES = ('assoc_contact_instance', 'assoc_courses_instance')
+# Tables named after FROM or JOIN, with the alias they are given if any
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+# Words that can follow a table name without being its alias
+SQL_KEYWORDS = {'ON', 'WHERE', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'OUTER', 'USING', 'GROUP', 'ORDER', 'LIMIT', 'UNION', 'NATURAL'}
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+
+class QueryRegistry:
+    """
+    Compiled statements of every .sql file in sql_queries/, named after the file without its extension
+    (e.g. registry['contacts_create']), along with their query plans
+    """
+
+    def __init__(self, engine, query_dir=QUERY_DIR):
+        """
+        Loads and checks every query so a broken query stops the run before anything is sent to Hubspot
+
+        Args:
+            engine (class): Engine object to provide a source of database connectivity and behavior
+            query_dir (str): folder holding the .sql files
+        """
+        self.engine = engine
+        self.query_dir = query_dir
+        self.queries = {} # {name: TextClause}
+        self.plans = {} # {name: [detail of each step of the query plan]}
+        self.load()
+        self.validate()
+
+    def __getitem__(self, name):
+        return self.queries[name]
+
+    def __contains__(self, name):
+        return name in self.queries
+
+    def load(self):
+        """Reads every .sql file once and compiles it into a statement"""
+        for query_file in sorted(glob(os.path.join(self.query_dir, '*.sql'))):
+            name = os.path.splitext(os.path.basename(query_file))[0]
+            with open(query_file) as file:
+                self.queries[name] = text(file.read())
+        if not self.queries:
+            raise FileNotFoundError(f'No .sql queries found in {self.query_dir}')
+
+    def validate(self):
+        """
+        Runs EXPLAIN QUERY PLAN on every query, which checks the tables and columns it uses against
+        the schema without running it, and keeps the plans
+
+        Raises:
+            SQLAlchemyError: the first query that does not fit the schema
+        """
+        with self.engine.connect() as con:
+            for name, query in self.queries.items():
+                try:
+                    steps = con.execute(text(f'EXPLAIN QUERY PLAN {query.text}')).fetchall()
+                except SQLAlchemyError as s:
+                    logger.error(f'Query {name} does not fit the database schema: {s}')
+                    raise
+                # Each step is (id, parent, notused, detail)
+                self.plans[name] = [step[-1] for step in steps]
+                for table in self.full_scans(name):
+                    if name in FULL_HISTORY_QUERIES:
+                        logger.debug(f'Query {name} does a full scan of {table}')
+                    else:
+                        logger.warning(f'Query {name} does a full scan of {table}')
+
+    def full_scans(self, name):
+        """
+        Finds the history tables a query reads from start to end instead of through an index
+
+        Args:
+            name (str): name of the query
+
+        Returns:
+            (list): names of the history tables scanned
+        """
+        # The plans name tables by their alias when they have one
+        tables = {}
+        for table, alias in TABLE_REFERENCE.findall(self.queries[name].text):
+            tables[table] = table
+            if alias and alias.upper() not in SQL_KEYWORDS:
+                tables[alias] = table
+        scanned = []
+        for detail in self.plans.get(name, []):
+            words = detail.split()
+            # e.g. "SCAN i" or "SCAN TABLE instance_history AS i" on older SQLite versions. A scan through
+            # an index still reads every row, so it counts too
+            if len(words) > 1 and words[0] == 'SCAN':
+                reference = words[2] if len(words) > 2 and words[1] == 'TABLE' else words[1]
+                table = tables.get(reference, reference)
+                if table in HISTORY_TABLES:
+                    scanned.append(table)
+        return scanned
+
+    def plan(self, name):
+        """
+        Gives the query plan of a query as text, one step per line
+
+        Args:
+            name (str): name of the query
+
+        Returns:
+            (str): the steps of the query plan
+        """
+        return '\n'.join(self.plans[name])
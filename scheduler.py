@@ -0,0 +1,102 @@
+"""Module to run the stages of the integration as a small dependency graph"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic
+
+import logging
+import os
+
+# Most stages running at the same time (1 runs them one after another in dependency order)
+STAGE_MAX_WORKERS = int(os.getenv('STAGE_MAX_WORKERS', 3))
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+
+def check_stages(stages):
+    """
+    Makes sure every dependency is a stage and that no stage ends up depending on itself
+
+    Args:
+        stages (dict): {name: (function, names of the stages it depends on)}
+
+    Raises:
+        ValueError: a dependency is missing or the stages form a cycle
+    """
+    for name, (_, dependencies) in stages.items():
+        missing = [dependency for dependency in dependencies if dependency not in stages]
+        if missing:
+            raise ValueError(f'Stage {name} depends on unknown stages: {", ".join(missing)}')
+    ordered = set()
+    while len(ordered) < len(stages):
+        ready = [name for name, (_, dependencies) in stages.items()
+                 if name not in ordered and all(dependency in ordered for dependency in dependencies)]
+        if not ready:
+            raise ValueError(f'Stages depend on each other in a cycle: {", ".join(sorted(set(stages) - ordered))}')
+        ordered.update(ready)
+
+
+def run_stages(stages, max_workers=STAGE_MAX_WORKERS, after_stage=None):
+    """
+    Starts each stage as soon as the stages it depends on have finished, with at most max_workers
+    stages running at the same time, so the run takes about as long as its longest chain of stages.
+    A stage that fails is logged and the stages depending on it are skipped, the others still run.
+
+    Args:
+        stages (dict): {name: (function, names of the stages it depends on)}, ready stages start in
+            the order they are given
+        max_workers (int): most stages running at the same time
+        after_stage (function): called with no arguments in the stage's thread once the stage ends,
+            ex: to remove the session of the thread
+
+    Returns:
+        (dict): {name: (start, end)} seconds since the first stage started, for every stage that ran
+
+    Raises:
+        Exception: the exception of the first stage that failed, once every other stage is done
+    """
+    check_stages(stages)
+    times = {}
+    started = monotonic()
+
+    def run(name, function):
+        start = monotonic() - started
+        try:
+            function()
+        finally:
+            times[name] = (start, monotonic() - started)
+            if after_stage is not None:
+                after_stage()
+
+    waiting = dict(stages)
+    done, failed, skipped = set(), {}, set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stage') as executor:
+        while waiting or running:
+            # Skip the stages that depend on one that failed or was skipped
+            blocked = [name for name, (_, dependencies) in waiting.items()
+                       if any(dependency in failed or dependency in skipped for dependency in dependencies)]
+            while blocked:
+                for name in blocked:
+                    del waiting[name]
+                    skipped.add(name)
+                    logger.error(f'Skipping stage {name}, a stage it depends on did not finish')
+                blocked = [name for name, (_, dependencies) in waiting.items()
+                           if any(dependency in skipped for dependency in dependencies)]
+            # Start the stages whose dependencies have all finished
+            for name in [name for name, (_, dependencies) in waiting.items() if all(d in done for d in dependencies)]:
+                function, _ = waiting.pop(name)
+                running[executor.submit(run, name, function)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    failed[name] = e
+                    logger.error(f'Stage {name} failed: {e}', exc_info=True)
+    if failed:
+        raise next(iter(failed.values()))
+    return times
@@ -1,17 +1,20 @@
 SELECT 
     c.hs_contact_id AS hs_contact_id,
     i.hs_instance_id AS hs_instance_id
+-- Goes through all of instance_history rather than this run's instances, so a pair Hubspot refused
+-- on an earlier run is sent again even when its instance is not staged this run
 FROM 
     contact_hs_history c
 JOIN
     instance_history i
 ON
-    i.talentlms_user_id = c.talentlms_user_id;
-
--- 1560, 128
-
--- UPDATE instance_history
--- SET talentlms_user_id = 1560,
--- talentlms_course_id = 128
--- WHERE 
---     hs_instance_id = 1870511175;
\ No newline at end of file
+    i.talentlms_user_id = c.talentlms_user_id
+-- Leave out the pairs that have already been associated on Hubspot
+WHERE NOT EXISTS (
+    SELECT 1 
+    FROM association_history a
+    WHERE 
+        a.from_id = c.hs_contact_id
+        AND a.to_id = i.hs_instance_id
+        AND a.assoc_type = 'student_class_instance_to_contact'
+);
@@ -1,9 +1,20 @@
 SELECT 
     c.hs_course_id AS hs_course_id,
     i.hs_instance_id AS hs_instance_id
+-- Goes through all of instance_history rather than this run's instances, so a pair Hubspot refused
+-- on an earlier run is sent again even when its instance is not staged this run
 FROM 
     course_hs_history c
 JOIN
     instance_history i
 ON
-    i.talentlms_course_id = c.talentlms_course_id;
+    i.talentlms_course_id = c.talentlms_course_id
+-- Leave out the pairs that have already been associated on Hubspot
+WHERE NOT EXISTS (
+    SELECT 1 
+    FROM association_history a
+    WHERE 
+        a.from_id = c.hs_course_id
+        AND a.to_id = i.hs_instance_id
+        AND a.assoc_type = 'course_to_student_class_instance'
+);
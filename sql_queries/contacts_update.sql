@@ -6,5 +6,6 @@ SELECT
     contacts.email AS email, 
     contacts.hs_content_membership_status AS hs_content_membership_status, 
     contacts.most_recent_linkedin_badge AS most_recent_linkedin_badge, 
-    contact_hs_history.hs_contact_id AS hs_contact_id
+    contact_hs_history.hs_contact_id AS hs_contact_id,
+    contact_hs_history.property_hash AS property_hash
 FROM contacts JOIN contact_hs_history ON contacts.talentlms_user_id = contact_hs_history.talentlms_user_id;
\ No newline at end of file
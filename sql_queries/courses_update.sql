@@ -12,5 +12,6 @@ SELECT
     courses.course_template_code AS course_template_code,
     courses.course_template_name AS course_template_name,
     course_hs_history.hs_course_id AS hs_course_id,
+    course_hs_history.property_hash AS property_hash,
     courses.trigger_datetime AS trigger_datetime
 FROM courses JOIN course_hs_history ON courses.talentlms_course_id = course_hs_history.talentlms_course_id;
\ No newline at end of file
@@ -20,7 +20,8 @@ SELECT
     student_course_instance.last_accessed_unit_url AS last_accessed_unit_url,
     student_course_instance.linkedin_badge AS linkedin_badge,
     student_course_instance.assignment_complete AS assignment_complete,
-    instance_history.hs_instance_id AS hs_instance_id
+    instance_history.hs_instance_id AS hs_instance_id,
+    instance_history.property_hash AS property_hash
 FROM student_course_instance 
 JOIN instance_history
 ON student_course_instance.talentlms_user_id = instance_history.talentlms_user_id 
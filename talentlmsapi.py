@@ -2,11 +2,14 @@
 import os
 import json 
 import logging
-import html
 import re
 import requests
 
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from threading import Lock
+from email.utils import parsedate_to_datetime
+from time import sleep, monotonic, time
 from webbrowser import get
 
 
@@ -16,26 +19,203 @@ from requests.packages.urllib3.util.retry import Retry
 
 from dotenv import load_dotenv
 
-from models import Contacts, Courses, StudentCourseInstance, TimeTracking, SQLITE_DB 
-from transform import return_unix_time, convert_dt_to_utc, remove_string
+try:
+    # Lets the bulk endpoints be parsed while they download instead of decoding the whole body at once
+    import ijson
+    DECODE_ERRORS = (ValueError, ijson.JSONError)
+except ImportError:
+    ijson = None
+    DECODE_ERRORS = (ValueError,)
+
+from models import Contacts, Courses, StudentCourseInstance, TimeTracking, CourseDetailCache, \
+    AssignmentCompletion, SQLITE_DB 
+from cache import DetailCache
+from transform import return_unix_time, convert_dt_to_utc, remove_string, bulk_upsert, InstanceBatch
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from hubapi import read_property, add_value_to_property
+from templates import CourseTemplateRegistry
 
-load_dotenv()
-TALENTLMS_API = os.getenv('TALENTLMS_API')
+# Number of student records requested from TalentLMS at the same time (1 keeps the serial path)
+TALENTLMS_MAX_WORKERS = int(os.getenv('TALENTLMS_MAX_WORKERS', 4))
+# Number of rows written to SQLite per transaction by the move_* methods
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 500))
+# Starting number of seconds between two TalentLMS requests, the rate limiter adjusts it from the headers
+REQUEST_INTERVAL = .36
+# Bounds (requests per second) the rate limiter is allowed to move between
+MIN_REQUEST_RATE = .2
+MAX_REQUEST_RATE = 10
+# Requests of the TalentLMS quota held in reserve: above it requests go out at MAX_REQUEST_RATE, once the
+# quota gets down to it the requests left are spread over the rest of the window
+RATE_LIMIT_FLOOR = int(os.getenv('RATE_LIMIT_FLOOR', 100))
+# Factor the rate goes back up by with every response after a backoff, when TalentLMS sends no rate limit headers
+RATE_RECOVERY = 1.25
+# Times a request TalentLMS refused with a 429 (or a 503 with a Retry-After) is sent again, once the rate limiter lets it through
+RATE_LIMIT_RETRIES = 5
 
+# Fields kept from each record of the bulk /courses and /users responses, the rest is dropped while parsing
+COURSE_FIELDS = ('id', 'name', 'code', 'description', 'last_update_on', 'custom_field_3', 'custom_field_4', 
+                 'custom_field_5', 'custom_field_6', 'custom_field_7')
+USER_FIELDS = ('id', 'first_name', 'last_name', 'login', 'email', 'status', 'last_updated_timestamp')
+# Fields kept from the individual student records and from each of the courses listed in them
+STUDENT_FIELDS = ('first_name', 'last_name', 'email', 'status', 'custom_field_4')
+STUDENT_COURSE_FIELDS = ('id', 'name', 'completed_on_timestamp', 'completion_status', 'completion_percentage', 'role',
+                         'total_time', 'total_time_seconds', 'last_accessed_unit_url')
 
 logger = logging.getLogger(f'CurrUpdate.{__name__}')
 
 BASE_URL = 'https://client_name.talentlms.com'
-# Lets you fake a browser visit using a python requests or command wget
-headers = {
-    'Authorization': f'{TALENTLMS_API}'
-    }
 
-talentlms_http = sessions.BaseUrlSession(BASE_URL)
-talentlms_http.mount(BASE_URL, HTTPAdapter(max_retries=Retry(backoff_factor=1)))
-talentlms_http.headers.update(headers)
+class RateLimiter:
+    """
+    Token bucket shared by every request made through get_talentlms_http(). The rate starts at 
+    1/REQUEST_INTERVAL and is adjusted from the X-RateLimit-* and Retry-After headers that
+    TalentLMS sends back: requests go out at MAX_REQUEST_RATE while the quota is well above
+    RATE_LIMIT_FLOOR, are spread over the rest of the window once it gets down to it, and back
+    off on a 429, after which the rate climbs back up.
+    """
+
+    def __init__(self, rate=1 / REQUEST_INTERVAL, capacity=1, floor=RATE_LIMIT_FLOOR):
+        self.rate = rate # tokens added per second
+        self.base_rate = rate # rate to recover to after a backoff when there are no rate limit headers
+        self.floor = floor # requests of the quota held in reserve
+        self.capacity = capacity # most requests that can be made in a burst
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0 # set when TalentLMS tells us to stop until a certain time
+        self.waited = 0.0 # seconds spent waiting on the limiter since the last report
+        self.requests = 0 # requests let through since the last report
+        self.lock = Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed to be made"""
+        with self.lock:
+            now = monotonic()
+            # Refill the bucket for the time that has gone by since the last request
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token right away, a negative balance lines up the other threads behind this one
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.blocked_until - now, 0)
+            self.waited += wait
+            self.requests += 1
+        if wait > 0:
+            sleep(wait)
+
+    def update(self, res):
+        """
+        Adjusts the rate using the rate limit headers of a TalentLMS response
+
+        Args:
+            res (class): contains the server's response to the HTTP request
+        """
+        with self.lock:
+            now = monotonic()
+            retry_after = self._seconds_from_header(res.headers.get('Retry-After'))
+            if res.status_code == 429 or retry_after is not None:
+                # Stop everyone until TalentLMS lets us back in and slow down for when it does
+                self.blocked_until = max(self.blocked_until, now + (retry_after or REQUEST_INTERVAL))
+                self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+                return
+            reset = self._seconds_from_header(res.headers.get('X-RateLimit-Reset'))
+            try:
+                remaining = int(res.headers.get('X-RateLimit-Remaining'))
+            except (TypeError, ValueError):
+                remaining = None
+            if remaining is None or reset is None:
+                # Nothing to go by, win back the rate lost to a backoff a little with every request let through
+                if self.rate < self.base_rate:
+                    self.rate = min(self.base_rate, self.rate * RATE_RECOVERY)
+                return
+            if remaining <= 0:
+                self.blocked_until = max(self.blocked_until, now + reset)
+            elif remaining > self.floor:
+                # Plenty of the quota left, go as fast as allowed
+                self.rate = MAX_REQUEST_RATE
+            else:
+                # Close to the end of the quota, spread the requests that are left evenly over what is left of the window
+                self.rate = min(MAX_REQUEST_RATE, max(MIN_REQUEST_RATE, remaining / max(reset, 1)))
+
+    def report(self):
+        """
+        Gives the time spent waiting on the limiter and resets the counters for the next run
+
+        Returns:
+            (dict): seconds waited, requests made and the current rate in requests per second
+        """
+        with self.lock:
+            stats = {'waited': self.waited, 'requests': self.requests, 'rate': self.rate}
+            self.waited = 0.0
+            self.requests = 0
+        return stats
+
+    @staticmethod
+    def _seconds_from_header(value):
+        """
+        Turns a header value into a number of seconds from now. The value can be a number of seconds,
+        a unix timestamp or an HTTP date.
+        """
+        if value is None:
+            return None
+        try:
+            seconds = float(value)
+            # Anything this big is a unix timestamp rather than a number of seconds
+            if seconds > 1e9:
+                seconds -= time()
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time()
+            except (TypeError, ValueError):
+                return None
+        return max(seconds, 0)
+
+
+class RateLimitedSession(sessions.BaseUrlSession):
+    """
+    BaseUrlSession that goes through a RateLimiter before every request and feeds it the response. 
+    A request TalentLMS refused with a 429, or a 503 with a Retry-After, is sent again once the limiter 
+    lets it through, up to RATE_LIMIT_RETRIES times, so every attempt is paced and seen by the limiter.
+    """
+
+    def __init__(self, base_url, rate_limiter):
+        super().__init__(base_url)
+        self.rate_limiter = rate_limiter
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self.rate_limiter.acquire()
+            res = super().request(method, url, *args, **kwargs)
+            self.rate_limiter.update(res)
+            refused = res.status_code == 429 or (res.status_code == 503 and 'Retry-After' in res.headers)
+            if not refused or attempt == RATE_LIMIT_RETRIES:
+                return res
+            logger.warning(f'TalentLMS refused {url} with a {res.status_code}, sending it again ({attempt + 1}/{RATE_LIMIT_RETRIES})')
+            res.close()
+
+
+# Session shared by every TalentLMS request, created by get_talentlms_http on first use
+_talentlms_http = None
+_talentlms_http_lock = Lock()
+
+
+def get_talentlms_http():
+    """
+    Gives the session every TalentLMS request goes through, creating it the first time with the API key
+    from the environment or the .env file
+
+    Returns:
+        (class): RateLimitedSession to TalentLMS
+    """
+    global _talentlms_http
+    if _talentlms_http is None:
+        with _talentlms_http_lock:
+            if _talentlms_http is None:
+                load_dotenv()
+                session = RateLimitedSession(BASE_URL, RateLimiter())
+                # urllib3 only retries failed connections, a 429 or 503 goes back to the session so the rate limiter sees it
+                session.mount(BASE_URL, HTTPAdapter(max_retries=Retry(backoff_factor=1, respect_retry_after_header=False)))
+                # Lets you fake a browser visit using a python requests or command wget
+                session.headers.update({'Authorization': f"{os.getenv('TALENTLMS_API')}"})
+                _talentlms_http = session
+    return _talentlms_http
 
 # Logging Function
 def talentlms_log(res):
@@ -62,15 +242,80 @@ def talentlms_log(res):
         logger.error(F'"LOG": "Failed TalentLMS request, unknown error.", {res_log}', exc_info=True)
         return None
 
+def iter_records(endpoint, fields):
+    """
+    Streams the records of a bulk TalentLMS endpoint (ex: api/v1/users/), decoding the response a
+    single time as it downloads and keeping only the given fields of each record
+
+    Args:
+        endpoint (str): TalentLMS endpoint that returns a list of records
+        fields (tuple): keys to keep from each record
+
+    Yields:
+        (dict): a record with only the given fields
+
+    Raises:
+        requests.HTTPError: TalentLMS did not answer with a 200
+        ValueError: the response is not a list of records or could not be decoded, so a partial list
+            is never taken for the whole one and the stage fails to be resumed by the next run
+    """
+    res = get_talentlms_http().get(endpoint, stream=True)
+    res_log = F'"METHOD": {res.request.method}, "STATUS_CODE": {res.status_code}, "URL": {res.url}'
+    if res.status_code != 200:
+        # Error bodies are small, so let talentlms_log read and log them
+        talentlms_log(res)
+        res.close()
+        raise requests.HTTPError(f'TalentLMS answered {endpoint} with {res.status_code}', response=res)
+    logger.debug(F'"LOG": "Successful TalentLMS request.", {res_log}', exc_info=True)
+    try:
+        if ijson is not None:
+            # Undo any gzip encoding before handing the raw stream to the parser
+            res.raw.decode_content = True
+            events = ijson.parse(res.raw, use_float=True)
+            first = next(events, None)
+            if first is None or first[1] != 'start_array':
+                raise ValueError(f'TalentLMS did not answer {endpoint} with a list of records')
+            records = ijson.items(chain([first], events), 'item')
+        else:
+            records = res.json()
+            if not isinstance(records, list):
+                raise ValueError(f'TalentLMS did not answer {endpoint} with a list of records')
+        for record in records:
+            yield {field: record.get(field) for field in fields}
+    except DECODE_ERRORS:
+        logger.error(F'"LOG": "Failed TalentLMS request, unable to decode response.", {res_log}', exc_info=True)
+        raise
+    finally:
+        res.close()
+
 # Request Class
 class TalentLMS: # Make this into a Parent Class and create some child classes
 
-    def __init__(self, isodatetime, engine=None, session=None):
+    def __init__(self, isodatetime, engine=None, session=None, chunk_size=INGEST_CHUNK_SIZE, template_registry=None, on_chunk=None, 
+                 user_ids=None, course_ids=None):
         self.isodatetime = isodatetime
         self.engine = engine 
         self.session = session
-        self.all_students = self.get_all_students() # Gathers all users from TalentLMS
-        self.all_courses = self.get_all_courses() # Gathers all courses from TalentLMS
+        self.chunk_size = chunk_size # rows committed per transaction by the move_* methods
+        # Called with (model, rows) once the move_* methods have committed a chunk, ex: by the streaming pipeline
+        self.on_chunk = on_chunk
+        # A targeted run, ex: from a webhook, only moves these users and courses whatever their last update, 
+        # and requests their details from TalentLMS instead of the caches. None for a regular run.
+        self.user_ids = None if user_ids is None and course_ids is None else {str(user_id) for user_id in user_ids or ()}
+        self.course_ids = None if self.user_ids is None else {str(course_id) for course_id in course_ids or ()}
+        if self.user_ids is None:
+            # The bulk responses are parsed once here into lists of trimmed records that the move_* methods loop through
+            self.all_students = self.get_all_students() # Gathers all users from TalentLMS
+            self.all_courses = self.get_all_courses() # Gathers all courses from TalentLMS
+            self.targeted_students = {}
+            self.targeted_courses = {}
+        else:
+            # A targeted run requests only the users and courses it names instead of downloading the whole lists,
+            # their full records are kept so they are not requested a second time
+            self.targeted_students = self.get_records_by_id(self.user_ids, self.get_student)
+            self.targeted_courses = self.get_records_by_id(self.course_ids, self.get_course)
+            self.all_students = [{field: student.get(field) for field in USER_FIELDS} for student in self.targeted_students.values()]
+            self.all_courses = [{field: course.get(field) for field in COURSE_FIELDS} for course in self.targeted_courses.values()]
         # A unique set of student ids obtained from courses that pass a certain criteria. 
         # This is used to later compare with information to lessen the amount of API calls needed
         self.student_ids = set() 
@@ -78,12 +323,13 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
         # session_time, and assign_complete_ids from course TalentsLMS API call to be used in 
         # instances
         self.course_ids_session = {} 
+        # Course payloads kept from earlier runs, used while the course's last_update_on has not moved
+        self.course_cache = DetailCache(CourseDetailCache, 'talentlms_course_id', 'last_update_on', self.session)
 
-        # 2-8311841 is the custom object internal name in hubspot for courses
-        # Get all the values from the property: course_template_name
-        course_template_name_payload = read_property('2-8311841', 'course_template_name').json()
-        # Gathers a dictionary of {course code: course name}
-        self.course_templates = {option['value']: option['label'] for option in course_template_name_payload['options']}
+        # The course templates on Hubspot indexed by course code and by course name, read from the local
+        # copy unless it is stale
+        self.course_templates = template_registry or CourseTemplateRegistry(self.session)
+        self.course_templates.load()
 
         try:
             # Get the last datetime the integration ran
@@ -96,42 +342,198 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
     # Request Helper Functions
     def get_all_courses(self):
         endpoint = 'api/v1/courses/'
-        res = talentlms_http.get(endpoint)
-        return talentlms_log(res)
+        return list(iter_records(endpoint, COURSE_FIELDS))
 
     def get_course(self, course_id):
         endpoint = f'api/v1/courses/id:{course_id}'
-        res = talentlms_http.get(endpoint)
+        res = get_talentlms_http().get(endpoint)
         return talentlms_log(res)
 
     def get_all_students(self):
         endpoint = 'api/v1/users/'
-        res = talentlms_http.get(endpoint)
-        return talentlms_log(res)
+        return list(iter_records(endpoint, USER_FIELDS))
 
     def get_student(self, user_id):
         endpoint = f'api/v1/users/id:{user_id}'
-        res = talentlms_http.get(endpoint)
+        res = get_talentlms_http().get(endpoint)
         return talentlms_log(res)
     
+    def get_records_by_id(self, ids, get_record):
+        """
+        Requests the individual records of the ids a targeted run names, leaving out the ones TalentLMS
+        did not return (ex: deleted since the webhook event was sent)
+
+        Args:
+            ids (set): TalentLMS ids of the users or courses
+            get_record (function): get_student or get_course
+
+        Returns:
+            (dict): {TalentLMS id: the record}
+        """
+        records = {}
+        for record_id in sorted(ids):
+            try:
+                res = get_record(record_id)
+                if res is None:
+                    logger.error(f'Skipping {record_id}, TalentLMS did not return the record')
+                    continue
+                records[record_id] = res.json()
+            except Exception as e:
+                logger.error(f'Skipping {record_id}: {e}', exc_info=True)
+                continue
+        return records
+
     def get_timeline_of_unit(self, unit_id, eventType="unitprogress_assignment_answered"):
         endpoint = f'api/v1/gettimeline/event_type:{eventType},unit_id:{unit_id}' 
-        res = talentlms_http.get(endpoint)
+        res = get_talentlms_http().get(endpoint)
         return talentlms_log(res)
 
+    def sync_assignment_completion(self, unit_id):
+        """
+        Adds the students of an Assignment unit's timeline that are not in the assignment_completion index
+        yet. TalentLMS gives the whole timeline of the unit every time and its timestamps are in the portal's
+        date format, so the new events are told apart by the students already indexed instead of by time.
+
+        Args:
+            unit_id (str): TalentLMS id of the Assignment unit
+
+        Returns:
+            (int): number of students added to the index
+        """
+        indexed = {user_id for (user_id,) in self.session.query(AssignmentCompletion.user_id)
+                   .filter(AssignmentCompletion.unit_id == int(unit_id))}
+        new_user_ids = {int(event['user_id']) for event in self.get_timeline_of_unit(unit_id).json()} - indexed
+        if new_user_ids:
+            self.session.execute(AssignmentCompletion.__table__.insert(), 
+                                 [{'unit_id': int(unit_id), 'user_id': user_id} for user_id in sorted(new_user_ids)])
+        return len(new_user_ids)
+
+    def get_assignment_completions(self, unit_ids):
+        """
+        Gives the students that have completed any of the given Assignment units
+
+        Args:
+            unit_ids (list): TalentLMS ids of the Assignment units
+
+        Returns:
+            (set): TalentLMS user ids of the students, as integers
+        """
+        if not unit_ids:
+            return set()
+        completions = self.session.query(AssignmentCompletion.user_id)\
+            .filter(AssignmentCompletion.unit_id.in_([int(unit_id) for unit_id in unit_ids]))
+        return {user_id for (user_id,) in completions}
+
+    def fetch_students(self, student_ids, max_workers=TALENTLMS_MAX_WORKERS):
+        """
+        Gathers the individual student records from TalentLMS, with more than one worker several requests 
+        are kept in flight at once while the session's RateLimiter keeps them under the rate limit. They are 
+        requested every run, as the course progress they hold changes without the users list showing it.
+
+        Args:
+            student_ids (list): TalentLMS user ids to be requested
+            max_workers (int): number of requests to keep in flight, 1 requests them one at a time
+
+        Yields:
+            (tuple): the student id and its TalentLMS record, in the same order as student_ids. Students
+                that could not be requested are left out.
+        """
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            # Both hand back the results in the order the ids were given, so the rows built from 
+            # them come out exactly as they would from the serial path
+            fetched = map(self._get_student_json, student_ids) if max_workers <= 1 \
+                else executor.map(self._get_student_json, student_ids)
+            for student_id, instance_json in zip(student_ids, fetched):
+                if instance_json is None:
+                    continue
+                yield student_id, instance_json
+
+    def _get_student_json(self, student_id):
+        """
+        Returns the student record from TalentLMS with only the fields used for the instances, or None if 
+        the student could not be requested (ex: deleted since the users list was read), so one student does 
+        not stop the rest
+        """
+        try:
+            # The students of a targeted run were requested already
+            instance_json = self.targeted_students.get(str(student_id))
+            if instance_json is None:
+                res = self.get_student(student_id)
+                if res is None:
+                    logger.error(f'Skipping student {student_id}, TalentLMS did not return the student record')
+                    return None
+                instance_json = res.json()
+            trimmed = {field: instance_json[field] for field in STUDENT_FIELDS}
+            trimmed['courses'] = [{field: course[field] for field in STUDENT_COURSE_FIELDS} for course in instance_json['courses']]
+            return trimmed
+        except Exception as e:
+            logger.error(f'Skipping student {student_id}: {e}', exc_info=True)
+            return None
+
+    def commit_entries(self, model, order_entries):
+        """
+        Commits a chunk of rows in its own transaction through the bulk upsert path so the rows are 
+        durable as soon as the chunk is full. If the chunk fails, its rows are committed one at a time
+        so only the failing rows are lost. The rows are then handed to on_chunk, if there is one.
+
+        Args:
+            model (class): table the rows belong to
+            order_entries (list): dicts of {column name: value} to be added to the database
+        """
+        if not order_entries:
+            return
+        try: 
+            bulk_upsert(self.session, model, order_entries)
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            self._commit_one_by_one(model, order_entries)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            self.session.rollback()
+            self._commit_one_by_one(model, order_entries)
+        if self.on_chunk is not None:
+            if model is Courses:
+                # The courses of the chunk may be sent to Hubspot right away, their new templates have to be there first
+                self.course_templates.flush()
+            self.on_chunk(model, order_entries)
+
+    def _commit_one_by_one(self, model, order_entries):
+        """Commits the rows of a chunk that failed one at a time to isolate the rows that made it fail"""
+        for entry in order_entries:
+            try:
+                bulk_upsert(self.session, model, [entry])
+                self.session.commit()
+            except SQLAlchemyError as s:
+                logger.error(s, exc_info=True)
+                self.session.rollback()
+                continue
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                self.session.rollback()
+                continue
+
     def move_courses_to_sqlite(self):
         """
         Move the courses obtained from TalentLMS that pass certain criteria to the Courses table
         in SQLite
         """
         order_entries = []
+        # Every course id still on TalentLMS, used to drop cached courses that have been deleted
+        live_course_ids = []
         # Loop through all the courses
-        for course in self.all_courses.json():
+        for course in self.all_courses:
+            live_course_ids.append(course['id'])
             # The datetime that the course was last update in unix epoch  (milliseconds)
             course_datetime = return_unix_time(course['last_update_on'])
-            # If any of the custom fields are empty or if the last time the course was updated is
-            # newer than the last time the integration run add it to the database
-            if course['custom_field_3'] is not None or course['custom_field_4'] is not None or course['custom_field_5'] is not None or course['custom_field_6'] is not None or course['custom_field_7'] is not None or course_datetime > self.time_track:
+            # A targeted run takes its own courses. Otherwise, if any of the custom fields are empty or if the 
+            # last time the course was updated is newer than the last time the integration run add it to the database
+            if self.course_ids is not None:
+                selected = str(course['id']) in self.course_ids
+            else:
+                selected = course['custom_field_3'] is not None or course['custom_field_4'] is not None or course['custom_field_5'] is not None or course['custom_field_6'] is not None or course['custom_field_7'] is not None or course_datetime > self.time_track
+            if selected:
                 try:
                     course_template_name = None
                     course_template_code = None
@@ -143,33 +545,22 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                     if transformed_code[-1] == "T":
                         # Remove (Template) from the course name
                         course_label = remove_string(course['name']) 
-                        # if the course code does not exist in the Hubspot prop course_template_name as an internal name
-                        if template_code not in self.course_templates.keys():
-                            # and if the course name does not exist in the Hubspot prop course_template_name as a UI name
-                            if course_label not in self.course_templates.values():
-                                # Create it and add it
-                                add_value = {
-                                    "label": course_label,
-                                    "value": template_code
-                                    }
-                                upd_prop_course_req = add_value_to_property('2-8311841', 'course_template_name', add_value)
-                                upd_prop_instance_req = add_value_to_property('2-8311962', 'course_template_name', add_value)
-                                self.course_templates[template_code] = course_label
-                                course_template_code = course_template_name = template_code
-                            else:
-                                # If the course code does not already exist in Hubspot
-                                for value, label in self.course_templates.items():
-                                    # But the course name does exist in Hubspot
-                                    if label == course_label:
-                                        # the wrong course code is on TalentLMS, so set it to
-                                        # whatever is in Hubspot
-                                        course_template_code = course_template_name = value
+                        # if the course code does exist in the Hubspot prop course_template_name as an internal name
+                        if self.course_templates.has_code(template_code):
+                            # just set both of these to it
+                            course_template_code = course_template_name = template_code
+                        # If the course code does not already exist in Hubspot, but the course name does exist 
+                        # in the Hubspot prop course_template_name as a UI name
+                        elif self.course_templates.code_of(course_label) is not None:
+                            # the wrong course code is on TalentLMS, so set it to whatever is in Hubspot
+                            course_template_code = course_template_name = self.course_templates.code_of(course_label)
                         else:
-                            # if the course code does exist, just set both of these to it
+                            # Create it and add it
+                            self.course_templates.add(template_code, course_label)
                             course_template_code = course_template_name = template_code
                     else: # if the split is not a T
-                        # And it's in the list of values in the property
-                        if template_code in self.course_templates.keys():
+                        # And it's in the list of values in the property, a miss adds nothing so the local copy will do
+                        if self.course_templates.has_code(template_code, refresh=False):
                             course_template_code = course_template_name = template_code
                         # If not in the list of values of the property
                         else:
@@ -183,7 +574,7 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                         session_date_unix = None
                         session_time = None
                     # Add all data to the Courses Table
-                    added_courses = Courses(    
+                    added_courses = dict(    
                                             talentlms_course_id=course['id'],
                                             course_name=course['name'],
                                             code=code,
@@ -199,25 +590,33 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                                             trigger_datetime=return_unix_time(self.isodatetime)
                                             )
                     order_entries.append(added_courses)
+                    if len(order_entries) >= self.chunk_size:
+                        self.commit_entries(Courses, order_entries)
+                        order_entries = []
                     # Keep a record of ids to be TalentLMS API called along with code, session_date_unix, session_time, assign_complete_id to be added to the HS student_course_instance object
-                    self.course_ids_session[course['id']] = {'code': code, 'session_date_unix': session_date_unix, 'session_time': session_time, 'assign_complete_ids': []}
+                    self.course_ids_session[course['id']] = {'code': code, 'session_date_unix': session_date_unix, 'session_time': session_time, 'assign_complete_ids': set()}
                     logger.info('Grabbing individual course records:')
-                    course_json = self.get_course(course['id']).json()
-                    # sleep to avoid rate limits
-                    sleep(.36)
-                    # Check the units
-                    for unit in course_json['units']:
-                        # Find the unit with type of Assignment assigned to the course
-                        if unit['type'] == 'Assignment':
-                            # If exists, do an TalentLMS API call to find all the student ids that have completed the assignment
-                            completed_users = self.get_timeline_of_unit(unit['id']).json()
-                            sleep(.36)
-                            for user in completed_users:
-                                # Put all the student ids that have completed the assignment in the course_ids_session dictionary
-                                self.course_ids_session[course['id']]['assign_complete_ids'].append(user['user_id'])
+                    course_json = self.course_cache.get(course['id'], course['last_update_on']) if self.course_ids is None else None
+                    if course_json is None:
+                        # The courses of a targeted run were requested already
+                        course_json = self.targeted_courses.get(str(course['id'])) or self.get_course(course['id']).json()
+                        # Only keep what is used below
+                        course_json = {
+                                    'units': [{'id': unit['id'], 'type': unit['type']} for unit in course_json['units']],
+                                    'users': [{'id': user['id']} for user in course_json['users']]
+                                    }
+                        self.course_cache.put(course['id'], course['last_update_on'], course_json)
+                    # Find the units with type of Assignment assigned to the course
+                    assignment_unit_ids = [unit['id'] for unit in course_json['units'] if unit['type'] == 'Assignment']
+                    for unit_id in assignment_unit_ids:
+                        # Add the students that have completed the assignment since the last run to the index
+                        self.sync_assignment_completion(unit_id)
+                    # Put all the student ids that have completed an assignment of the course in the course_ids_session dictionary
+                    self.course_ids_session[course['id']]['assign_complete_ids'] = self.get_assignment_completions(assignment_unit_ids)
                     for user in course_json['users']:
                         # Grab all the student id in the course (This includes active and inactive students)
-                        self.student_ids.add(user['id'])  
+                        if self.user_ids is None or str(user['id']) in self.user_ids:
+                            self.student_ids.add(user['id'])
                 except SQLAlchemyError as s:
                     logger.error(s, exc_info=True)
                     self.session.rollback()
@@ -225,29 +624,31 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                 except Exception as e:
                     logger.error(e, exc_info=True)
                     continue 
-        try: 
-            self.session.add_all(order_entries)
-            self.session.commit()
-        except SQLAlchemyError as s:
-            logger.error(s, exc_info=True)
-            self.session.rollback()
-            pass
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            pass
+        # Commit the rows left over from the last chunk
+        self.commit_entries(Courses, order_entries)
+        # Add the course templates found during the pass to Hubspot
+        self.course_templates.flush()
+        # Evict old entries from the course cache and save the ones fetched this run, a targeted run only 
+        # knows of its own courses so it can not tell which ones were deleted
+        self.course_cache.save(live_ids=live_course_ids if self.course_ids is None else None)
 
     def move_users_to_sqlite(self):
         """
         Moves all students to the Contacts table based on certain criteria
         """
         order_entries = []
-        for student in self.all_students.json():
+        for student in self.all_students:
             # Check to see if the last updated student information is newer than the last time the program ran
             student_datetime = student['last_updated_timestamp']
-            if int(student_datetime) * 1000 > self.time_track:
+            # A targeted run takes its own users whatever their last update
+            if self.user_ids is not None:
+                selected = str(student['id']) in self.user_ids
+            else:
+                selected = int(student_datetime) * 1000 > self.time_track
+            if selected:
                 try:
                     # Add to the Contacts Table
-                    added_contact = Contacts( 
+                    added_contact = dict( 
                                             talentlms_user_id=student['id'],
                                             firstname=student['first_name'],
                                             lastname=student['last_name'],
@@ -256,6 +657,9 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                                             hs_content_membership_status=student['status']
                                             )
                     order_entries.append(added_contact)
+                    if len(order_entries) >= self.chunk_size:
+                        self.commit_entries(Contacts, order_entries)
+                        order_entries = []
                     self.student_ids.add(student['id'])
                 except SQLAlchemyError as s:
                     logger.error(s, exc_info=True)
@@ -263,16 +667,8 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                 except Exception as e:
                     logger.error(e, exc_info=True)
                     continue
-        try: 
-            self.session.add_all(order_entries)
-            self.session.commit()
-        except SQLAlchemyError as s:
-            logger.error(s, exc_info=True)
-            self.session.rollback()
-            pass
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            pass
+        # Commit the rows left over from the last chunk
+        self.commit_entries(Contacts, order_entries)
 
     def move_instances_to_sqlite(self):
         """
@@ -281,12 +677,10 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
         the criteria of having a last_updated time that is newer than the last time the program has run.
         Information stored earlier in self.course_ids_session is also gather for the student_course_instance records
         """
-        order_entries = []
+        instances = InstanceBatch()
         logger.info('Grabbing individual student records:')
         # Loop only through students that are currently in courses
-        for student_id in self.student_ids:
-            instance_json = self.get_student(student_id).json()
-            sleep(.36)
+        for student_id, instance_json in self.fetch_students(list(self.student_ids)):
             # Loop through all the courses the student is taking
             for course in instance_json["courses"]:
                 course_id = course['id']
@@ -294,52 +688,13 @@ class TalentLMS: # Make this into a Parent Class and create some child classes
                 # Or, the custom objects are filled, then add the data to the StudentCourseInstance Table
                 # This is done to decrease the number of API calls needed
                 if course_id in self.course_ids_session.keys():
-                    # Check if the student has already completed the assignment
-                    if student_id in self.course_ids_session[course_id]['assign_complete_ids']:
-                        assignment_status = "Yes"
-                    else: 
-                        assignment_status = "No"
                     try:
-                        # Add all needed data to the StudentCourseIntance table
-                        added_instance = StudentCourseInstance( 
-                                        talentlms_user_id=student_id,
-                                        talentlms_course_id=course['id'],
-                                        instance_name=f"{instance_json['last_name']} {instance_json['first_name']}: {html.unescape(course['name'])}",
-                                        firstname=instance_json['first_name'], 
-                                        lastname=instance_json['last_name'],
-                                        course_name=course['name'],
-                                        code=self.course_ids_session[course['id']]['code'],
-                                        company_cohort_id=instance_json['custom_field_4'],
-                                        completed_on=int(course['completed_on_timestamp']) * 1000 \
-                                            if course['completed_on_timestamp'] is not None \
-                                            else course['completed_on_timestamp'],
-                                        completion_status=course['completion_status'],
-                                        completion_percent=course['completion_percentage'],
-                                        email=instance_json['email'],
-                                        live_session_datetime=self.course_ids_session[course['id']]['session_date_unix'],
-                                        role=course['role'],
-                                        session_time=self.course_ids_session[course['id']]['session_time'],
-                                        status = instance_json['status'],
-                                        total_time=course['total_time'],
-                                        total_time_seconds=course['total_time_seconds'],
-                                        last_accessed_unit_url=course['last_accessed_unit_url'],
-                                        assignment_complete=assignment_status
-                                        )
-                        order_entries.append(added_instance)
-                    except SQLAlchemyError as s:
-                        logger.error(s, exc_info=True)
-                        self.session.rollback()
-                        continue
+                        # Gather the enrollment, the StudentCourseIntance rows are built a whole chunk at a time
+                        instances.append(student_id, instance_json, course, self.course_ids_session[course_id])
+                        if len(instances) >= self.chunk_size:
+                            self.commit_entries(StudentCourseInstance, instances.rows())
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         continue
-        try: 
-            self.session.add_all(order_entries)
-            self.session.commit()
-        except SQLAlchemyError as s:
-            logger.error(s, exc_info=True)
-            self.session.rollback()
-            pass
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            pass
+        # Commit the rows left over from the last chunk
+        self.commit_entries(StudentCourseInstance, instances.rows())
@@ -1,86 +1,195 @@
 """Main module to run TalentLMS to Hubspot Integration"""
 
+import argparse
+import fcntl
+import os
+import signal
+
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
+from threading import Event
+from time import monotonic
+
+from dotenv import load_dotenv
+# Read the .env file before the modules below take their settings from the environment
+load_dotenv()
 
-from talentlmsapi import TalentLMS
+from talentlmsapi import TalentLMS, get_talentlms_http
 from hubapi import CreateRecordsHandler, UpdateRecordsHandler, CreateAssociationsHandler
-from transform import create_obj_payload, update_obj_payload, create_assoc_payload, update_time_tracking, gather_batch_hs_id, gather_unit_hs_id
+from transform import iter_create_obj_payload, iter_update_obj_payload, iter_assoc_payload, update_time_tracking, save_fingerprints, \
+    save_associations
 from logger import get_logger
-from models import Courses, Contacts, StudentCourseInstance, SQLITE_DB 
-from sqlalchemy import create_engine
+from ledger import Ledger
+from pipeline import StreamingPipeline
+from queries import QueryRegistry
+from scheduler import run_stages
+from templates import CourseTemplateRegistry
+from models import Courses, Contacts, StudentCourseInstance, IN_MEMORY_STAGING, get_engine, init_db
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-import os
 # "2-8311841" Test for courses
 # 2-8311962  Test for student_class_instance
 
 # 2-8311841 is the internal ID of courses object on HS
 # 2-8311962 is the internal ID of the student_course_instance object on HS
 
-project_root = os.path.dirname(os.path.dirname(__file__))
-output_path = os.path.join(project_root, 'TLMS_HS_Integration/sql_queries')   
+# Seconds between the start of two cycles in --daemon mode
+DAEMON_INTERVAL = int(os.getenv('DAEMON_INTERVAL', 15 * 60))
+# Lock file of the cron job, also taken by every daemon cycle so a cycle and a cron run never overlap
+LOCK_FILE = os.getenv('LOCK_FILE', '/tmp/sample.lockfile')
+
 
 class CurrUpdate:
 
-    def __init__(self, isodatetime=datetime.utcnow().isoformat()):
-        # Create an engine and session to SQLAlchemy to start the program
-        self.engine, self.session = self.get_session()
-        try:
-            # Delete any information in the Contacts, Courses, and StudentCourseInstance from the last run
-            # This is done to only bring in newly created or updated information from TalentLMS
-            self.session.query(Contacts).delete()
-            self.session.query(Courses).delete()
-            self.session.query(StudentCourseInstance).delete()
-            self.session.commit()
-        except SQLAlchemyError as s:
-            self.logger.error(s)
-            self.session.rollback()
-            pass
-        except Exception as e:
-            self.logger.error(e, exc_info=True)
-            pass
-        self.isodatetime = isodatetime # set the current time
+    def __init__(self, isodatetime=None, engine=None, session=None, queries=None, template_registry=None, streaming=False, 
+                 user_ids=None, course_ids=None):
+        """
+        Args:
+            isodatetime (str): start time of the run, now if None
+            engine (class): Engine object to reuse, ex: from the daemon. A new one is created and disposed 
+                of at the end of the run if None
+            session (class): scoped_session to reuse with the engine
+            queries (class): QueryRegistry to reuse, loaded from sql_queries/ if None
+            template_registry (class): CourseTemplateRegistry to reuse across runs
+            streaming (bool): send records to Hubspot while TalentLMS is still being read, see pipeline.py
+            user_ids (iterable): TalentLMS users of a targeted run, ex: from webhook.py. A targeted run moves
+                only the given users and courses, and neither uses the run ledger nor moves the time tracking
+            course_ids (iterable): TalentLMS courses of a targeted run
+        """
         self.logger = get_logger('CurrUpdate') # Instantiate the logger
+        # Create an engine and session to SQLAlchemy to start the program, unless they are handed over
+        self.owns_engine = engine is None
+        self.engine, self.session = self.get_session() if self.owns_engine else (engine, session)
+        # Load and check every .sql query up front, a query that does not fit the schema stops the run here,
+        # before the ledger or the staging tables are touched
+        self.queries = queries or QueryRegistry(self.engine)
+        self.template_registry = template_registry
+        self.user_ids, self.course_ids = user_ids, course_ids
+        self.targeted = user_ids is not None or course_ids is not None
+        # The loaders read the staging tables while they are written, which the in-memory staging database 
+        # does not allow across connections
+        self.streaming = streaming and not IN_MEMORY_STAGING
+        if streaming and IN_MEMORY_STAGING:
+            self.logger.warning('Streaming is not available with IN_MEMORY_STAGING, running the stages one after the other')
+        # Pick up the last run if it did not finish, under its start time so the next run still brings in 
+        # everything since then, otherwise start a new run. A run resumed too many times is abandoned for
+        # a new one that still starts from its start time
+        self.ledger = Ledger(self.session)
+        self.isodatetime = isodatetime or datetime.utcnow().isoformat() # set the current time
+        if not self.targeted:
+            self.isodatetime = self.ledger.open(self.isodatetime)
+        # The staging tables of an unfinished run are kept when its TalentLMS stage had finished, the tables in 
+        # memory are gone with the process though, so that stage runs again
+        if self.ledger.is_done('talentlms') and IN_MEMORY_STAGING:
+            self.ledger.redo('talentlms')
+        if not (self.ledger.is_done('talentlms') or self.ledger.is_done('stream')):
+            try:
+                # Delete any information in the Contacts, Courses, and StudentCourseInstance from the last run
+                # This is done to only bring in newly created or updated information from TalentLMS
+                self.session.query(Contacts).delete()
+                self.session.query(Courses).delete()
+                self.session.query(StudentCourseInstance).delete()
+                self.session.commit()
+            except SQLAlchemyError as s:
+                self.logger.error(s)
+                self.session.rollback()
+                pass
+            except Exception as e:
+                self.logger.error(e, exc_info=True)
+                pass
+        self.suppressed_updates = Counter() # updates left out per object because nothing changed
 
     def run(self):
         """Main function to run the program"""
-        self.logger.info(f'--- BEGIN HOURLY UPDATE ({self.isodatetime}) ---\n')
+        self.logger.info(f'--- BEGIN {"TARGETED" if self.targeted else "HOURLY"} UPDATE ({self.isodatetime}) ---\n')
 
-        self._migrate_from_talentlms()
-        self._contacts_to_hs()
-        self._courses_to_hs()
-        self._instances_to_hs()
-        self._create_assoc()
+        # Each stage runs once the stages it needs have finished, independent ones run at the same time,
+        # the ledger skips the ones an unfinished run got through
+        stages = {name: (self.ledger.stage(name, function), dependencies) for name, (function, dependencies) in self.stages().items()}
+        self.stage_times = run_stages(stages, after_stage=self.session.remove)
+        self._log_stage_times()
         # After the program is done running, update the TimeTrack table to the start time that this program has run
-        update_time_tracking(self.isodatetime, self.session)
-        # CLose the session and engine
-        self.session.close()
-        self.engine.dispose()
+        # A targeted run leaves it alone, the next regular run still has to look at everything since the last one
+        if not self.targeted:
+            update_time_tracking(self.isodatetime, self.session)
+            self.ledger.close()
+        self.logger.info(f'Suppressed unchanged updates: {self.suppressed_updates["contacts"]} contacts, '
+                         f'{self.suppressed_updates["2-8311841"]} courses, {self.suppressed_updates["2-8311962"]} instances')
+        # CLose the session and engine, the ones handed over are kept open for the next run
+        if self.owns_engine:
+            self.session.close()
+            self.engine.dispose()
+        else:
+            self.session.remove()
+
+        self.logger.info(f'--- END {"TARGETED" if self.targeted else "HOURLY"} UPDATE ({self.isodatetime}) ---')
+
+    def stages(self):
+        """
+        The stages of a run and the stages each one needs to have finished first. Records need their
+        TalentLMS data in SQLite, and each association type needs the Hubspot ids of its two objects.
 
-        self.logger.info(f'--- END HOURLY UPDATE ({self.isodatetime}) ---')
+        In streaming mode the TalentLMS stage and the three record stages are a single stage.
 
-    def get_session(self):
+        Returns:
+            (dict): {name: (function, names of the stages it depends on)}
+        """
+        if self.streaming:
+            return {
+                    'stream': (StreamingPipeline(self).run, ()),
+                    'contact_assoc': (self._contact_assoc, ('stream',)),
+                    'course_assoc': (self._course_assoc, ('stream',))
+                    }
+        return {
+                'talentlms': (self._migrate_from_talentlms, ()),
+                'contacts': (self._contacts_to_hs, ('talentlms',)),
+                'courses': (self._courses_to_hs, ('talentlms',)),
+                'instances': (self._instances_to_hs, ('talentlms',)),
+                'contact_assoc': (self._contact_assoc, ('contacts', 'instances')),
+                'course_assoc': (self._course_assoc, ('courses', 'instances'))
+                }
+
+    def _log_stage_times(self):
+        """Logs when each stage started and ended, in seconds since the first stage started"""
+        for name, (start, end) in sorted(self.stage_times.items(), key=lambda item: item[1]):
+            self.logger.info(f'Stage {name}: {end - start:.1f}s (from {start:.1f}s to {end:.1f}s)')
+        wall = max(end for _, end in self.stage_times.values())
+        total = sum(end - start for start, end in self.stage_times.values())
+        self.logger.info(f'Stages took {wall:.1f}s, {total:.1f}s if they had run one after another\n')
+
+    @staticmethod
+    def get_session():
         """Creates a new database self.session for instant use"""
 
-        engine = create_engine(SQLITE_DB)
+        # Engine with the SQLite performance settings of models.set_sqlite_pragma
+        engine = get_engine()
+        # Create the tables and indexes the database is missing
+        init_db(engine)
         session_factory = sessionmaker(bind = engine)
         session = scoped_session(session_factory)
         return (engine, session)
         
         # GET ALL SESSIONS AND CLOSE DATABASE
 
-    def _migrate_from_talentlms(self):
-        """Migrates all data from TalentLMS to a SQLite database"""
+    def _migrate_from_talentlms(self, on_chunk=None):
+        """
+        Migrates all data from TalentLMS to a SQLite database
+
+        Args:
+            on_chunk (function): called with (model, rows) for every chunk committed to SQLite
+        """
 
         self.logger.info('-- START TALENTLMS ROUTINE --\n')
 
         self.logger.info('Retrieving data from TalentLMS...')
         # Instantiate the information needed to do API calls to TalentLMS
-        get_from_talentlms = TalentLMS(self.isodatetime, self.engine, self.session)
+        get_from_talentlms = TalentLMS(self.isodatetime, self.engine, self.session, template_registry=self.template_registry, 
+                                       on_chunk=on_chunk, user_ids=self.user_ids, course_ids=self.course_ids)
         # Lets you know the amount of information gathered from TalentLMS
-        self.logger.info(f'... Obtained {len(get_from_talentlms.all_courses.json()) if get_from_talentlms.all_courses is not None else "no"} courses from TalentLMS')
-        self.logger.info(f'... Obtained {len(get_from_talentlms.all_students.json()) if get_from_talentlms is not None else "no"} contacts from TalentLMS\n')
+        self.logger.info(f'... Obtained {len(get_from_talentlms.all_courses) or "no"} courses from TalentLMS')
+        self.logger.info(f'... Obtained {len(get_from_talentlms.all_students) or "no"} contacts from TalentLMS\n')
 
         self.logger.info('Moving Courses to SQLite database...')
         # Move course information to SQLITE database
@@ -122,6 +231,10 @@ class CurrUpdate:
         except Exception as e:
             self.logger.error(e, exc_info=True)
             pass
+        # Lets you know how close the run came to the TalentLMS rate limit
+        rate_stats = get_talentlms_http().rate_limiter.report()
+        self.logger.info(f"...Waited {rate_stats['waited']:.1f}s on the TalentLMS rate limiter over {rate_stats['requests']} requests "
+                         f"(ending rate {rate_stats['rate']:.2f} requests/s)\n")
         self.logger.info('-- END TALENTLMS ROUTINE --\n')
 
     def _contacts_to_hs(self):
@@ -132,20 +245,24 @@ class CurrUpdate:
         self.logger.info('Creating contacts on Hubspot...')
         # Instantiates a Contacts Recrd to be created
         create_contact = CreateRecordsHandler('contacts', self.session)
-        # Creates the contact creation payload
-        create_contact_payload = create_obj_payload(os.path.join(output_path, 'contacts_create.sql'), self.engine)
-        # Create on Hubspot
-        create_contact.dispatch(create_contact_payload)
+        # Creates the contact creation payloads in batches and creates them on Hubspot as they are read
+        for create_contact_payload in iter_create_obj_payload(self.queries['contacts_create'], self.engine):
+            res = create_contact.dispatch(create_contact_payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints('contacts', create_contact_payload, self.session, res):
+                self.ledger.ack('contacts')
         self.logger.info('...Finished creating contacts.\n')
 
         self.logger.info('Updating contacts on Hubspot...')
         # Instantiates a Contacts Recrd to be uploaded
         update_contact = UpdateRecordsHandler('contacts')
-        # Creates the contact upload payload
-        update_contact_payload = update_obj_payload(os.path.join(output_path, 'contacts_update.sql'), 'contacts', \
-            self.engine)
-        # Upload to Hubspot
-        update_contact.dispatch(update_contact_payload)
+        # Creates the contact upload payloads in batches and uploads them to Hubspot as they are read
+        for update_contact_payload in iter_update_obj_payload(self.queries['contacts_update'], 'contacts', \
+                self.engine, suppressed=self.suppressed_updates):
+            res = update_contact.dispatch(update_contact_payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints('contacts', update_contact_payload, self.session, res):
+                self.ledger.ack('contacts')
         self.logger.info('...Finished updating contacts.\n')
 
         self.logger.info('-- END HUBSPOT CONTACTS ROUTINE --\n')
@@ -158,15 +275,21 @@ class CurrUpdate:
         self.logger.info('Creating courses on Hubspot...')
         # Instantiates a Coourses Recrd to be created
         create_course = CreateRecordsHandler('2-8311841', self.session)
-        create_course_payload = create_obj_payload(os.path.join(output_path, 'courses_create.sql'), self.engine)
-        create_course.dispatch(create_course_payload)
+        for create_course_payload in iter_create_obj_payload(self.queries['courses_create'], self.engine):
+            res = create_course.dispatch(create_course_payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints('2-8311841', create_course_payload, self.session, res):
+                self.ledger.ack('courses')
         self.logger.info('...Finished creating courses.\n')
 
         self.logger.info('Updating course on Hubspot...')
         update_course = UpdateRecordsHandler('2-8311841')
-        update_course_payload = update_obj_payload(os.path.join(output_path, 'courses_update.sql'),  '2-8311841', \
-            self.engine)
-        update_course.dispatch(update_course_payload)
+        for update_course_payload in iter_update_obj_payload(self.queries['courses_update'],  '2-8311841', \
+                self.engine, suppressed=self.suppressed_updates):
+            res = update_course.dispatch(update_course_payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints('2-8311841', update_course_payload, self.session, res):
+                self.ledger.ack('courses')
         self.logger.info('...Finished updating courses.\n')
 
         self.logger.info('-- END HUBSPOT COURSES ROUTINE --\n')
@@ -178,50 +301,159 @@ class CurrUpdate:
 
         self.logger.info('Creating instances on Hubspot...')
         create_instance = CreateRecordsHandler('2-8311962', self.session)
-        create_instance_payload = create_obj_payload(os.path.join(output_path, 'instances_create.sql'), self.engine)
-        create_instance.dispatch(create_instance_payload)
+        for create_instance_payload in iter_create_obj_payload(self.queries['instances_create'], self.engine):
+            res = create_instance.dispatch(create_instance_payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints('2-8311962', create_instance_payload, self.session, res):
+                self.ledger.ack('instances')
         self.logger.info('...Finished creating instances.\n')
 
         self.logger.info('Updating instances on Hubspot...')
         update_instance = UpdateRecordsHandler('2-8311962')
-        update_instance_payload = update_obj_payload(os.path.join(output_path, 'instances_update.sql'),  '2-8311962', \
-            self.engine)
-        update_instance.dispatch(update_instance_payload)
+        for update_instance_payload in iter_update_obj_payload(self.queries['instances_update'],  '2-8311962', \
+                self.engine, suppressed=self.suppressed_updates):
+            res = update_instance.dispatch(update_instance_payload)
+            # Remember what Hubspot accepted so unchanged records are not sent again
+            if save_fingerprints('2-8311962', update_instance_payload, self.session, res):
+                self.ledger.ack('instances')
         self.logger.info('...Finished updating instances.\n')
 
         self.logger.info('-- END HUBSPOT INSTANCES  ROUTINE --\n')
 
-    def _create_assoc(self):
-        """
-        Creates Hubspot Associations between the contacts and student_course_instance records
-        Creates Hubspot Associations between the courses and student_course_instance records
-        """
+    def _contact_assoc(self):
+        """Creates Hubspot Associations between the contacts and student_course_instance records"""
 
-        self.logger.info('-- START HUBSPOT ASSOCIATIONS ROUTINE --')
+        self.logger.info('-- START HUBSPOT CONTACT ASSOCIATIONS ROUTINE --')
 
         self.logger.info('Associating Contacts to Instances on Hubspot...')
         # Instantiates an Associations Object for contacts and student_class_instance
         contact_instance_assoc = CreateAssociationsHandler('contact','2-8311962')
-        # Create the association payload for contacts and student_class_instance
-        contact_instance_payload = create_assoc_payload(os.path.join(output_path, 'assoc_contact_instance.sql'),  \
-            'student_class_instance_to_contact', self.engine)
-        # Create the association on Hubspot
-        contact_instance_assoc.dispatch(contact_instance_payload)
+        # Create the association payloads for contacts and student_class_instance and create them on Hubspot batch by batch
+        for contact_instance_payload in iter_assoc_payload(self.queries['assoc_contact_instance'],  \
+                'student_class_instance_to_contact', self.engine):
+            res = contact_instance_assoc.dispatch(contact_instance_payload)
+            # Record the pairs Hubspot confirmed so they are not sent again on the next run
+            if save_associations(contact_instance_payload, self.session, res):
+                self.ledger.ack('contact_assoc')
         self.logger.info('...Finished associating Contacts to Instances.\n')
 
+        self.logger.info(f'-- END HUBSPOT CONTACT ASSOCIATIONS ROUTINE --{datetime.utcnow().isoformat()} \n')
+
+    def _course_assoc(self):
+        """Creates Hubspot Associations between the courses and student_course_instance records"""
+
+        self.logger.info('-- START HUBSPOT COURSE ASSOCIATIONS ROUTINE --')
+
         self.logger.info('Associating Courses to Instances on Hubspot...')
         # Instantiates an Associations Object for courses and student_class_instance
         course_instance_assoc = CreateAssociationsHandler('2-8311841', '2-8311962')
-        # Create the association payload for courses and student_class_instance
-        course_instance_payload = create_assoc_payload(os.path.join(output_path, 'assoc_courses_instance.sql'),  \
-            'course_to_student_class_instance', self.engine)
-        # Create the association on Hubspot
-        course_instance_assoc.dispatch(course_instance_payload)
+        # Create the association payloads for courses and student_class_instance and create them on Hubspot batch by batch
+        for course_instance_payload in iter_assoc_payload(self.queries['assoc_courses_instance'],  \
+                'course_to_student_class_instance', self.engine):
+            res = course_instance_assoc.dispatch(course_instance_payload)
+            # Record the pairs Hubspot confirmed so they are not sent again on the next run
+            if save_associations(course_instance_payload, self.session, res):
+                self.ledger.ack('course_assoc')
         self.logger.info('...Finished associating Courses to Instances.\n')
 
-        self.logger.info(f'-- END HUBSPOT ASSOCIATIONS  ROUTINE --{datetime.utcnow().isoformat()} \n')
+        self.logger.info(f'-- END HUBSPOT COURSE ASSOCIATIONS ROUTINE --{datetime.utcnow().isoformat()} \n')
+
+
+@contextmanager
+def cycle_lock(lock_file=LOCK_FILE):
+    """
+    Holds an exclusive flock on the lock file while a run goes, the same lock the cron job takes with
+    /usr/bin/flock, so two runs never overlap
+
+    Args:
+        lock_file (str): path of the lock file
+
+    Yields:
+        (bool): True if the lock was taken, False if another run holds it
+    """
+    with open(lock_file, 'a') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class Daemon:
+    """
+    Runs CurrUpdate cycles in a single long running process, keeping the engine, the compiled queries,
+    the course templates and the HTTP connection pools warm between cycles instead of paying for a cold
+    start every time. Cycles start every interval seconds and never overlap, a cycle that runs over the
+    interval is followed right away by the next one. SIGTERM or SIGINT stops the daemon once the 
+    current cycle has finished.
+    """
+
+    def __init__(self, interval=DAEMON_INTERVAL, lock_file=LOCK_FILE, streaming=False):
+        """
+        Args:
+            interval (int): seconds between the start of two cycles
+            lock_file (str): path of the lock file shared with the cron job
+            streaming (bool): run the cycles in streaming mode
+        """
+        self.interval = interval
+        self.lock_file = lock_file
+        self.streaming = streaming
+        self.logger = get_logger('CurrUpdate')
+        self.stopping = Event() # set by stop() to end the loop
+        self.engine, self.session = CurrUpdate.get_session()
+        self.queries = QueryRegistry(self.engine)
+        self.template_registry = CourseTemplateRegistry(self.session)
+
+    def stop(self, signum=None, frame=None):
+        """Signal handler asking the daemon to stop once the current cycle is done"""
+        self.logger.info(f'Received signal {signum}, stopping after the current cycle')
+        self.stopping.set()
+
+    def run_cycle(self):
+        """Runs one CurrUpdate cycle with the warm resources unless another run holds the lock"""
+        with cycle_lock(self.lock_file) as locked:
+            if not locked:
+                self.logger.info('Another run holds the lock, skipping this cycle')
+                return
+            try:
+                CurrUpdate(engine=self.engine, session=self.session, queries=self.queries, 
+                           template_registry=self.template_registry, streaming=self.streaming).run()
+            except Exception as e:
+                # Keep the daemon alive, the next cycle tries again
+                self.logger.error(e, exc_info=True)
+
+    def serve(self):
+        """Runs cycles until a SIGTERM or SIGINT arrives, then releases the database"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.logger.info(f'Starting the daemon, a cycle every {self.interval}s')
+        while not self.stopping.is_set():
+            started = monotonic()
+            self.run_cycle()
+            # Wake up early if a signal arrives while waiting for the next cycle
+            self.stopping.wait(max(0, self.interval - (monotonic() - started)))
+        self.session.remove()
+        self.engine.dispose()
+        self.logger.info('Daemon stopped')
+
+
+def main(argv=None):
+    """Runs a single update, or cycles of updates with --daemon"""
+    parser = argparse.ArgumentParser(description='Moves TalentLMS student and course data to Hubspot')
+    parser.add_argument('--daemon', action='store_true', help='keep running and start a cycle every --interval seconds')
+    parser.add_argument('--interval', type=int, default=DAEMON_INTERVAL, help='seconds between the start of two cycles')
+    parser.add_argument('--streaming', action='store_true', help='send records to Hubspot while TalentLMS is still being read')
+    args = parser.parse_args(argv)
+    if args.daemon:
+        Daemon(args.interval, streaming=args.streaming).serve()
+    else:
+        integration = CurrUpdate(streaming=args.streaming)
+        integration.run()
 
 
 if __name__ == '__main__':
-    integration = CurrUpdate()
-    integration.run()
+    main()
@@ -0,0 +1,172 @@
+"""Module to keep the course templates (options of the course_template_name property on Hubspot) locally"""
+import logging
+import os
+
+from time import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import CourseTemplate
+from hubapi import read_property, add_value_to_property
+from transform import hubspot_accepted
+
+# 2-8311841 is the internal ID of courses object on HS
+# 2-8311962 is the internal ID of the student_course_instance object on HS
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+# Seconds the local copy of the course templates is used for before it is read again from Hubspot
+TEMPLATE_TTL = int(os.getenv('TEMPLATE_TTL', 60 * 60))
+# Objects whose course_template_name property gets the new course templates
+TEMPLATE_OBJECTS = ('2-8311841', '2-8311962')
+
+
+class CourseTemplateRegistry:
+    """
+    Keeps the course templates indexed both ways, {course code: course name} and {course name: course code},
+    and saved in the course_template table. Hubspot is only read when the saved copy is older than the TTL
+    or when a code or name is missing, and then at most once per load. New templates are queued and added
+    to Hubspot together by flush() so finding them does not wait on Hubspot.
+    """
+
+    def __init__(self, session, ttl=TEMPLATE_TTL):
+        """
+        Args:
+            session (class): scoped_session object, and it represents a registry of Session
+                objects: which manages persistence operations for ORM-mapped objects.
+            ttl (int): seconds the saved copy is used for before it is read again from Hubspot
+        """
+        self.session = session
+        self.ttl = ttl
+        self.labels = {} # {course code: course name}
+        self.codes = {} # {course name: course code}
+        self.refreshed = False # True once Hubspot has been read since the last load
+        self.pending = [] # (object type, new option) pairs waiting to be added to Hubspot by flush()
+
+    def load(self):
+        """Loads the saved copy of the course templates, or reads them from Hubspot if it is empty or stale"""
+        self.refreshed = False
+        try:
+            templates = self.session.query(CourseTemplate).all()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            templates = []
+        if not templates or min(template.refreshed_at for template in templates) < time() - self.ttl:
+            self.refresh()
+            return
+        self._index((template.code, template.label) for template in templates)
+
+    def refresh(self):
+        """Reads the options of the course_template_name property from Hubspot and saves them"""
+        # Get all the values from the property: course_template_name
+        course_template_name_payload = read_property('2-8311841', 'course_template_name').json()
+        options = [(option['value'], option['label']) for option in course_template_name_payload['options']]
+        self._index(options)
+        self.refreshed = True
+        now = int(time())
+        try:
+            self.session.query(CourseTemplate).delete()
+            self.session.add_all([CourseTemplate(code=code, label=label, refreshed_at=now) for code, label in options])
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            pass
+
+    def has_code(self, code, refresh=True):
+        """
+        Checks if a course code is a course template on Hubspot
+
+        Args:
+            code (str): course template code
+            refresh (bool): read Hubspot again if the code is not in the local copy, only worth it when
+                a miss leads to adding the template
+
+        Returns:
+            (bool): True if the code is an internal name of the course_template_name property
+        """
+        if refresh and code not in self.labels:
+            self._refresh_on_miss()
+        return code in self.labels
+
+    def code_of(self, label):
+        """
+        Finds the course code of a course template from its name
+
+        Args:
+            label (str): course template name without (Template)
+
+        Returns:
+            (str): the course code, or None if no course template has this name
+        """
+        if label not in self.codes:
+            self._refresh_on_miss()
+        return self.codes.get(label)
+
+    def add(self, code, label):
+        """
+        Adds a new course template to the local indexes right away and queues it to be added to the
+        course_template_name property on Hubspot when flush() is called
+
+        Args:
+            code (str): course template code, used as the internal name of the option
+            label (str): course template name, used as the UI name of the option
+        """
+        self._index([(code, label)], replace=False)
+        add_value = {
+                    "label": label,
+                    "value": code
+                    }
+        self.pending.extend((object_type, add_value) for object_type in TEMPLATE_OBJECTS)
+
+    def flush(self):
+        """
+        Adds the queued course templates to the course_template_name property of the courses and
+        student_course_instance objects on Hubspot, then saves the ones both objects accepted locally.
+        The options Hubspot refused stay queued for the next flush, and a new process adds them again
+        since they are not in the saved copy.
+        """
+        if not self.pending:
+            return
+        logger.info(f'Adding {len({add_value["value"] for _, add_value in self.pending})} new course templates to Hubspot...')
+        failed = []
+        for object_type, add_value in self.pending:
+            try:
+                res = add_value_to_property(object_type, 'course_template_name', add_value)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                res = None
+            if not hubspot_accepted(res):
+                failed.append((object_type, add_value))
+        refused = {add_value['value'] for _, add_value in failed}
+        added = {add_value['value']: add_value for _, add_value in self.pending if add_value['value'] not in refused}
+        self.pending = failed
+        if refused:
+            logger.error(f'Hubspot did not add the course templates {", ".join(sorted(refused))}, keeping them for the next flush')
+        now = int(time())
+        try:
+            for add_value in added.values():
+                self.session.merge(CourseTemplate(code=add_value['value'], label=add_value['label'], refreshed_at=now))
+            self.session.commit()
+        except SQLAlchemyError as s:
+            logger.error(s, exc_info=True)
+            self.session.rollback()
+            pass
+
+    def _refresh_on_miss(self):
+        """Reads Hubspot again in case the template was added there since the last refresh"""
+        if not self.refreshed:
+            self.refresh()
+
+    def _index(self, options, replace=True):
+        """Indexes (course code, course name) pairs, replacing what was there unless replace is False"""
+        if replace:
+            self.labels = {}
+            self.codes = {}
+        for code, label in options:
+            self.labels[code] = label
+            # Later options win, like looking the name up in the option list from the start
+            self.codes[label] = code
@@ -0,0 +1,283 @@
+"""
+Fakes of TalentLMS and Hubspot shared by the tests, so whole runs go through a temporary SQLite database
+without reaching the network. hubapi.py is not part of this repository, the fake module below stands in
+for it with the same handlers and functions.
+"""
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import types
+
+from threading import Lock
+
+import pytest
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# get_logger only sets up its file, console and papertrail handlers on a logger without any, the records
+# still reach pytest's caplog through the root logger
+logging.getLogger('CurrUpdate').addHandler(logging.NullHandler())
+
+
+class FakeResponse:
+    """Response of a Hubspot request"""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeHubspot:
+    """Records every request sent to Hubspot and answers them the way Hubspot does"""
+
+    def __init__(self):
+        self.ids = itertools.count(1000)
+        self.lock = Lock()
+        self.dispatched = [] # (kind, object, inputs) of every dispatch
+        self.options = [{'value': 'ABC0', 'label': 'Course & 12'}] # options of course_template_name
+        self.crashes = {} # {(kind, object): dispatches let through before raising}
+        self.refused = set() # (kind, object) of the requests answered with a 400
+
+    def crash(self, kind, obj, after=0):
+        """Makes the dispatches of a kind of request to an object raise after the first few"""
+        self.crashes[(kind, obj)] = after
+
+    def record(self, kind, obj, payload):
+        with self.lock:
+            if (kind, obj) in self.crashes:
+                if self.crashes[(kind, obj)] <= 0:
+                    raise RuntimeError(f'Hubspot is down for {kind} {obj}')
+                self.crashes[(kind, obj)] -= 1
+            self.dispatched.append((kind, obj, payload['inputs']))
+
+    def refuse(self, kind, obj):
+        """Makes Hubspot answer the requests of a kind to an object with a 400"""
+        self.refused.add((kind, obj))
+
+    def refusal(self, kind, obj):
+        """The 400 answer to a refused request, None if the request goes through"""
+        if (kind, obj) in self.refused:
+            return FakeResponse(400, {'status': 'error', 'message': 'Property values were not valid', 'category': 'VALIDATION_ERROR'})
+        return None
+
+    def sent(self, kind, obj=None):
+        """Inputs sent in the requests of a kind, to one object or all of them"""
+        return [record for k, o, inputs in self.dispatched if k == kind and obj in (None, o) for record in inputs]
+
+
+def fake_hubapi():
+    """Module with the handlers and functions of hubapi, answered by hubapi.hubspot"""
+    module = types.ModuleType('hubapi')
+    module.hubspot = FakeHubspot()
+
+    class CreateRecordsHandler:
+        def __init__(self, obj, session):
+            self.obj, self.session = obj, session
+
+        def dispatch(self, payload):
+            import transform
+            module.hubspot.record('create', self.obj, payload)
+            refusal = module.hubspot.refusal('create', self.obj)
+            if refusal is not None:
+                return refusal
+            res = FakeResponse(201, {'status': 'COMPLETE', 'results': [
+                    {'id': str(next(module.hubspot.ids)), 'properties': {key: str(value) for key, value in record['properties'].items() if value is not None}}
+                    for record in payload['inputs']]})
+            transform.gather_batch_hs_id(self.obj, res, self.session)
+            return res
+
+    class UpdateRecordsHandler:
+        def __init__(self, obj):
+            self.obj = obj
+
+        def dispatch(self, payload):
+            module.hubspot.record('update', self.obj, payload)
+            refusal = module.hubspot.refusal('update', self.obj)
+            if refusal is not None:
+                return refusal
+            return FakeResponse(200, {'status': 'COMPLETE', 'results': [{'id': str(record['id'])} for record in payload['inputs']]})
+
+    class CreateAssociationsHandler:
+        def __init__(self, from_object, to_object):
+            self.obj = from_object
+
+        def dispatch(self, payload):
+            module.hubspot.record('assoc', self.obj, payload)
+            refusal = module.hubspot.refusal('assoc', self.obj)
+            if refusal is not None:
+                return refusal
+            return FakeResponse(201, {'status': 'COMPLETE', 'results': [
+                    {'from': {'id': assoc['from']['id']}, 'to': [{'id': assoc['to']['id']}], 'type': assoc['type']}
+                    for assoc in payload['inputs']]})
+
+    def read_property(obj, name):
+        return FakeResponse(200, {'options': list(module.hubspot.options)})
+
+    def add_value_to_property(obj, name, value):
+        module.hubspot.options.append(value)
+        return FakeResponse(200, value)
+
+    module.CreateRecordsHandler = CreateRecordsHandler
+    module.UpdateRecordsHandler = UpdateRecordsHandler
+    module.CreateAssociationsHandler = CreateAssociationsHandler
+    module.read_property = read_property
+    module.add_value_to_property = add_value_to_property
+    return module
+
+
+sys.modules['hubapi'] = fake_hubapi()
+
+import models
+import talentlmsapi
+
+from task import CurrUpdate
+
+
+class FakeTalentLMS(BaseAdapter):
+    """
+    Transport answering the TalentLMS API from generated users and courses: every fourth course is a template
+    and each user is enrolled in the courses whose id adds up with theirs to a multiple of three
+    """
+
+    def __init__(self, users=60, courses=8):
+        super().__init__()
+        self.users = [{'id': str(i), 'login': f'user{i}', 'first_name': f'First{i}', 'last_name': f'Last{i}', 'email': f'user{i}@example.com',
+                       'status': 'active', 'last_updated_timestamp': str(1600000000 + i), 'custom_field_4': 'cohort'}
+                      for i in range(1, users + 1)]
+        self.courses = [{'id': str(c), 'name': f'Course &amp; {c}' + (' (Template)' if c % 4 == 0 else ''),
+                         'code': f'01ABC{c % 3}-' + ('T' if c % 4 == 0 else '22'), 'description': 'description',
+                         'last_update_on': '05/04/2022, 13:45:31', 'custom_field_3': '12/01/2022', 'custom_field_4': '2022-12-05',
+                         'custom_field_5': '12/03/2022 6:00 PM', 'custom_field_6': None, 'custom_field_7': 'cohort'}
+                        for c in range(1, courses + 1)]
+        self.enrollments = {course['id']: [user['id'] for user in self.users if (int(user['id']) + int(course['id'])) % 3 == 0]
+                            for course in self.courses}
+        self.requests = [] # paths requested
+        self.failures = {} # {path: (status code, raw body)} answered instead of the records
+        self.timelines = {} # {unit id: user ids} of the timelines that differ from half the course's students
+
+    def send(self, request, **kwargs):
+        path = request.url.split('.talentlms.com/')[1]
+        self.requests.append(path)
+        res = Response()
+        try:
+            res.status_code, body = 200, self.route(path)
+        except KeyError:
+            res.status_code, body = 404, {'error': {'type': 'not_found', 'message': 'The requested record does not exist'}}
+        res._content = json.dumps(body).encode()
+        if path in self.failures:
+            res.status_code, res._content = self.failures[path]
+        res.raw = io.BytesIO(res._content)
+        res.headers['Content-Type'] = 'application/json'
+        res.encoding = 'utf-8'
+        res.url = request.url
+        res.request = request
+        return res
+
+    def close(self):
+        pass
+
+    def route(self, path):
+        if path == 'api/v1/users/':
+            return self.users
+        if path == 'api/v1/courses/':
+            return self.courses
+        match = re.fullmatch(r'api/v1/users/id:(\d+)', path)
+        if match:
+            return self.user_detail(match.group(1))
+        match = re.fullmatch(r'api/v1/courses/id:(\d+)', path)
+        if match:
+            return self.course_detail(match.group(1))
+        match = re.fullmatch(r'api/v1/gettimeline/event_type:[^,]+,unit_id:(\d+)', path)
+        if match:
+            user_ids = self.timelines.get(match.group(1), self.enrollments[str(int(match.group(1)) // 10)][::2])
+            return [{'user_id': user_id, 'timestamp': '1650000000'} for user_id in user_ids]
+        raise KeyError(path)
+
+    @staticmethod
+    def find(records, record_id):
+        for record in records:
+            if record['id'] == record_id:
+                return record
+        raise KeyError(record_id)
+
+    def user_detail(self, user_id):
+        user = dict(self.find(self.users, user_id))
+        user['courses'] = [{'id': course['id'], 'name': course['name'], 'completed_on_timestamp': '1650000000' if int(user_id) % 2 else None,
+                            'completion_status': 'completed', 'completion_percentage': '50', 'role': 'learner', 'total_time': '1h',
+                            'total_time_seconds': 3600, 'last_accessed_unit_url': 'https://example.com'}
+                           for course in self.courses if user_id in self.enrollments[course['id']]]
+        return user
+
+    def course_detail(self, course_id):
+        course = dict(self.find(self.courses, course_id))
+        course['units'] = [{'id': str(int(course_id) * 10), 'type': 'Assignment'}, {'id': str(int(course_id) * 10 + 1), 'type': 'Test'}]
+        course['users'] = [{'id': user_id} for user_id in self.enrollments[course_id]]
+        return course
+
+
+@pytest.fixture
+def talentlms(monkeypatch):
+    """Fake TalentLMS behind the session every TalentLMS request goes through, without its rate limit"""
+    fake = FakeTalentLMS()
+    http = talentlmsapi.RateLimitedSession(talentlmsapi.BASE_URL, talentlmsapi.RateLimiter(rate=10000, capacity=10000))
+    http.mount(talentlmsapi.BASE_URL, fake)
+    monkeypatch.setattr(talentlmsapi, '_talentlms_http', http)
+    return fake
+
+
+@pytest.fixture
+def hubspot():
+    """Fake Hubspot of the hubapi module, fresh for each test"""
+    sys.modules['hubapi'].hubspot = FakeHubspot()
+    return sys.modules['hubapi'].hubspot
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    """Creates databases as the integration sets them up, each with its engine and scoped session"""
+    created = []
+
+    def make(name='integration'):
+        engine = models.get_engine(f'sqlite:///{tmp_path / name}.db')
+        models.init_db(engine)
+        with engine.begin() as con:
+            con.execute(text('INSERT INTO time_tracking VALUES (0)'))
+        session = scoped_session(sessionmaker(bind=engine))
+        created.append((engine, session))
+        return engine, session
+
+    yield make
+    for engine, session in created:
+        session.remove()
+        engine.dispose()
+
+
+@pytest.fixture
+def db(make_db):
+    return make_db()
+
+
+def run_update(db, isodatetime, **kwargs):
+    """Runs a CurrUpdate on the database and gives it back"""
+    engine, session = db
+    update = CurrUpdate(isodatetime, engine=engine, session=session, **kwargs)
+    update.run()
+    return update
+
+
+def fetch(db, statement):
+    """Rows of a query on the database"""
+    with db[0].connect() as con:
+        return con.execute(text(statement)).fetchall()
@@ -0,0 +1,61 @@
+"""Course detail cache: which runs request the course details from TalentLMS again"""
+import time
+
+from cache import DetailCache
+from conftest import fetch, run_update
+from models import CourseDetailCache
+
+
+def course_requests(talentlms):
+    return sorted(path for path in talentlms.requests if path.startswith('api/v1/courses/id:'))
+
+
+def test_unchanged_courses_are_served_from_the_cache(db, talentlms, hubspot):
+    run_update(db, '2022-12-01T00:00:00')
+    assert len(course_requests(talentlms)) == 8
+    assert len(fetch(db, 'SELECT * FROM course_detail_cache')) == 8
+
+    talentlms.requests.clear()
+    talentlms.courses[2]['last_update_on'] = '06/04/2022, 10:00:00'
+    run_update(db, '2022-12-01T00:15:00')
+    # Only the course whose last_update_on moved is requested again
+    assert course_requests(talentlms) == ['api/v1/courses/id:3']
+    assert fetch(db, 'SELECT count(*) FROM student_course_instance') == [(160,)]
+
+
+def test_entries_older_than_max_age_are_requested_again(db, talentlms, hubspot):
+    run_update(db, '2022-12-01T00:00:00')
+    with db[0].begin() as con:
+        con.exec_driver_sql('UPDATE course_detail_cache SET fetched_at = fetched_at - 4 * 60 * 60 WHERE talentlms_course_id = 5')
+    talentlms.requests.clear()
+    run_update(db, '2022-12-01T00:15:00')
+    assert course_requests(talentlms) == ['api/v1/courses/id:5']
+
+
+def test_save_evicts_deleted_and_least_recently_used_entries(db):
+    session = db[1]
+    cache = DetailCache(CourseDetailCache, 'talentlms_course_id', 'last_update_on', session, max_entries=2)
+    for course_id in (1, 2, 3, 4):
+        cache.put(course_id, 'v1', {'units': [], 'users': []})
+    session.commit()
+    session.query(CourseDetailCache).filter(CourseDetailCache.talentlms_course_id.in_([1, 3]))\
+        .update({'last_accessed': int(time.time()) + 10})
+    cache.save(live_ids=['1', '2', '3'])
+    # Course 4 is gone from TalentLMS, and of the rest only the two most recently used are kept
+    assert fetch(db, 'SELECT talentlms_course_id FROM course_detail_cache ORDER BY 1') == [(1,), (3,)]
+
+
+def test_changed_version_is_a_miss(db):
+    cache = DetailCache(CourseDetailCache, 'talentlms_course_id', 'last_update_on', db[1])
+    cache.put(1, 'v1', {'units': [{'id': '10', 'type': 'Assignment'}], 'users': []})
+    assert cache.get(1, 'v1') == {'units': [{'id': '10', 'type': 'Assignment'}], 'users': []}
+    assert cache.get(1, 'v2') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_empty_live_list_evicts_nothing(db):
+    cache = DetailCache(CourseDetailCache, 'talentlms_course_id', 'last_update_on', db[1])
+    for course_id in (1, 2):
+        cache.put(course_id, 'v1', {'units': [], 'users': []})
+    cache.save(live_ids=[])
+    assert fetch(db, 'SELECT count(*) FROM course_detail_cache') == [(2,)]
@@ -0,0 +1,69 @@
+"""Resuming and abandoning unfinished runs through the run ledger"""
+import time
+
+import pytest
+
+from conftest import fetch, run_update
+from ledger import Ledger, LEDGER_MAX_RESUMES, RUN
+from models import RunLedger
+from task import CurrUpdate
+
+
+def run_status(db):
+    return fetch(db, "SELECT run_id, status, since, resumes FROM run_ledger WHERE stage = 'run' ORDER BY started_at, run_id")
+
+
+def test_crashed_run_resumes_from_the_unconfirmed_batch(db, talentlms, hubspot):
+    # 160 course associations go out in batches of 100, the second batch never reaches Hubspot
+    hubspot.crash('assoc', '2-8311841', after=1)
+    with pytest.raises(RuntimeError):
+        run_update(db, '2022-12-01T00:00:00')
+    assert run_status(db) == [('2022-12-01T00:00:00', 'running', '2022-12-01T00:00:00', 0)]
+    assert len(hubspot.sent('assoc', '2-8311841')) == 100
+
+    hubspot.crashes.clear()
+    hubspot.dispatched.clear()
+    update = run_update(db, '2022-12-02T00:00:00')
+
+    # Picked up under the start time of the crashed run, only the 60 associations left are sent
+    assert update.ledger.resumed and update.isodatetime == '2022-12-01T00:00:00'
+    assert [(kind, obj) for kind, obj, _ in hubspot.dispatched] == [('assoc', '2-8311841')]
+    assert len(hubspot.sent('assoc')) == 60
+    assert run_status(db) == [('2022-12-01T00:00:00', 'done', '2022-12-01T00:00:00', 1)]
+    assert fetch(db, 'SELECT count(*) FROM association_history') == [(320,)]
+    assert fetch(db, 'SELECT last_modified_time FROM time_tracking') == [(1669852800000,)]
+
+
+def test_run_resumed_too_often_is_abandoned(db, talentlms, hubspot):
+    hubspot.crash('assoc', 'contact')
+    starts = []
+    for day in range(1, LEDGER_MAX_RESUMES + 3):
+        update = CurrUpdate(f'2022-12-0{day}T00:00:00', engine=db[0], session=db[1])
+        starts.append(update.isodatetime)
+        with pytest.raises(RuntimeError):
+            update.run()
+
+    # The first run is resumed LEDGER_MAX_RESUMES times, then a new run takes over its start time
+    first, last = '2022-12-01T00:00:00', f'2022-12-0{LEDGER_MAX_RESUMES + 2}T00:00:00'
+    assert run_status(db) == [(first, 'abandoned', first, LEDGER_MAX_RESUMES), (last, 'running', first, 0)]
+    # Every one of them brings in the changes since the start of the first run
+    assert starts == [first] * (LEDGER_MAX_RESUMES + 2)
+
+    # Once Hubspot is back the new run finishes and the time tracking covers everything since the first run
+    hubspot.crashes.clear()
+    update = run_update(db, '2022-12-09T00:00:00')
+    assert update.isodatetime == first
+    assert run_status(db)[-1] == (last, 'done', first, 1)
+    assert fetch(db, 'SELECT last_modified_time FROM time_tracking') == [(1669852800000,)]
+
+
+def test_old_unfinished_run_is_abandoned(db):
+    session = db[1]
+    assert Ledger(session).open('2022-12-01T00:00:00') == '2022-12-01T00:00:00'
+    session.query(RunLedger).filter(RunLedger.stage == RUN).update({'started_at': int(time.time()) - 7 * 60 * 60})
+    session.commit()
+
+    ledger = Ledger(session)
+    assert ledger.open('2022-12-01T07:00:00', max_age=6 * 60 * 60) == '2022-12-01T00:00:00'
+    assert not ledger.resumed and ledger.run_id == '2022-12-01T07:00:00'
+    assert [row[:2] for row in run_status(db)] == [('2022-12-01T00:00:00', 'abandoned'), ('2022-12-01T07:00:00', 'running')]
@@ -0,0 +1,110 @@
+"""Streaming mode: records sent to Hubspot while TalentLMS is still being read"""
+import sqlite3
+
+from collections import Counter
+from functools import partial
+from threading import Thread
+
+import pytest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from conftest import fetch, run_update
+from models import Contacts
+from pipeline import restrict_queries, restrict_query, StreamingPipeline, STREAMS
+from queries import QueryRegistry
+from talentlmsapi import TalentLMS
+
+
+def sent_records(hubspot):
+    """What was sent per request kind and object, leaving out the Hubspot ids that differ between databases"""
+    sent = {}
+    for kind, obj, inputs in hubspot.dispatched:
+        sent.setdefault((kind, obj), Counter()).update(
+                repr(sorted(record['properties'].items())) if 'properties' in record else record['type'] for record in inputs)
+    return sent
+
+
+def history(db):
+    return {
+            'contacts': fetch(db, 'SELECT talentlms_user_id, property_hash FROM contact_hs_history ORDER BY 1'),
+            'courses': fetch(db, 'SELECT talentlms_course_id, property_hash FROM course_hs_history ORDER BY 1'),
+            'instances': fetch(db, 'SELECT talentlms_user_id, talentlms_course_id, property_hash FROM instance_history ORDER BY 1, 2'),
+            'associations': fetch(db, 'SELECT assoc_type, count(*) FROM association_history GROUP BY 1 ORDER BY 1')
+            }
+
+
+def test_streaming_sends_the_same_records(make_db, talentlms, hubspot, monkeypatch):
+    # Small chunks so the loaders get several of them while TalentLMS is still being read
+    monkeypatch.setattr('task.TalentLMS', partial(TalentLMS, chunk_size=25))
+    staged, streamed = make_db('staged'), make_db('streamed')
+
+    options = list(hubspot.options)
+    run_update(staged, '2022-12-01T00:00:00')
+    sent_staged = sent_records(hubspot)
+    # The streamed run starts from the same Hubspot, without the template options the staged run added
+    hubspot.dispatched.clear()
+    hubspot.options[:] = options
+    update = run_update(streamed, '2022-12-01T00:00:00', streaming=True)
+
+    assert update.ledger.is_done('stream')
+    assert sent_records(hubspot) == sent_staged
+    assert history(streamed) == history(staged)
+    assert len(fetch(streamed, 'SELECT * FROM instance_history')) == 160
+
+    # A second run has nothing new to send either way
+    hubspot.dispatched.clear()
+    run_update(streamed, '2022-12-02T00:00:00', streaming=True)
+    assert hubspot.sent('create') == [] and hubspot.sent('assoc') == []
+
+
+def test_extraction_waits_for_a_loader_that_is_behind():
+    pipeline = StreamingPipeline(update=None, queue_size=1)
+    chunks = [[{'talentlms_user_id': 1}], [{'talentlms_user_id': 2}]]
+    extraction = Thread(target=lambda: [pipeline.notify(Contacts, chunk) for chunk in chunks], daemon=True)
+    extraction.start()
+
+    # The second chunk waits until the loader has taken the first one
+    extraction.join(0.3)
+    assert extraction.is_alive()
+    assert pipeline.queues['contacts'].get() == [(1,)]
+    extraction.join(1)
+    assert not extraction.is_alive()
+    assert pipeline.queues['contacts'].get() == [(2,)]
+
+
+def test_failed_loader_fails_the_stage_and_the_next_run_resumes(db, talentlms, hubspot):
+    hubspot.crash('create', 'contacts')
+    with pytest.raises(RuntimeError):
+        run_update(db, '2022-12-01T00:00:00', streaming=True)
+    assert fetch(db, "SELECT status FROM run_ledger WHERE stage IN ('run', 'stream') ORDER BY stage") == [('running',), ('running',)]
+    assert fetch(db, 'SELECT count(*) FROM association_history') == [(0,)]
+
+    hubspot.crashes.clear()
+    update = run_update(db, '2022-12-02T00:00:00', streaming=True)
+
+    # Whatever the other loaders had sent before the failure, every record is created once over both runs
+    assert update.ledger.resumed
+    assert Counter(record['properties']['talentlms_user_id'] for record in hubspot.sent('create', 'contacts')) == Counter(range(1, 61))
+    assert Counter(record['properties']['talentlms_course_id'] for record in hubspot.sent('create', '2-8311841')) == Counter(range(1, 9))
+    assert len({(record['properties']['talentlms_user_id'], record['properties']['talentlms_course_id'])
+                for record in hubspot.sent('create', '2-8311962')}) == len(hubspot.sent('create', '2-8311962')) == 160
+    assert fetch(db, 'SELECT count(*) FROM association_history') == [(320,)]
+
+
+def test_restricted_queries_stay_under_the_sqlite_variable_limit(db):
+    # 500 enrollments of 500 students, bound at once they need 1500 variables
+    with db[0].begin() as con:
+        con.execute(text('INSERT INTO student_course_instance (talentlms_user_id, talentlms_course_id) VALUES (:u, :c)'),
+                    [{'u': u, 'c': u % 8} for u in range(500)])
+    keys = [(u, u % 8) for u in range(500)]
+    query = QueryRegistry(db[0])['instances_create']
+    with db[0].connect() as con:
+        # The limit of SQLite builds before 3.32
+        con.connection.dbapi_connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        with pytest.raises(OperationalError, match='too many SQL variables'):
+            con.execute(restrict_query(query, STREAMS['student_course_instance'][3], keys))
+        rows = [row for statement in restrict_queries(query, STREAMS['student_course_instance'][3], keys)
+                for row in con.execute(statement)]
+    assert sorted((row.talentlms_user_id, row.talentlms_course_id) for row in rows) == keys
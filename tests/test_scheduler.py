@@ -0,0 +1,82 @@
+"""Order, concurrency and failures of the stages run by the scheduler"""
+from threading import Barrier, Lock
+
+import pytest
+
+from scheduler import check_stages, run_stages
+
+
+def recorder():
+    """Stage functions that note when they start and end, in order"""
+    events, lock = [], Lock()
+
+    def stage(name, then=None):
+        def function():
+            with lock:
+                events.append(f'start {name}')
+            if then is not None:
+                then()
+            with lock:
+                events.append(f'end {name}')
+        return function
+    return events, stage
+
+
+def test_stages_start_after_their_dependencies():
+    events, stage = recorder()
+    run_stages({
+        'assoc': (stage('assoc'), ('contacts', 'instances')),
+        'instances': (stage('instances'), ('contacts', 'courses')),
+        'contacts': (stage('contacts'), ()),
+        'courses': (stage('courses'), ()),
+        }, max_workers=3)
+    assert events.index('start instances') > max(events.index('end contacts'), events.index('end courses'))
+    assert events.index('start assoc') > events.index('end instances')
+
+
+def test_independent_stages_run_at_the_same_time():
+    # Each stage waits for the other one, so they only both finish if they run at the same time
+    both = Barrier(2, timeout=5)
+    events, stage = recorder()
+    times = run_stages({'contacts': (stage('contacts', both.wait), ()), 'courses': (stage('courses', both.wait), ())},
+                       max_workers=2)
+    assert events[:2] == ['start contacts', 'start courses'] and set(times) == {'contacts', 'courses'}
+
+
+def test_one_worker_runs_the_stages_one_after_another():
+    events, stage = recorder()
+    run_stages({'contacts': (stage('contacts'), ()), 'courses': (stage('courses'), ()), 'assoc': (stage('assoc'), ('courses',))},
+               max_workers=1)
+    assert events == ['start contacts', 'end contacts', 'start courses', 'end courses', 'start assoc', 'end assoc']
+
+
+def test_failed_stage_skips_its_dependents_and_raises_once_the_rest_are_done():
+    def fail():
+        raise RuntimeError('Hubspot is down')
+    events, stage = recorder()
+    with pytest.raises(RuntimeError, match='Hubspot is down'):
+        run_stages({
+            'contacts': (stage('contacts', fail), ()),
+            'courses': (stage('courses'), ()),
+            'instances': (stage('instances'), ('contacts', 'courses')),
+            'assoc': (stage('assoc'), ('instances',)),
+            'templates': (stage('templates'), ('courses',)),
+            }, max_workers=2)
+    # Nothing downstream of the failed stage runs, the stages that do not depend on it still finish
+    assert 'start instances' not in events and 'start assoc' not in events
+    assert 'end courses' in events and 'end templates' in events
+
+
+def test_after_stage_runs_for_every_stage_that_ran():
+    ended = []
+    run_stages({'contacts': (lambda: None, ()), 'courses': (lambda: None, ('contacts',))}, after_stage=lambda: ended.append(1))
+    assert len(ended) == 2
+
+
+@pytest.mark.parametrize('stages', [
+        {'instances': (None, ('contacts',))},
+        {'contacts': (None, ('courses',)), 'courses': (None, ('contacts',))},
+        ])
+def test_missing_or_circular_dependencies_are_refused(stages):
+    with pytest.raises(ValueError):
+        check_stages(stages)
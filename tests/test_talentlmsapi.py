@@ -0,0 +1,162 @@
+"""TalentLMS requests and the moves of their records to SQLite"""
+from functools import partial
+from time import monotonic
+
+import pytest
+
+from requests.exceptions import HTTPError
+from requests.models import Response
+
+import talentlmsapi
+
+from conftest import FakeTalentLMS, fetch, run_update
+from talentlmsapi import TalentLMS, iter_records, RateLimiter, RateLimitedSession, BASE_URL, MAX_REQUEST_RATE, MIN_REQUEST_RATE, RATE_LIMIT_RETRIES
+
+
+def instance_rows(db):
+    return fetch(db, 'SELECT * FROM student_course_instance ORDER BY talentlms_user_id, talentlms_course_id')
+
+
+def move_to_sqlite(db, max_workers):
+    lms = TalentLMS('2022-12-01T00:00:00', *db)
+    lms.fetch_students = partial(lms.fetch_students, max_workers=max_workers)
+    lms.move_courses_to_sqlite()
+    lms.move_users_to_sqlite()
+    lms.move_instances_to_sqlite()
+    return lms
+
+
+def test_concurrent_fetch_builds_the_same_instances(make_db, talentlms, hubspot):
+    serial, concurrent = make_db('serial'), make_db('concurrent')
+    move_to_sqlite(serial, max_workers=1)
+    move_to_sqlite(concurrent, max_workers=4)
+    assert len(instance_rows(serial)) == 160
+    assert instance_rows(concurrent) == instance_rows(serial)
+
+
+def test_fetch_students_keeps_the_order_and_skips_missing_students(db, talentlms, hubspot):
+    lms = TalentLMS('2022-12-01T00:00:00', *db)
+    ids = ['7', '999', '3', '12']
+    fetched = list(lms.fetch_students(ids, max_workers=4))
+    assert [student_id for student_id, _ in fetched] == ['7', '3', '12']
+    assert fetched[0][1]['last_name'] == 'Last7' and fetched[0][1]['courses'][0]['id'] == '2'
+
+
+def response(status_code=200, **headers):
+    res = Response()
+    res.status_code = status_code
+    res.headers.update({key.replace('_', '-'): str(value) for key, value in headers.items()})
+    return res
+
+
+def test_rate_limiter_goes_full_speed_above_the_floor():
+    limiter = RateLimiter(floor=100)
+    limiter.update(response(X_RateLimit_Remaining=1900, X_RateLimit_Reset=3500))
+    assert limiter.rate == MAX_REQUEST_RATE
+
+
+def test_rate_limiter_spreads_the_quota_near_the_floor():
+    limiter = RateLimiter(floor=100)
+    limiter.update(response(X_RateLimit_Remaining=50, X_RateLimit_Reset=100))
+    assert limiter.rate == pytest.approx(0.5)
+    limiter.update(response(X_RateLimit_Remaining=1, X_RateLimit_Reset=3500))
+    assert limiter.rate == MIN_REQUEST_RATE
+
+
+def test_rate_limiter_waits_for_the_window_once_the_quota_is_used_up():
+    limiter = RateLimiter()
+    limiter.update(response(X_RateLimit_Remaining=0, X_RateLimit_Reset=30))
+    assert limiter.blocked_until - monotonic() == pytest.approx(30, abs=1)
+
+
+def test_rate_limiter_backs_off_on_a_429_and_recovers():
+    limiter = RateLimiter(rate=2)
+    limiter.update(response(429, Retry_After='0.05'))
+    limiter.update(response(429, Retry_After='0.05'))
+    assert limiter.rate == pytest.approx(0.5)
+    # Without rate limit headers the rate climbs back to where it started, and no further
+    for _ in range(20):
+        limiter.update(response())
+    assert limiter.rate == 2
+    # With them it goes by the quota left
+    limiter.update(response(429, Retry_After='0.05'))
+    limiter.update(response(X_RateLimit_Remaining=500, X_RateLimit_Reset=60))
+    assert limiter.rate == MAX_REQUEST_RATE
+
+
+class Refusing(FakeTalentLMS):
+    """Answers the first requests with a 429"""
+
+    def __init__(self, refusals):
+        super().__init__()
+        self.refusals = refusals
+
+    def send(self, request, **kwargs):
+        if self.refusals:
+            self.refusals -= 1
+            self.requests.append('refused')
+            res = response(429, Retry_After='0.01')
+            res._content = b'{"error": {"message": "Too many requests"}}'
+            res.request, res.url = request, request.url
+            return res
+        return super().send(request, **kwargs)
+
+
+@pytest.mark.parametrize('refusals, status', [(2, 200), (RATE_LIMIT_RETRIES + 1, 429)])
+def test_session_sends_a_refused_request_again_through_the_limiter(refusals, status):
+    fake = Refusing(refusals)
+    limiter = RateLimiter(rate=1000, capacity=1000)
+    http = RateLimitedSession(BASE_URL, limiter)
+    http.mount(BASE_URL, fake)
+    assert http.get('api/v1/users/id:1').status_code == status
+    assert len(fake.requests) == min(refusals + 1, RATE_LIMIT_RETRIES + 1)
+    assert limiter.report()['requests'] == len(fake.requests)
+
+
+def test_urllib3_leaves_429_to_the_limiter(monkeypatch):
+    monkeypatch.setattr(talentlmsapi, '_talentlms_http', None)
+    retry = talentlmsapi.get_talentlms_http().get_adapter(BASE_URL).max_retries
+    assert not retry.is_retry('GET', 429, has_retry_after=True)
+
+
+@pytest.mark.parametrize('failure, error', [
+        ((500, b'{"error": {"message": "Internal error"}}'), HTTPError),
+        ((200, b'[{"id": "1", "login": "user1"}, {"id": "2", "lo'), talentlmsapi.DECODE_ERRORS),
+        ((200, b'{"error": {"message": "Invalid arguments"}}'), ValueError),
+        ])
+def test_iter_records_raises_instead_of_ending_early(talentlms, failure, error):
+    talentlms.failures['api/v1/users/'] = failure
+    with pytest.raises(error):
+        list(iter_records('api/v1/users/', ('id', 'login')))
+
+
+@pytest.mark.parametrize('path', ['api/v1/users/', 'api/v1/courses/'])
+def test_failed_bulk_list_fails_the_run_and_keeps_the_cache(db, talentlms, hubspot, path):
+    run_update(db, '2022-12-01T00:00:00')
+    hubspot.dispatched.clear()
+    talentlms.failures[path] = (500, b'{"error": {"message": "Internal error"}}')
+    with pytest.raises(HTTPError):
+        run_update(db, '2022-12-02T00:00:00')
+
+    # Nothing sent, the time tracking stays where it was and the cached courses are kept
+    assert hubspot.dispatched == []
+    assert fetch(db, 'SELECT last_modified_time FROM time_tracking') == [(1669852800000,)]
+    assert fetch(db, "SELECT status FROM run_ledger WHERE stage = 'run' AND run_id = '2022-12-02T00:00:00'") == [('running',)]
+    assert fetch(db, 'SELECT count(*) FROM course_detail_cache') == [(8,)]
+
+    # The next run picks up the window of the failed one
+    del talentlms.failures[path]
+    update = run_update(db, '2022-12-02T00:15:00')
+    assert update.ledger.resumed and update.isodatetime == '2022-12-02T00:00:00'
+    assert fetch(db, 'SELECT last_modified_time FROM time_tracking') == [(1669939200000,)]
+
+
+def test_assignment_index_only_takes_new_students(db, talentlms, hubspot):
+    lms = TalentLMS('2022-12-01T00:00:00', *db)
+    talentlms.timelines['20'] = ['1', '7']
+    assert lms.sync_assignment_completion('20') == 2
+    assert lms.sync_assignment_completion('20') == 0
+    talentlms.timelines['20'] = ['13', '1', '7']
+    assert lms.sync_assignment_completion('20') == 1
+    assert lms.get_assignment_completions(['20']) == {1, 7, 13}
+    assert lms.get_assignment_completions(['30']) == set()
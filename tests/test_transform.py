@@ -0,0 +1,92 @@
+"""Fingerprints of the records sent to Hubspot and the Hubspot ids stored for created records"""
+from conftest import FakeResponse, fetch, run_update
+from transform import property_fingerprint, reconcile_hs_ids, save_fingerprints
+
+
+def test_fingerprint_ignores_trigger_datetime_and_key_order():
+    record = {'talentlms_course_id': 1, 'course_name': 'Course', 'trigger_datetime': 1669852800000}
+    same = {'trigger_datetime': 1669939200000, 'course_name': 'Course', 'talentlms_course_id': 1}
+    assert property_fingerprint(record) == property_fingerprint(same)
+    assert property_fingerprint(record) != property_fingerprint(dict(record, course_name='Renamed'))
+
+
+def settled(db):
+    """Runs until everything is in Hubspot, the first run adds the template options the second run sends"""
+    run_update(db, '2022-12-01T00:00:00')
+    run_update(db, '2022-12-01T00:15:00')
+
+
+def test_unchanged_records_are_not_sent_again(db, talentlms, hubspot):
+    settled(db)
+    hubspot.dispatched.clear()
+    talentlms.courses[2]['description'] = 'new description'
+    update = run_update(db, '2022-12-01T00:30:00')
+
+    # Every course and instance is staged again, only the course that changed goes out
+    assert [(kind, obj) for kind, obj, _ in hubspot.dispatched] == [('update', '2-8311841')]
+    assert [record['properties']['talentlms_course_id'] for record in hubspot.sent('update')] == [3]
+    assert update.suppressed_updates['2-8311841'] == 7 and update.suppressed_updates['2-8311962'] == 160
+
+
+def test_refused_update_is_sent_again_next_run(db, talentlms, hubspot):
+    settled(db)
+    talentlms.courses[2]['description'] = 'new description'
+    hubspot.refuse('update', '2-8311841')
+    run_update(db, '2022-12-01T00:30:00')
+
+    hubspot.refused.clear()
+    hubspot.dispatched.clear()
+    run_update(db, '2022-12-01T00:45:00')
+    assert [record['properties']['talentlms_course_id'] for record in hubspot.sent('update')] == [3]
+
+    # Accepted this time, so it is left alone from then on
+    hubspot.dispatched.clear()
+    run_update(db, '2022-12-01T01:00:00')
+    assert hubspot.sent('update') == []
+
+
+def test_save_fingerprints_only_for_the_updates_hubspot_returned(db):
+    session = db[1]
+    with db[0].begin() as con:
+        con.exec_driver_sql('INSERT INTO course_hs_history (talentlms_course_id, hs_course_id) VALUES (1, 101), (2, 102)')
+    payload = {'inputs': [{'id': 101, 'properties': {'talentlms_course_id': 1, 'course_name': 'One'}},
+                          {'id': 102, 'properties': {'talentlms_course_id': 2, 'course_name': 'Two'}}]}
+    # A 207 only returns the records that went through
+    assert save_fingerprints('2-8311841', payload, session, FakeResponse(207, {'results': [{'id': '102'}]})) == 1
+    assert fetch(db, 'SELECT talentlms_course_id, property_hash IS NOT NULL FROM course_hs_history ORDER BY 1') == [(1, 0), (2, 1)]
+    assert save_fingerprints('2-8311841', payload, session, FakeResponse(400, {'status': 'error'})) == 0
+
+
+def test_refused_associations_are_sent_again_without_their_instance_staged(db, talentlms, hubspot):
+    hubspot.refuse('assoc', '2-8311841')
+    run_update(db, '2022-12-01T00:00:00')
+    assert fetch(db, 'SELECT assoc_type, count(*) FROM association_history GROUP BY 1') == [('student_class_instance_to_contact', 160)]
+
+    hubspot.refused.clear()
+    hubspot.dispatched.clear()
+    # A targeted run only stages the instances of user 4, the refused pairs of every other user go out too
+    run_update(db, '2022-12-01T00:15:00', user_ids={'4'})
+    assert len(hubspot.sent('assoc', '2-8311841')) == 160 and hubspot.sent('assoc', 'contact') == []
+    assert fetch(db, 'SELECT count(*) FROM association_history') == [(320,)]
+
+
+def created(hs_id, course_id):
+    return {'id': hs_id, 'properties': {'talentlms_course_id': course_id, 'course_name': 'Course'}}
+
+
+def test_reconcile_keeps_the_first_created_hubspot_id(db):
+    reconcile_hs_ids('2-8311841', [created('205', '1'), created('201', '1'), created('202', '2')], db[1])
+    assert fetch(db, 'SELECT talentlms_course_id, hs_course_id FROM course_hs_history ORDER BY 1') == [(1, 201), (2, 202)]
+
+
+def test_reconcile_moves_a_hubspot_id_to_its_new_talentlms_id(db):
+    reconcile_hs_ids('2-8311841', [created('201', '1'), created('202', '2')], db[1])
+    reconcile_hs_ids('2-8311841', [created('201', '3')], db[1])
+    # The row of course 1 is replaced, the Hubspot id is only ever stored once
+    assert fetch(db, 'SELECT talentlms_course_id, hs_course_id FROM course_hs_history ORDER BY 1') == [(2, 202), (3, 201)]
+
+
+def test_reconcile_skips_records_without_their_ids(db):
+    results = [created('not-an-id', '1'), created('202', None), {'id': '203', 'properties': {}}, None, created('204', '4')]
+    reconcile_hs_ids('2-8311841', results, db[1])
+    assert fetch(db, 'SELECT talentlms_course_id, hs_course_id FROM course_hs_history') == [(4, 204)]
@@ -0,0 +1,129 @@
+"""Webhook receiver: events, debouncing and the targeted cycles they start"""
+import http.client
+import time
+
+from threading import Event, Thread
+
+import pytest
+
+from conftest import fetch, run_update
+from task import CurrUpdate
+from webhook import EventQueue, WebhookReceiver, event_ids
+
+
+@pytest.mark.parametrize('payload, ids', [
+        ({'event': 'course_completion', 'data': {'user_id': 12, 'course_id': 3}}, ({'12'}, {'3'})),
+        ({'event': 'user_update', 'user': {'id': '12'}}, ({'12'}, set())),
+        ({'event': 'enrollment', 'user_id': ' 7 ', 'data': {'course': {'id': 4}}}, ({'7'}, {'4'})),
+        ({'event': 'user_update', 'data': {'user_id': ''}}, (set(), set())),
+        (['not', 'an', 'event'], (set(), set())),
+        ])
+def test_event_ids(payload, ids):
+    assert event_ids(payload) == ids
+
+
+def test_events_are_taken_once_they_are_quiet():
+    events = EventQueue()
+    events.add({'1'}, {'2'})
+    events.add({'1', '3'})
+    start = time.monotonic()
+    assert events.take(debounce=0.2, max_delay=5) == ({'1', '3'}, {'2'})
+    assert 0.15 <= time.monotonic() - start < 1
+
+
+def test_steady_events_are_taken_after_max_delay():
+    events = EventQueue()
+    stop = Event()
+
+    def send():
+        while not stop.is_set():
+            events.add({'1'})
+            time.sleep(0.05)
+
+    sender = Thread(target=send, daemon=True)
+    sender.start()
+    start = time.monotonic()
+    assert events.take(debounce=0.2, max_delay=0.5) == ({'1'}, set())
+    assert time.monotonic() - start < 1
+    stop.set()
+    sender.join()
+
+
+def test_closed_queue_stops_take():
+    events = EventQueue()
+    events.close()
+    assert events.take() is None
+
+
+def test_refuses_public_address_without_token(db, monkeypatch):
+    monkeypatch.setattr(CurrUpdate, 'get_session', staticmethod(lambda: db))
+    with pytest.raises(ValueError):
+        WebhookReceiver(host='0.0.0.0', port=0, token=None)
+
+
+@pytest.fixture
+def receiver(db, tmp_path, monkeypatch):
+    """Receiver with a token serving requests on a free local port"""
+    monkeypatch.setattr(CurrUpdate, 'get_session', staticmethod(lambda: db))
+    receiver = WebhookReceiver(host='127.0.0.1', port=0, token='s3cret', lock_file=str(tmp_path / 'lockfile'))
+    server = Thread(target=receiver.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    server.start()
+    yield receiver
+    receiver.server.shutdown()
+    receiver.server.server_close()
+
+
+def post(receiver, body, headers):
+    con = http.client.HTTPConnection(*receiver.server.server_address, timeout=5)
+    try:
+        con.request('POST', '/', body=body, headers=headers)
+        return con.getresponse().status
+    finally:
+        con.close()
+
+
+@pytest.mark.parametrize('body, headers, status', [
+        (b'{"data": {"user_id": 4}}', {}, 403),
+        (b'{"data": {"user_id": 4}}', {'X-Webhook-Token': 'wrong'}, 403),
+        (b'{"data": {"user_id": 4}}', {'X-Webhook-Token': 's3cret', 'Content-Length': 'abc'}, 400),
+        (b'{"data": ', {'X-Webhook-Token': 's3cret'}, 400),
+        (b'{"event": "user_update"}', {'X-Webhook-Token': 's3cret'}, 400),
+        (b'{"data": {"user_id": 4}}', {'X-Webhook-Token': 's3cret'}, 202),
+        ])
+def test_handler_responses(receiver, body, headers, status):
+    assert post(receiver, body, headers) == status
+    assert receiver.events.user_ids == ({'4'} if status == 202 else set())
+
+
+def test_targeted_cycle_only_requests_the_named_records(db, receiver, talentlms, hubspot):
+    run_update(db, '2022-12-01T00:00:00')
+    tracked = fetch(db, 'SELECT last_modified_time FROM time_tracking')
+    talentlms.requests.clear()
+    hubspot.dispatched.clear()
+    talentlms.users[3]['last_name'] = 'Renamed'
+    talentlms.courses[1]['description'] = 'new description'
+
+    assert receiver.run_cycle({'4'}, {'2'})
+
+    # The user and the course are requested on their own, never the whole lists
+    assert 'api/v1/users/' not in talentlms.requests and 'api/v1/courses/' not in talentlms.requests
+    assert 'api/v1/users/id:4' in talentlms.requests and 'api/v1/courses/id:2' in talentlms.requests
+    assert {kind for kind, _, _ in hubspot.dispatched} == {'update'}
+    assert [record['properties']['lastname'] for record in hubspot.sent('update', 'contacts')] == ['Renamed']
+    assert [record['properties']['description'] for record in hubspot.sent('update', '2-8311841')] == ['new description']
+    # Only instances of the named user or course, ex: the renamed user's enrollment in the course
+    assert [(record['properties']['talentlms_user_id'], record['properties']['talentlms_course_id'], record['properties']['lastname'])
+            for record in hubspot.sent('update', '2-8311962')] == [(4, 2, 'Renamed')]
+    # The regular runs keep their place
+    assert fetch(db, 'SELECT last_modified_time FROM time_tracking') == tracked
+
+
+def test_events_wait_for_an_unfinished_run(db, receiver, talentlms, hubspot):
+    hubspot.crash('assoc', 'contact')
+    with pytest.raises(RuntimeError):
+        run_update(db, '2022-12-01T00:00:00')
+    hubspot.dispatched.clear()
+
+    assert not receiver.run_cycle({'4'}, set())
+    assert hubspot.dispatched == []
+    assert receiver.events.user_ids == {'4'}
@@ -1,19 +1,53 @@
 """Module to transform TalentLMS data to what will be uploaded on Hubspot"""
 
+import hashlib
+import html
+import json
+
 from calendar import timegm
 from dateutil.parser import parse
-from datetime import datetime,timezone
+from datetime import datetime
+from functools import lru_cache
 import pytz
-from sqlalchemy import exc, text
+from sqlalchemy import text, and_, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 import logging
-from models import Contacts, ContactHSHistory, CourseHSHistory, InstanceHistory, TimeTracking
-from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from models import ContactHSHistory, CourseHSHistory, InstanceHistory, AssociationHistory, TimeTracking
+from sqlalchemy.exc import SQLAlchemyError
 import re
 
+# Formats TalentLMS sends its dates in, read directly before falling back to dateutil. Dates with slashes
+# are month first like dateutil's default so both give the same result.
+# ex: 12/01/2022, 12/01/2022, 13:45:31, 12/01/2022 6:00 PM
+US_DATETIME = re.compile(r'(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})'
+                         r'(,? (?P<hour>\d{1,2}):(?P<minute>\d{2})(:(?P<second>\d{2}))?( ?(?P<meridiem>[AaPp][Mm]))?)?')
+# ex: 2022-12-01, 2022-12-01 13:45:31, 2022-12-01T13:45:31.123456 (datetime.isoformat(), like the start time of each run)
+ISO_DATETIME = re.compile(r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})'
+                          r'([ T](?P<hour>\d{2}):(?P<minute>\d{2})(:(?P<second>\d{2})(\.(?P<fraction>\d{1,6}))?)?)?')
+
 # 2-8311841 is the internal ID of courses object on HS
 # 2-8311962 is the internal ID of the student_course_instance object on HS
 
+# Most records Hubspot accepts in one batch request
+HUBSPOT_BATCH_SIZE = 100
+# Column holding the Hubspot id in the update query of each object
+HS_ID_COLUMNS = {'contacts': 'hs_contact_id', '2-8311841': 'hs_course_id', '2-8311962': 'hs_instance_id'}
+# History table of each object and the TalentLMS id properties that identify a record in it
+HISTORY_KEYS = {
+                'contacts': (ContactHSHistory, ('talentlms_user_id',)),
+                '2-8311841': (CourseHSHistory, ('talentlms_course_id',)),
+                '2-8311962': (InstanceHistory, ('talentlms_user_id', 'talentlms_course_id'))
+                }
+# Properties left out of the fingerprints since they change every run without the record itself changing
+FINGERPRINT_EXCLUDE = ('trigger_datetime',)
+
+# Values gathered for each enrollment by InstanceBatch.append, one column each
+INSTANCE_RAW_COLUMNS = ('talentlms_user_id', 'talentlms_course_id', 'firstname', 'lastname', 'course_name', 'code',
+                        'company_cohort_id', 'completed_on_timestamp', 'completion_status', 'completion_percent', 'email',
+                        'live_session_datetime', 'role', 'session_time', 'status', 'total_time', 'total_time_seconds',
+                        'last_accessed_unit_url', 'assign_complete_ids')
+
 logger = logging.getLogger(f'CurrUpdate.{__name__}')
 
 def validate_unix(time_str):
@@ -28,14 +62,51 @@ def validate_unix(time_str):
             return True
     return False
 
+@lru_cache(maxsize=4096)
+def parse_datetime(datetime_str):
+    """
+    The parse_datetime is a helper function that turns a datetime string into a datetime object. The known TalentLMS
+    formats are read exactly and anything else goes through dateutil's fuzzy parser. Results are cached since the
+    same dates come up over and over (ex: courses of a cohort share their dates)
+    :param datetime_str: a string to be changed to a datetime
+    :return: the datetime object, the same one dateutil's fuzzy parser would give
+    """
+    match = US_DATETIME.fullmatch(datetime_str) or ISO_DATETIME.fullmatch(datetime_str)
+    if match is not None:
+        fields = match.groupdict()
+        hour = int(fields['hour'] or 0)
+        meridiem = (fields.get('meridiem') or '').upper()
+        # 12 AM is midnight and 12 PM is noon
+        if meridiem == 'AM' and hour == 12:
+            hour = 0
+        elif meridiem == 'PM' and hour != 12:
+            hour += 12
+        try:
+            return datetime(int(fields['year']), int(fields['month']), int(fields['day']), hour, int(fields['minute'] or 0), 
+                            int(fields['second'] or 0), int((fields.get('fraction') or '0').ljust(6, '0')))
+        except ValueError:
+            # Out of range values (ex: 13 PM) are left to dateutil
+            pass
+    return parse(datetime_str, fuzzy=True)
+
+@lru_cache(maxsize=None)
+def get_timezone(zonename):
+    """
+    The get_timezone is a helper function that builds a pytz timezone only once per name
+    :param zonename: the time zone
+    :return: the pytz timezone
+    """
+    return pytz.timezone(zonename)
+
 def to_millisec(datetime_str):
     """
     The to_millisec is a helper function for the return_unix_time function takes a datetime string and changes the time to unix time
     :param datetime_str: a string to be changed to unix time
     :return: the correlating datetime in unix time (milliseconds) 
     """
-    return timegm(parse(datetime_str, fuzzy=True).timetuple()) * 1000
+    return timegm(parse_datetime(datetime_str).timetuple()) * 1000
 
+@lru_cache(maxsize=4096)
 def convert_dt_to_utc(dt_str, zonename='US/Eastern'):
     """
     Takes a datestring and changes it into unix epoch time and also grabs the time data as its own separate entitity
@@ -43,9 +114,9 @@ def convert_dt_to_utc(dt_str, zonename='US/Eastern'):
     :return: The unix epoch time and session time
     """
     # Set the timezone
-    tz = pytz.timezone(zonename)
+    tz = get_timezone(zonename)
     # Grab the datetime from a string
-    dt_obj_unaware = parse(dt_str, fuzzy=True)
+    dt_obj_unaware = parse_datetime(dt_str)
     # Make the datetime object aware of the timezone
     dt_obj_aware = tz.localize(dt_obj_unaware)
     # Create a timetuple of the datetime in UTC time
@@ -72,71 +143,194 @@ def return_unix_time(time_str):
     else:
         return to_millisec(time_str)
 
-def create_obj_payload(outer_join_file, engine):
+def bulk_upsert(session, model, rows):
+    """
+    Writes rows to a table with a single executemany INSERT ... ON CONFLICT DO UPDATE on its primary
+    key, the same outcome as the sqlite_on_conflict='REPLACE' the tables are declared with in models.py,
+    without building ORM objects or going through the unit of work. The caller commits.
+
+    Args:
+        session (class): scoped_session object, and it represents a registry of Session objects: 
+            which manages persistence operations for ORM-mapped objects.
+        model (class): table the rows are written to, ex: Contacts
+        rows (list): dicts of {column name: value}, all with the same keys
+    """
+    if not rows:
+        return
+    table = model.__table__
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(
+                                                index_elements=[column.name for column in table.primary_key],
+                                                set_={column.name: statement.excluded[column.name] 
+                                                      for column in table.columns if not column.primary_key}
+                                                )
+    session.execute(statement, rows)
+
+class InstanceBatch:
+    """
+    Enrollment records gathered into a batch and turned into student_course_instance rows a whole batch
+    at a time: the records are split into columns so each conversion runs once over its column instead 
+    of once per row, and course names are unescaped once per distinct name instead of once per enrollment
     """
-    Uses an outer join to match up Historical Data with new data from their respective tables 
-    in order to find any TalentLMS IDs without Hubspot Ids in the historical tables
-    for a CREATE API payload
+
+    def __init__(self):
+        self.records = [] # one tuple of INSTANCE_RAW_COLUMNS per enrollment, turned into columns by rows()
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, student_id, student, course, course_session):
+        """
+        Adds one enrollment to the batch. Every value is read before the record is added, so a record 
+        missing a field raises without leaving anything behind.
+
+        Args:
+            student_id (str): TalentLMS id of the student
+            student (dict): individual student record from TalentLMS
+            course (dict): the course from the student's record
+            course_session (dict): the course's entry of TalentLMS.course_ids_session
+        """
+        values = (
+                student_id, course['id'], student['first_name'], student['last_name'], course['name'],
+                course_session['code'], student['custom_field_4'], course['completed_on_timestamp'],
+                course['completion_status'], course['completion_percentage'], student['email'],
+                course_session['session_date_unix'], course['role'], course_session['session_time'], student['status'],
+                course['total_time'], course['total_time_seconds'], course['last_accessed_unit_url'],
+                course_session['assign_complete_ids']
+                )
+        self.records.append(values)
+
+    def rows(self):
+        """
+        Converts the batch into rows for the StudentCourseInstance table and empties it. If a value 
+        can not be converted, the batch is converted again row by row so only the bad rows are left out.
+
+        Returns:
+            (list): dicts of {column name: value}
+        """
+        records, self.records = self.records, []
+        if not records:
+            return []
+        try:
+            return self._convert(records)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+        rows = []
+        for record in records:
+            try:
+                rows += self._convert([record])
+            except Exception as e:
+                logger.error(f'Leaving out the instance of user {record[0]} in course {record[1]}: {e}', exc_info=True)
+        return rows
+
+    @staticmethod
+    def _convert(records):
+        """
+        :param records: list of tuples of INSTANCE_RAW_COLUMNS
+        :return: list of StudentCourseInstance rows
+        """
+        # Turn the records into one column per field
+        columns = dict(zip(INSTANCE_RAW_COLUMNS, zip(*records)))
+        unescaped = {name: html.unescape(name) for name in set(columns['course_name'])}
+        instance_name = [f'{last} {first}: {unescaped[name]}' for last, first, name 
+                         in zip(columns['lastname'], columns['firstname'], columns['course_name'])]
+        # Unix seconds to milliseconds
+        completed_on = [int(timestamp) * 1000 if timestamp is not None else None 
+                        for timestamp in columns['completed_on_timestamp']]
+        # Whether the student has already completed the course's assignment
+        assignment_complete = ['Yes' if int(student_id) in complete_ids else 'No' for student_id, complete_ids 
+                               in zip(columns['talentlms_user_id'], columns['assign_complete_ids'])]
+        converted = dict(columns, instance_name=instance_name, completed_on=completed_on, 
+                         assignment_complete=assignment_complete)
+        del converted['completed_on_timestamp'], converted['assign_complete_ids']
+        names = tuple(converted)
+        return [dict(zip(names, values)) for values in zip(*converted.values())]
+
+def stream_query(query_file, engine, to_input, batch_size=HUBSPOT_BATCH_SIZE):
+    """
+    Runs a .sql file and streams its rows from the cursor, turning each row into a Hubspot input and 
+    yielding them as batches that are ready to be sent, so the first batch can go out while the rest
+    of the rows are still being read
 
     Args:
-        outer_join_file (str): a .sql filename for creates
+        query_file (str|TextClause): a .sql filename, or its statement from the QueryRegistry
         engine (class): Engine object to provide a source of database connectivity and behavior
+        to_input (function): turns a result row into one input of the payload, or None to leave the row out
+        batch_size (int): most inputs per batch
 
-    Returns:
-        (dict): dict that will be convert to JSON data for Hubspot CREATE 
+    Yields:
+        (dict): {'inputs': [...]} that will be convert to JSON data for a Hubspot batch request
     """
     try:
         with engine.connect() as con:
-            with open(outer_join_file) as file:
-                query = text(file.read())
-                
-                results = con.execute(query)
-                return  {'inputs': [{'properties': dict(result)} for result in results]}
-        con.close()
+            if isinstance(query_file, str):
+                with open(query_file) as file:
+                    query = text(file.read())
+            else:
+                query = query_file
+            results = con.execute(query)
+            batch = []
+            for result in results:
+                record = to_input(result)
+                if record is None:
+                    continue
+                batch.append(record)
+                if len(batch) == batch_size:
+                    yield {'inputs': batch}
+                    batch = []
+            if batch:
+                yield {'inputs': batch}
     except SQLAlchemyError as s:
+        # Raised again so the stage fails and the run is resumed, instead of passing as a stage with nothing to send
         logger.error(s, exc_info=True)
-        pass
+        raise
     except Exception as e:
         logger.error(e, exc_info=True)
-        pass
-    
+        raise
+
+def iter_create_obj_payload(outer_join_file, engine, batch_size=HUBSPOT_BATCH_SIZE):
+    """
+    Uses an outer join to match up Historical Data with new data from their respective tables 
+    in order to find any TalentLMS IDs without Hubspot Ids in the historical tables
+    for CREATE API payloads, streamed in batches
 
-def update_obj_payload(inner_join_file, obj, engine):
+    Args:
+        outer_join_file (str|TextClause): a .sql filename for creates, or its statement from the QueryRegistry
+        engine (class): Engine object to provide a source of database connectivity and behavior
+        batch_size (int): most records per payload
+
+    Yields:
+        (dict): dict that will be convert to JSON data for a Hubspot batch CREATE 
+    """
+    return stream_query(outer_join_file, engine, lambda result: {'properties': dict(result)}, batch_size)
+
+def iter_update_obj_payload(inner_join_file, obj, engine, batch_size=HUBSPOT_BATCH_SIZE, suppressed=None):
     """Uses an inner join to match up Historical Data with new data from their respective tables 
     in order to find Hubspot IDs associated with TalentLMS IDs in the historical tables
-    for an UPDATE API payload
+    for UPDATE API payloads, streamed in batches. Records whose properties have the same fingerprint
+    as the ones last sent to Hubspot are left out.
 
     Args:
-        inner_join_file (str): .sql filename for updates
+        inner_join_file (str|TextClause): .sql filename for updates, or its statement from the QueryRegistry
         obj (str): object name on Hubspot to update to
         engine (class): Engine object to provide a source of database connectivity and behavior
+        batch_size (int): most records per payload
+        suppressed (Counter): counts the records left out per object, if given
 
-    Returns:
-        (dict): dict that will be convert to JSON data for Hubspot UPDATE
+    Yields:
+        (dict): dict that will be convert to JSON data for a Hubspot batch UPDATE
     """
-    payload = {'inputs': []}
-    try:
-        with engine.connect() as con:
-            with open(inner_join_file) as file:
-                query = text(file.read())
-                
-                results = con.execute(query)
-                for result in results:
-                    record = dict(result)
-                    if obj == 'contacts':
-                        payload['inputs'].append({'id': record.pop('hs_contact_id'), 'properties': record})
-                    elif obj == '2-8311841':
-                        payload['inputs'].append({'id': record.pop('hs_course_id'), 'properties': record})
-                    elif obj == '2-8311962':
-                        payload['inputs'].append({'id': record.pop('hs_instance_id'), 'properties': record})
-                return payload   
-        con.close()
-    except SQLAlchemyError as s:
-        logger.error(s, exc_info=True)
-        pass
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        pass
+    def to_input(result):
+        record = dict(result)
+        hs_id = record.pop(HS_ID_COLUMNS[obj])
+        last_hash = record.pop('property_hash', None)
+        # Nothing changed since the last time the record was sent
+        if last_hash is not None and last_hash == property_fingerprint(record):
+            if suppressed is not None:
+                suppressed[obj] += 1
+            return None
+        return {'id': hs_id, 'properties': record}
+    return stream_query(inner_join_file, engine, to_input, batch_size)
 
 def update_if_already_exists_payload(hs_id, payld):
     """
@@ -155,93 +349,216 @@ def update_if_already_exists_payload(hs_id, payld):
     payload.update(payld)
     return payload
 
-def create_assoc_payload(assoc_join_file, assoc_type, engine):
+def iter_assoc_payload(assoc_join_file, assoc_type, engine, batch_size=HUBSPOT_BATCH_SIZE):
     """
-    Creates an association payload for either the Contact or Courses object to be associated 
-    with the Student/Instance object
+    Creates association payloads for either the Contact or Courses object to be associated 
+    with the Student/Instance object, streamed in batches
 
     Args:
-        assoc_join_file (str): filename of a .sql that uses a JOIN on historical data to grab the
-            ids of contact or courses and associated with an instance id
+        assoc_join_file (str|TextClause): filename of a .sql that uses a JOIN on historical data to grab the
+            ids of contact or courses and associated with an instance id, or its statement from the QueryRegistry
         assoc_type (str): shows the connection to be contact_to_instance or courses_to_instance
         engine (class): Engine object to provide a source of database connectivity and behavior
+        batch_size (int): most associations per payload
+
+    Yields:
+        (dict): dict that will be convert to JSON data for a Hubspot batch CREATE for associations
+    """
+    return stream_query(assoc_join_file, engine, lambda result: {
+                                                                "from": {
+                                                                    "id": str(result[0])
+                                                                },
+                                                                "to": {
+                                                                    "id": str(result[1])
+                                                                },
+                                                                "type": assoc_type
+                                                                }, batch_size)
+
+def property_fingerprint(properties):
+    """
+    Hashes the properties of a record the way they are sent to Hubspot
+
+    Args:
+        properties (dict): properties of a CREATE or UPDATE input
 
     Returns:
-        (dict): dict that will be convert to JSON data for Hubspot CREATE for associations
+        (str): sha1 hex digest of the properties, without the ones in FINGERPRINT_EXCLUDE
     """
+    fingerprinted = {key: value for key, value in properties.items() if key not in FINGERPRINT_EXCLUDE}
+    return hashlib.sha1(json.dumps(fingerprinted, sort_keys=True, default=str).encode()).hexdigest()
+
+def hubspot_results(responses):
+    """
+    Gathers the records Hubspot returned for the batch requests of a dispatch, leaving out the requests
+    it refused. A 207 only returns the records that went through, the rest are in its errors.
+
+    Args:
+        responses (class|list): Response object, or list of them, returned by a hubapi dispatch
+
+    Returns:
+        (list): the 'results' of every request Hubspot accepted
+    """
+    if responses is None:
+        return []
+    if not isinstance(responses, (list, tuple)):
+        responses = [responses]
+    results = []
+    for res in responses:
+        if not hubspot_accepted(res):
+            continue
+        try:
+            results.extend(res.json().get('results') or [])
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            continue
+    return results
+
+def save_fingerprints(objectType, payload, session, responses):
+    """
+    Stores the fingerprint of every record of a CREATE or UPDATE payload that Hubspot accepted in its 
+    history table, so the record is not sent again until one of its properties changes. An update is 
+    accepted when Hubspot returned its id, a create when its Hubspot id was stored in the history table
+    by the handler, as the fingerprint only goes on a row that is already there.
+
+    Args:
+        objectType (str): Hubspot object to be used to specify which table the fingerprints go in
+        payload (dict): the {'inputs': [...]} that was dispatched
+        session (class):  scoped_session object, and it represents a registry of  Session
+            objects: which manages persistence operations for ORM-mapped objects.
+        responses (class|list): what the dispatch of the payload returned
+
+    Returns:
+        (int): number of records whose fingerprint was stored
+    """
+    model, keys = HISTORY_KEYS[objectType]
+    table = model.__table__
+    inputs = payload['inputs']
+    if any('id' in record for record in inputs):
+        confirmed = {str(result.get('id')) for result in hubspot_results(responses)}
+        inputs = [record for record in inputs if 'id' not in record or str(record['id']) in confirmed]
+    statement = table.update()\
+        .where(and_(*[table.c[key] == bindparam(f'b_{key}') for key in keys]))\
+        .values(property_hash=bindparam('b_property_hash'))
+    rows = [dict({f'b_{key}': record['properties'][key] for key in keys}, b_property_hash=property_fingerprint(record['properties']))
+            for record in inputs]
+    saved = 0
     try:
-        with engine.connect() as con:
-            with open(assoc_join_file) as file:
-                query = text(file.read())
-                results = con.execute(query)
-                return {'inputs': [{
-                                    "from": {
-                                        "id": str(result[0])
-                                    },
-                                    "to": {
-                                        "id": str(result[1])
-                                    },
-                                    "type": assoc_type
-                                    } for result in results]}
-        con.close()
+        if rows:
+            saved = session.execute(statement, rows).rowcount
+            session.commit()
     except SQLAlchemyError as s:
         logger.error(s, exc_info=True)
+        session.rollback()
         pass
     except Exception as e:
         logger.error(e, exc_info=True)
         pass
-   
+    if saved < len(payload['inputs']):
+        logger.warning(f'Hubspot did not accept {len(payload["inputs"]) - saved} of {len(payload["inputs"])} {objectType} '
+                       'records, they are sent again on the next run')
+    return saved
 
-def gather_batch_hs_id(objectType, res, session):
+def confirmed_pairs(responses):
     """
-    Gathers the Hubspot IDS generated with doing a CREATE API call and storing it with a 
-    TalentLMS ID as a single record
+    Finds the (from id, to id) pairs Hubspot returned for association requests, the to side of a 
+    result is a single object or a list of them depending on the endpoint
 
     Args:
-        objectType (str): Hubspot object to be used to specify which table to put the historical
-            data in
-        res (class): JSON response to find the ids
+        responses (class|list): Response object, or list of them, returned by a hubapi dispatch
+
+    Returns:
+        (set): (from id, to id) pairs as strings
+    """
+    pairs = set()
+    for result in hubspot_results(responses):
+        try:
+            from_id = str(result['from']['id'])
+            targets = result['to'] if isinstance(result['to'], list) else [result['to']]
+            pairs.update((from_id, str(target.get('id', target.get('toObjectId')))) for target in targets)
+        except (KeyError, TypeError, AttributeError):
+            logger.error(f'Hubspot returned an association without its ids: {result}')
+            continue
+    return pairs
+
+def save_associations(payload, session, responses):
+    """
+    Records the associations of a payload that Hubspot confirmed in the association_history table, 
+    so the association queries leave them out from then on. The rest are sent again on the next run.
+
+    Args:
+        payload (dict): the {'inputs': [...]} association payload that was dispatched
         session (class):  scoped_session object, and it represents a registry of  Session
             objects: which manages persistence operations for ORM-mapped objects.
+        responses (class|list): what the dispatch of the payload returned
+
+    Returns:
+        (int): number of associations recorded
     """
-    for r in res.json()['results']:
-        if objectType == 'contacts':
-            try:
-                session.add(ContactHSHistory(hs_contact_id=r['id'], talentlms_user_id=r['properties']\
-                    ['talentlms_user_id']))
-            except SQLAlchemyError as s:
-                logger.error(s, exc_info=True)
-                continue
-            except Exception as e:
-                logger.error(e, exc_info=True)
-                continue
-        elif objectType == '2-8311841':
-            try:
-                session.add(CourseHSHistory(hs_course_id=r['id'], talentlms_course_id=r['properties']\
-                    ['talentlms_course_id']))
-            except SQLAlchemyError as s:
-                logger.error(s, exc_info=True)
-                continue
-            except Exception as e:
-                logger.error(e, exc_info=True)
-                continue
-        elif objectType == '2-8311962':
-            try:
-                session.add(InstanceHistory(hs_instance_id=r['id'], talentlms_user_id=r['properties']\
-                    ['talentlms_user_id'], talentlms_course_id=r['properties']['talentlms_course_id']))
-            except SQLAlchemyError as s:
-                logger.error(s, exc_info=True)
-                session.rollback()
-                continue
-            except Exception as e:
-                logger.error(e, exc_info=True)
-                continue
-    try: 
+    confirmed = confirmed_pairs(responses)
+    rows = [{
+            'from_id': int(assoc['from']['id']),
+            'to_id': int(assoc['to']['id']),
+            'assoc_type': assoc['type']
+            } for assoc in payload['inputs'] if (str(assoc['from']['id']), str(assoc['to']['id'])) in confirmed]
+    if len(rows) < len(payload['inputs']):
+        logger.warning(f'Hubspot did not confirm {len(payload["inputs"]) - len(rows)} of {len(payload["inputs"])} '
+                       f'{payload["inputs"][0]["type"]} associations, they are sent again on the next run')
+    if not rows:
+        return 0
+    try:
+        # Pairs that are already recorded are ignored by the primary key's ON CONFLICT IGNORE
+        session.execute(AssociationHistory.__table__.insert(), rows)
         session.commit()
-    except IntegrityError as i:
-        logger.error(i, exc_info=True)
+    except SQLAlchemyError as s:
+        logger.error(s, exc_info=True)
         session.rollback()
-        pass
+        return 0
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return 0
+    return len(rows)
+
+def reconcile_hs_ids(objectType, results, session):
+    """
+    Stores the Hubspot ids of created records with their TalentLMS ids in a single INSERT OR REPLACE, 
+    so one conflicting record can not roll back the ids of the rest of the batch. Conflicts are settled 
+    the same way every time:
+        - a TalentLMS id returned with more than one Hubspot id keeps the lowest (first created) Hubspot id
+        - a Hubspot id already stored for another TalentLMS id moves to the TalentLMS id it was just 
+          returned for, and the old row is replaced
+        - a record without a numeric Hubspot id or TalentLMS id is logged and left out
+
+    Args:
+        objectType (str): Hubspot object to be used to specify which table to put the historical
+            data in
+        results (list): records returned by Hubspot, each with its 'id' and 'properties'
+        session (class): scoped_session object, and it represents a registry of  Session
+            objects: which manages persistence operations for ORM-mapped objects.
+    """
+    model, keys = HISTORY_KEYS[objectType]
+    hs_id_column = HS_ID_COLUMNS[objectType]
+    records = [] # (Hubspot id, TalentLMS key) of the records that came back whole
+    for result in results:
+        try:
+            records.append((int(result['id']), tuple(int(result['properties'][k]) for k in keys)))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logger.error(f'Hubspot {objectType} record {result} came back without its Hubspot or TalentLMS ids')
+            continue
+    rows = {} # {TalentLMS key: row}
+    # Go through the records lowest Hubspot id first so the first one kept for a key is the oldest
+    for hs_id, key in sorted(records):
+        if key in rows:
+            logger.warning(f'Hubspot {objectType} records {rows[key][hs_id_column]} and {hs_id} were both '
+                           f'created for TalentLMS id {key}, keeping {rows[key][hs_id_column]}')
+            continue
+        rows[key] = dict(zip(keys, key), **{hs_id_column: hs_id})
+    if not rows:
+        return
+    try:
+        # OR REPLACE also settles the UNIQUE constraint on the Hubspot id, which the primary key's
+        # ON CONFLICT REPLACE does not cover
+        session.execute(model.__table__.insert().prefix_with('OR REPLACE'), list(rows.values()))
+        session.commit()
     except SQLAlchemyError as s:
         logger.error(s, exc_info=True)
         session.rollback()
@@ -250,6 +567,37 @@ def gather_batch_hs_id(objectType, res, session):
         logger.error(e, exc_info=True)
         pass
 
+def hubspot_accepted(res):
+    """
+    Checks if Hubspot accepted a request, hubapi logs the requests it refused instead of raising
+
+    Args:
+        res (class): Response object of the request, None if it could not be sent
+
+    Returns:
+        (bool): True if the request went through, fully or for part of a batch (207)
+    """
+    return res is not None and getattr(res, 'status_code', None) is not None and res.status_code < 400
+
+def gather_batch_hs_id(objectType, res, session):
+    """
+    Gathers the Hubspot IDS generated with doing a CREATE API call and storing it with a 
+    TalentLMS ID as a single record
+
+    Args:
+        objectType (str): Hubspot object to be used to specify which table to put the historical
+            data in
+        res (class): JSON response to find the ids
+        session (class):  scoped_session object, and it represents a registry of  Session
+            objects: which manages persistence operations for ORM-mapped objects.
+    """
+    try:
+        results = res.json()['results']
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return
+    reconcile_hs_ids(objectType, results, session)
+
 def gather_unit_hs_id(objectType, res, session):
     """
     Helper function to gather the created Hubspot Ids and match it up with to the TalentLMS Ids
@@ -263,48 +611,12 @@ def gather_unit_hs_id(objectType, res, session):
         session (class): scoped_session object, and it represents a registry of  Session
             objects: which manages persistence operations for ORM-mapped objects.
     """
-    r = res.json()
-    if objectType == 'contacts':
-        try:
-            session.add(ContactHSHistory(hs_contact_id=r['id'], talentlms_user_id=r['properties']\
-                ['talentlms_user_id']))
-        except SQLAlchemyError as s:
-            logger.error(s, exc_info=True)
-            session.rollback()
-            pass
-        except Exception as e:
-            logger.error(e, exc_info=True)
-    elif objectType == '2-8311841':
-        try:
-            session.add(CourseHSHistory(hs_course_id=r['id'], talentlms_course_id=r['properties']\
-                ['talentlms_course_id']))
-        except SQLAlchemyError as s:
-            logger.error(s, exc_info=True)
-            session.rollback()
-            pass
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            pass
-    elif objectType == '2-8311962': 
-        try:
-            session.add(InstanceHistory(hs_instance_id=r['id'], talentlms_user_id=r['properties']\
-                ['talentlms_user_id'], talentlms_course_id=r['properties']['talentlms_course_id']))
-        except SQLAlchemyError as s:
-            logger.error(s, exc_info=True)
-            session.rollback()
-            pass
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            pass
-    try: 
-        session.commit()
-    except SQLAlchemyError as s:
-        logger.error(s, exc_info=True)
-        session.rollback()
-        pass
+    try:
+        result = res.json()
     except Exception as e:
         logger.error(e, exc_info=True)
-        pass
+        return
+    reconcile_hs_ids(objectType, [result], session)
 
 def update_time_tracking(time_str, session):
     """Updates the last_modified_time recored to the start time of the program running.
@@ -0,0 +1,309 @@
+"""Module to receive TalentLMS webhook events and sync the users and courses they name right away"""
+
+import argparse
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import signal
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Thread
+from time import monotonic
+
+from dotenv import load_dotenv
+# Read the .env file before the modules below take their settings from the environment
+load_dotenv()
+
+import requests
+
+from task import CurrUpdate, cycle_lock, LOCK_FILE
+from ledger import Ledger
+from logger import get_logger
+from queries import QueryRegistry
+from templates import CourseTemplateRegistry
+
+# Address the receiver listens on, only this machine by default (ex: behind a reverse proxy). Listening on
+# any other address needs WEBHOOK_TOKEN
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8085))
+# Shared secret TalentLMS sends in the X-Webhook-Token header, events without it are refused when it is set
+WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+# A targeted cycle starts once no event has come in for WEBHOOK_DEBOUNCE seconds, or WEBHOOK_MAX_DELAY seconds
+# after the first event it holds, so a steady flow of events can not hold it back
+WEBHOOK_DEBOUNCE = float(os.getenv('WEBHOOK_DEBOUNCE', 10))
+WEBHOOK_MAX_DELAY = float(os.getenv('WEBHOOK_MAX_DELAY', 60))
+# Largest request body accepted, in bytes
+WEBHOOK_MAX_BODY = 64 * 1024
+
+logger = logging.getLogger(f'CurrUpdate.{__name__}')
+
+
+def is_loopback(host):
+    """True if the address only accepts connections from this machine"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def event_ids(payload):
+    """
+    Finds the user and course ids of a webhook event. The ids can be at the top of the event or under
+    its data, either as user_id/course_id or as the id of a user/course object, ex:
+        {"event": "course_completion", "data": {"user_id": 12, "course_id": 3}}
+        {"event": "user_update", "user": {"id": "12"}}
+
+    Args:
+        payload (dict): the JSON body of the event
+
+    Returns:
+        (tuple): set of user ids and set of course ids, as strings
+    """
+    user_ids, course_ids = set(), set()
+    if not isinstance(payload, dict):
+        return user_ids, course_ids
+    for part in (payload, payload.get('data')):
+        if not isinstance(part, dict):
+            continue
+        for key, ids in (('user', user_ids), ('course', course_ids)):
+            value = part.get(f'{key}_id')
+            if value is None and isinstance(part.get(key), dict):
+                value = part[key].get('id')
+            if value is not None and str(value).strip():
+                ids.add(str(value).strip())
+    return user_ids, course_ids
+
+
+class EventQueue:
+    """Debounced set of the user and course ids the events named since the last targeted cycle"""
+
+    def __init__(self):
+        self.condition = Condition()
+        self.user_ids = set()
+        self.course_ids = set()
+        self.first = None # monotonic time of the first event held
+        self.last = None # monotonic time of the latest event
+        self.closed = False
+
+    def add(self, user_ids=(), course_ids=()):
+        """Queues the ids of an event, ids already queued are only synced once"""
+        with self.condition:
+            now = monotonic()
+            self.user_ids.update(user_ids)
+            self.course_ids.update(course_ids)
+            self.first = self.first or now
+            self.last = now
+            self.condition.notify_all()
+
+    def close(self):
+        """Wakes up take() for good, ex: when the receiver stops"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def take(self, debounce=WEBHOOK_DEBOUNCE, max_delay=WEBHOOK_MAX_DELAY):
+        """
+        Waits until events have been quiet for debounce seconds, or max_delay seconds have passed since
+        the first of them, then hands over their ids and empties the queue
+
+        Returns:
+            (tuple): set of user ids and set of course ids, None once the queue is closed
+        """
+        with self.condition:
+            while not self.closed:
+                if self.first is None:
+                    self.condition.wait()
+                    continue
+                due = min(self.last + debounce, self.first + max_delay)
+                if monotonic() >= due:
+                    ids = (self.user_ids, self.course_ids)
+                    self.user_ids, self.course_ids = set(), set()
+                    self.first = self.last = None
+                    return ids
+                self.condition.wait(due - monotonic())
+            return None
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Queues the ids of every event POSTed by TalentLMS and answers 202 right away"""
+
+    def do_POST(self):
+        token = self.server.token
+        if token and not hmac.compare_digest(self.headers.get('X-Webhook-Token', ''), token):
+            return self._reply(403, 'forbidden')
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            return self._reply(400, 'invalid Content-Length')
+        if length < 0:
+            return self._reply(400, 'invalid Content-Length')
+        if length > WEBHOOK_MAX_BODY:
+            return self._reply(413, 'payload too large')
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._reply(400, 'invalid JSON')
+        user_ids, course_ids = event_ids(payload)
+        if not user_ids and not course_ids:
+            return self._reply(400, 'no user or course id in the event')
+        self.server.events.add(user_ids, course_ids)
+        logger.info(f'Webhook event {payload.get("event")}: queued users {sorted(user_ids)} and courses {sorted(course_ids)}')
+        self._reply(202, 'queued')
+
+    def _reply(self, status, message):
+        body = json.dumps({'status': message}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f'Webhook request from {self.address_string()}: {format % args}')
+
+
+class WebhookReceiver:
+    """
+    Listens for TalentLMS webhook events (course completions, user updates, enrollments) and runs targeted
+    CurrUpdate cycles for only the users and courses they name, so a change reaches Hubspot within seconds
+    instead of waiting for the next regular run. The regular runs from the cron job or the daemon keep going
+    as the safety net, and every targeted cycle takes the same lock so they never overlap. Events that come
+    in while the lock is held, or while an unfinished regular run waits to be resumed, are kept for later.
+    """
+
+    def __init__(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, debounce=WEBHOOK_DEBOUNCE, max_delay=WEBHOOK_MAX_DELAY,
+                 lock_file=LOCK_FILE, token=WEBHOOK_TOKEN):
+        """
+        Args:
+            host (str): address to listen on
+            port (int): port to listen on
+            debounce (float): seconds without events before a targeted cycle starts
+            max_delay (float): most seconds an event waits for its targeted cycle
+            lock_file (str): path of the lock file shared with the cron job and the daemon
+            token (str): shared secret expected in the X-Webhook-Token header, None to accept every event,
+                which is only allowed on a loopback address
+
+        Raises:
+            ValueError: the host is not a loopback address and there is no token
+        """
+        get_logger('CurrUpdate') # Instantiate the logger
+        if not token and not is_loopback(host):
+            raise ValueError(f'Refusing to listen on {host} without WEBHOOK_TOKEN, set it or listen on 127.0.0.1')
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.lock_file = lock_file
+        self.events = EventQueue()
+        self.stopping = Event() # set by stop() to end the loop
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.events = self.events
+        self.server.token = token
+        # Kept warm between cycles, as in the daemon
+        self.engine, self.session = CurrUpdate.get_session()
+        self.queries = QueryRegistry(self.engine)
+        self.template_registry = CourseTemplateRegistry(self.session)
+
+    def stop(self, signum=None, frame=None):
+        """Signal handler stopping the receiver once the current cycle is done"""
+        logger.info(f'Received signal {signum}, stopping the webhook receiver')
+        self.stopping.set()
+        self.events.close()
+
+    def run_cycle(self, user_ids, course_ids):
+        """
+        Runs a targeted cycle for the ids unless the lock is taken or a regular run has to be resumed first
+
+        Returns:
+            (bool): False if the ids were queued again for later
+        """
+        with cycle_lock(self.lock_file) as locked:
+            if not locked:
+                logger.info('Another run holds the lock, keeping the webhook events for the next cycle')
+                self.events.add(user_ids, course_ids)
+                return False
+            # A targeted cycle empties the staging tables an unfinished run may resume from
+            if Ledger(self.session).unfinished() is not None:
+                logger.info('A regular run has to be resumed first, keeping the webhook events for the next cycle')
+                self.session.remove()
+                self.events.add(user_ids, course_ids)
+                return False
+            logger.info(f'Syncing {len(user_ids)} users and {len(course_ids)} courses from webhook events')
+            try:
+                CurrUpdate(engine=self.engine, session=self.session, queries=self.queries, template_registry=self.template_registry,
+                           user_ids=user_ids, course_ids=course_ids).run()
+            except Exception as e:
+                # The next regular run picks these changes up
+                logger.error(e, exc_info=True)
+            return True
+
+    def serve(self):
+        """Receives events and runs the targeted cycles until a SIGTERM or SIGINT arrives"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        server = Thread(target=self.server.serve_forever, name='webhook', daemon=True)
+        server.start()
+        logger.info(f'Listening for TalentLMS webhook events on {self.server.server_address[0]}:{self.server.server_address[1]}')
+        while not self.stopping.is_set():
+            ids = self.events.take(self.debounce, self.max_delay)
+            if ids is None:
+                break
+            if not self.run_cycle(*ids):
+                # Give the other run some time before trying again
+                self.stopping.wait(self.debounce)
+        self.server.shutdown()
+        self.server.server_close()
+        self.session.remove()
+        self.engine.dispose()
+        logger.info('Webhook receiver stopped')
+
+
+def send_event(url, event, user_id=None, course_id=None, token=WEBHOOK_TOKEN):
+    """
+    Sends a fake TalentLMS webhook event, ex: to try the receiver locally
+
+    Args:
+        url (str): address of the receiver
+        event (str): name of the event, ex: course_completion, user_update or enrollment
+        user_id (str): TalentLMS user id of the event
+        course_id (str): TalentLMS course id of the event
+        token (str): shared secret of the receiver
+
+    Returns:
+        (class): Response object of the receiver
+    """
+    data = {key: value for key, value in (('user_id', user_id), ('course_id', course_id)) if value is not None}
+    headers = {'X-Webhook-Token': token} if token else {}
+    return requests.post(url, json={'event': event, 'data': data}, headers=headers, timeout=10)
+
+
+def main(argv=None):
+    """Runs the webhook receiver, or sends fake events to one with send"""
+    parser = argparse.ArgumentParser(description='Syncs the TalentLMS users and courses named by webhook events to Hubspot')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='receive events and run targeted cycles (the default)')
+    serve.add_argument('--host', default=WEBHOOK_HOST, help='address to listen on')
+    serve.add_argument('--port', type=int, default=WEBHOOK_PORT, help='port to listen on')
+    serve.add_argument('--debounce', type=float, default=WEBHOOK_DEBOUNCE, help='seconds without events before a cycle starts')
+    send = commands.add_parser('send', help='send a fake webhook event')
+    send.add_argument('--url', default=f'http://localhost:{WEBHOOK_PORT}/', help='address of the receiver')
+    send.add_argument('--event', default='course_completion', help='name of the event')
+    send.add_argument('--user-id', help='TalentLMS user id')
+    send.add_argument('--course-id', help='TalentLMS course id')
+    send.add_argument('--repeat', type=int, default=1, help='times to send the event, ex: to see it debounced')
+    args = parser.parse_args(argv)
+    if args.command == 'send':
+        for _ in range(args.repeat):
+            response = send_event(args.url, args.event, args.user_id, args.course_id)
+            print(response.status_code, response.text)
+    else:
+        host = getattr(args, 'host', WEBHOOK_HOST)
+        port = getattr(args, 'port', WEBHOOK_PORT)
+        debounce = getattr(args, 'debounce', WEBHOOK_DEBOUNCE)
+        WebhookReceiver(host=host, port=port, debounce=debounce).serve()
+
+
+if __name__ == '__main__':
+    main()